@@ -0,0 +1,347 @@
+"""
+USPEX.Stages.ABACUS_Archive
+
+Indexed archive of finished calc folders and pruning of their bulky files
+
+===========================
+"""
+import fnmatch
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from os.path import join as pj
+
+import numpy as np
+
+from .ABACUS_Staging import StagingCache
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+
+class ResultArchive:
+    '''
+    Keeps a compact record of every finished calc folder and frees its scratch space.
+
+    The final structure, energies, forces, stress and convergence flags go into one SQLite
+    index, the arrays as a compressed blob per record, and the running_*.log files into
+    logs/ compressed with zstd (gzip when zstandard is not installed). Listing the index never
+    decompresses anything, load() and readLog() only the record asked for.
+
+    After archiving, the retention policy is applied to the calc folder:
+        keep : nothing is removed
+        dedupe : staged pseudopotential and orbital files are replaced by hardlinks into a
+                 content-addressed pool, identical files share one inode. Bulky outputs stay in
+                 place, ABACUS rewrites them in place when the folder is reused
+        prune : bulky outputs (densities, wavefunctions, matrices) and the staged pseudopotential
+                and orbital files are deleted, they are staged again when the folder is reused
+        purge : as prune, and the OUT.* trees are deleted as a whole
+    '''
+
+    retentionPolicies = ('keep', 'dedupe', 'prune', 'purge')
+    bulkyPatterns = ('*CHG*.cube', 'chg*.cube', 'SPIN*_DM*', '*.restart', 'WAVEFUNC*', 'LOWF*', 'wfk*', 'wfc*',
+                     'data-*-H', 'data-*-S', '*R*.csr')
+    logPatterns = ('running_*.log',)
+    # dedupe stores between two sweeps of the pool
+    poolCheckInterval = 50
+
+    schema = '''CREATE TABLE IF NOT EXISTS records (
+                    id INTEGER PRIMARY KEY,
+                    tag TEXT NOT NULL,
+                    calcFolder TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    composition TEXT NOT NULL,
+                    natoms INTEGER NOT NULL,
+                    energy REAL,
+                    enthalpy REAL,
+                    volume REAL,
+                    converged INTEGER,
+                    relaxConverged INTEGER,
+                    ionicSteps INTEGER,
+                    aborted INTEGER NOT NULL DEFAULT 0,
+                    stages TEXT,
+                    logs TEXT,
+                    data BLOB NOT NULL);
+                CREATE INDEX IF NOT EXISTS records_key ON records (tag, composition);'''
+    columns = ('id', 'tag', 'calcFolder', 'created', 'composition', 'natoms', 'energy', 'enthalpy', 'volume',
+               'converged', 'relaxConverged', 'ionicSteps', 'aborted', 'stages', 'logs')
+
+    def __init__(self, folder: str, retention: str = 'prune', compressLogs: bool = True, level: int = 10):
+        '''
+        Parameter definition:
+            folder : Directory of the index, the compressed logs and the dedupe pool
+            retention : What happens to the calc folder once archived: keep, dedupe, prune or purge
+            compressLogs : Archive the running_*.log files
+            level : Compression level of the logs
+        '''
+        if retention not in self.retentionPolicies:
+            raise ValueError(f'Unknown retention policy {retention}, expected one of {self.retentionPolicies}')
+        self.folder = folder
+        self.retention = retention
+        self.compressLogs = compressLogs
+        self.level = level
+        self.logFolder = pj(folder, 'logs')
+        self.poolFolder = pj(folder, 'pool')
+        os.makedirs(self.logFolder, exist_ok=True)
+        self.filesRemoved = 0
+        self.bytesFreed = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(pj(folder, 'archive.sqlite'), timeout=60, check_same_thread=False)
+        self._db.executescript(self.schema)
+
+    ############################## Compression ##############################
+    @property
+    def logSuffix(self):
+        return '.zst' if zstandard is not None else '.gz'
+
+    def compress(self, source: str, dest: str):
+        tmp = f'{dest}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(source, 'rb') as fin, open(tmp, 'wb') as fout:
+            if dest.endswith('.zst'):
+                zstandard.ZstdCompressor(level=self.level).copy_stream(fin, fout)
+            else:
+                with gzip.GzipFile(fileobj=fout, mode='wb', compresslevel=min(self.level, 9)) as gz:
+                    shutil.copyfileobj(fin, gz)
+        os.replace(tmp, dest)
+
+    @staticmethod
+    def decompress(filename: str):
+        with open(filename, 'rb') as f:
+            if filename.endswith('.zst'):
+                if zstandard is None:
+                    raise ImportError(f'{filename} needs the zstandard package')
+                return zstandard.ZstdDecompressor().stream_reader(f).read()
+            return gzip.decompress(f.read())
+
+    @staticmethod
+    def packArrays(**arrays):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **{name: np.asarray(a) for name, a in arrays.items() if a is not None})
+        return buffer.getvalue()
+
+    ############################## Archiving ##############################
+    @staticmethod
+    def outputFolders(calcFolder: str):
+        '''
+        :return: OUT.* folders of calcFolder, including those kept by fused stages
+        '''
+        try:
+            return sorted(pj(calcFolder, name) for name in os.listdir(calcFolder)
+                          if name.startswith('OUT.') and os.path.isdir(pj(calcFolder, name)))
+        except OSError:
+            return []
+
+    def files(self, calcFolder: str, patterns):
+        matched = []
+        for output in self.outputFolders(calcFolder):
+            for root, _, names in os.walk(output):
+                matched += [pj(root, n) for n in names if any(fnmatch.fnmatch(n, p) for p in patterns)]
+        return matched
+
+    def store(self, tag, calcFolder: str, extracted: dict, enthalpy: float = None, aborted: bool = False,
+              stages: dict = None, staged=()):
+        '''
+        Archive a finished calc folder and apply the retention policy to it
+        :param extracted: what the ABACUS adapter read from the calc folder (atoms, energy, forces, ...)
+        :param staged: names of the staged pseudopotential/orbital files in calcFolder
+        :return: id of the record
+        '''
+        atoms = extracted['atoms']
+        symbols = np.asarray(atoms.get_chemical_symbols())
+        elements, counts = np.unique(symbols, return_counts=True)
+        data = self.packArrays(symbols=symbols, cell=atoms.get_cell().array, positions=atoms.get_positions(),
+                               pbc=atoms.get_pbc(), forces=extracted.get('forces'), stress=extracted.get('stress'))
+
+        def flag(value):
+            return None if value is None else int(bool(value))
+
+        with self._lock, self._db:
+            recordId = self._db.execute(
+                'INSERT INTO records (tag, calcFolder, created, composition, natoms, energy, enthalpy, volume, '
+                'converged, relaxConverged, ionicSteps, aborted, stages, data) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (str(tag), os.path.abspath(calcFolder), time.time(),
+                 ' '.join(f'{e}{c}' for e, c in zip(elements, counts)), len(symbols),
+                 extracted.get('energy'), enthalpy, extracted.get('volume'), flag(extracted.get('converged')),
+                 flag(extracted.get('relaxConverged')), extracted.get('ionicSteps'), int(bool(aborted)),
+                 json.dumps(stages, default=float) if stages else None, data)).lastrowid
+
+        logs = dict()
+        if self.compressLogs:
+            for log in self.files(calcFolder, self.logPatterns):
+                name = os.path.relpath(log, calcFolder)
+                dest = pj(self.logFolder, f'{recordId}.{name.replace(os.sep, "_")}{self.logSuffix}')
+                try:
+                    self.compress(log, dest)
+                    logs[name] = os.path.basename(dest)
+                except OSError as e:
+                    logger.warning(f'Cannot archive {log}: {e}')
+            if logs:
+                with self._lock, self._db:
+                    self._db.execute('UPDATE records SET logs = ? WHERE id = ?', (json.dumps(logs), recordId))
+
+        self.applyRetention(calcFolder, staged, logsArchived=len(logs) > 0 or not self.compressLogs)
+        return recordId
+
+    def applyRetention(self, calcFolder: str, staged=(), logsArchived: bool = True):
+        if self.retention == 'keep':
+            return
+        staged = [pj(calcFolder, os.path.basename(name)) for name in staged]
+        staged = [f for f in staged if os.path.isfile(f)]
+        if self.retention == 'dedupe':
+            # only files nothing writes to again can share an inode
+            for filename in staged:
+                self.dedupe(filename)
+            self.stores += 1
+            if self.stores % self.poolCheckInterval == 0:
+                self.prunePool()
+            return
+        bulky = self.files(calcFolder, self.bulkyPatterns)
+        for filename in bulky + staged:
+            self.remove(filename)
+        if self.retention == 'purge' and logsArchived:
+            for output in self.outputFolders(calcFolder):
+                for root, _, names in os.walk(output):
+                    for name in names:
+                        self.remove(pj(root, name))
+                shutil.rmtree(output, ignore_errors=True)
+
+    def remove(self, filename: str):
+        try:
+            stat = os.lstat(filename)
+            os.remove(filename)
+        except OSError as e:
+            logger.debug(f'Cannot remove {filename}: {e}')
+            return
+        with self._lock:
+            self.filesRemoved += 1
+            # a file with other links frees nothing
+            if stat.st_nlink <= 1:
+                self.bytesFreed += stat.st_size
+
+    def dedupe(self, filename: str):
+        '''
+        Replace filename by a hardlink to the pool copy of its content
+        '''
+        try:
+            stat = os.lstat(filename)
+            if not os.path.isfile(filename) or os.path.islink(filename) or stat.st_nlink > 1:
+                # already shared, e.g. hardlinked from the staging cache
+                return
+            os.makedirs(self.poolFolder, exist_ok=True)
+            pooled = pj(self.poolFolder, StagingCache.digest(filename))
+            if not os.path.exists(pooled):
+                os.link(filename, pooled)
+                return
+            tmp = f'{filename}.{os.getpid()}.dedupe'
+            os.link(pooled, tmp)
+            os.replace(tmp, filename)
+            with self._lock:
+                self.bytesFreed += stat.st_size
+        except OSError as e:
+            logger.debug(f'Cannot dedupe {filename}: {e}')
+
+    def prunePool(self):
+        '''
+        Remove pool files no calc folder links to anymore, their folders were restaged or deleted
+        '''
+        try:
+            names = os.listdir(self.poolFolder)
+        except OSError:
+            return
+        for name in names:
+            filename = pj(self.poolFolder, name)
+            try:
+                if os.stat(filename).st_nlink <= 1:
+                    self.remove(filename)
+            except OSError:
+                continue
+
+    ############################## Reloading ##############################
+    def query(self, tag=None, composition: str = None, converged: bool = None, limit: int = None):
+        '''
+        :param composition: as stored, e.g. "O2 Si1"
+        :return: list of record summaries, oldest first, without structures or logs
+        '''
+        conditions, arguments = [], []
+        for column, value in (('tag', None if tag is None else str(tag)), ('composition', composition),
+                              ('converged', None if converged is None else int(converged))):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                arguments.append(value)
+        sql = f'SELECT {", ".join(self.columns)} FROM records'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY id'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        with self._lock:
+            rows = self._db.execute(sql, arguments).fetchall()
+        records = []
+        for row in rows:
+            record = dict(zip(self.columns, row))
+            record['stages'] = json.loads(record['stages']) if record['stages'] else None
+            record['logs'] = json.loads(record['logs']) if record['logs'] else {}
+            records.append(record)
+        return records
+
+    def load(self, recordId: int):
+        '''
+        :return: summary of the record with its symbols, cell, positions, pbc, forces and stress arrays,
+                 None when there is no such record
+        '''
+        with self._lock:
+            row = self._db.execute(f'SELECT {", ".join(self.columns)}, data FROM records WHERE id = ?',
+                                   (recordId,)).fetchone()
+        if row is None:
+            return None
+        record = dict(zip(self.columns, row[:-1]))
+        record['stages'] = json.loads(record['stages']) if record['stages'] else None
+        record['logs'] = json.loads(record['logs']) if record['logs'] else {}
+        with np.load(io.BytesIO(row[-1])) as arrays:
+            record.update({name: arrays[name] for name in arrays.files})
+        return record
+
+    def atoms(self, recordId: int):
+        '''
+        :return: ase Atoms of the archived final structure
+        '''
+        from ase.atoms import Atoms
+        record = self.load(recordId)
+        return None if record is None else Atoms(record['symbols'], record['positions'], cell=record['cell'],
+                                                 pbc=record['pbc'])
+
+    def readLog(self, recordId: int, name: str = None):
+        '''
+        :param name: log path relative to the calc folder, the first archived log by default
+        :return: text of the archived log, None when it was not archived
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT logs FROM records WHERE id = ?', (recordId,)).fetchone()
+        logs = json.loads(row[0]) if row is not None and row[0] else {}
+        if not logs:
+            return None
+        archived = logs.get(name) if name is not None else next(iter(logs.values()))
+        if archived is None:
+            return None
+        return self.decompress(pj(self.logFolder, archived)).decode(errors='replace')
+
+    def statistics(self):
+        with self._lock:
+            records = self._db.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+        return dict(records=records, filesRemoved=self.filesRemoved, bytesFreed=self.bytesFreed)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
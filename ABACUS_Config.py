@@ -0,0 +1,123 @@
+"""
+USPEX.Stages.ABACUS_Config
+
+Parse-once registry of the ABACUS input files shared by all stages
+
+===========================
+"""
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class AtomicSpecies:
+    '''
+    Specific/ATOMIC_SPECIES : one "element mass pseudopotential" line per species
+    '''
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.masses = dict()
+        self.pseudopotentials = dict()
+        with open(filename, 'r') as f:
+            for line in f:
+                words = line.split('#')[0].split()
+                if len(words) < 3:
+                    continue
+                self.masses[words[0]] = float(words[1])
+                self.pseudopotentials[words[0]] = words[2]
+
+    @property
+    def elements(self):
+        return list(self.pseudopotentials)
+
+
+class NumericalOrbitals:
+    '''
+    Specific/NUMERICAL_ORBITAL : one "element orbital" line per species
+    '''
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.orbitals = dict()
+        with open(filename, 'r') as f:
+            for line in f:
+                words = line.split('#')[0].split()
+                if len(words) < 2:
+                    continue
+                self.orbitals[words[0]] = words[1]
+
+
+class InputParameters:
+    '''
+    Keyword map of an ABACUS INPUT file. Keys are lower case, values are kept as written,
+    later occurrences of a keyword override earlier ones as in ABACUS itself.
+    '''
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.parameters = dict()
+        with open(filename, 'r') as f:
+            for line in f:
+                words = line.split('#')[0].split(None, 1)
+                if len(words) < 2:
+                    continue
+                self.parameters[words[0].lower()] = words[1].strip()
+
+    def get(self, keyword: str, default=None):
+        return self.parameters.get(keyword.lower(), default)
+
+    def __contains__(self, keyword: str):
+        return keyword.lower() in self.parameters
+
+    @property
+    def basisType(self):
+        return self.get('basis_type', 'pw').lower()
+
+    @property
+    def isLCAO(self):
+        return self.basisType.startswith('lcao')
+
+
+class ConfigRegistry:
+    '''
+    Process-wide cache of parsed input files keyed by absolute path. An entry is reused
+    as long as the file keeps its mtime and size, otherwise the file is parsed again.
+    '''
+
+    def __init__(self):
+        self._entries = dict()
+        self._lock = threading.Lock()
+
+    def get(self, parser, filename: str):
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        key = (parser, filename)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                return entry[1]
+        logger.debug(f'Parsing {filename}')
+        parsed = parser(filename)
+        with self._lock:
+            self._entries[key] = (signature, parsed)
+        return parsed
+
+    def species(self, filename: str) -> AtomicSpecies:
+        return self.get(AtomicSpecies, filename)
+
+    def orbitals(self, filename: str) -> NumericalOrbitals:
+        return self.get(NumericalOrbitals, filename)
+
+    def input(self, filename: str) -> InputParameters:
+        return self.get(InputParameters, filename)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+registry = ConfigRegistry()
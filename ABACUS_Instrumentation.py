@@ -0,0 +1,275 @@
+"""
+USPEX.Stages.ABACUS_Instrumentation
+
+Opt-in per-phase timing and I/O accounting of the ABACUS interface
+
+===========================
+"""
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def ioCounters():
+    '''
+    :return: (bytes read, bytes written) through read/write calls of the current thread, zeros where
+             the kernel does not expose them. Memory-mapped reads are not included.
+    '''
+    for filename in ('/proc/thread-self/io', '/proc/self/io'):
+        try:
+            with open(filename) as f:
+                counters = dict(line.split(':') for line in f)
+            return int(counters['rchar']), int(counters['wchar'])
+        except (OSError, KeyError, ValueError):
+            continue
+    return 0, 0
+
+
+def parseTimingTable(filename: str, tail: int = 1 << 18):
+    '''
+    ABACUS's own timing table at the end of a running_*.log
+    :return: dict "class:name" -> seconds (the overall row as "total"), empty when there is none
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            f.seek(max(0, os.fstat(f.fileno()).st_size - tail))
+            text = f.read().decode(errors='replace')
+    except OSError:
+        return {}
+    start = max(text.rfind('CLASS_NAME'), text.rfind('TIME STATISTICS'))
+    if start < 0:
+        return {}
+    timings = dict()
+    for line in text[start:].splitlines()[1:]:
+        words = line.replace('%', ' ').split()
+        try:
+            # class name time calls avg per%, the overall row has no class
+            if len(words) == 6:
+                timings[f'{words[0]}:{words[1]}'] = float(words[2])
+            elif len(words) == 5 and words[0].lower() == 'total':
+                timings['total'] = float(words[1])
+        except ValueError:
+            continue
+    return timings
+
+
+class Instrumentation:
+    '''
+    Wall time, bytes read/written and file counts per calc folder and phase.
+
+    Phases are either timed with phase() or laid out as consecutive laps: start() opens a calc
+    folder in the current thread and every lap() closes the section since the previous one.
+    finish() completes the record of a calc folder, adds the DFT timing table of its log and
+    exports it. The set-up of an interface is timed the same way under setupKey(tag) and
+    exported by finishSetup() as a record of its own kind. When disabled every call is a no-op.
+    '''
+
+    formats = ('jsonl', 'prometheus')
+
+    _instances = dict()
+    _instancesLock = threading.Lock()
+
+    @classmethod
+    def forFile(cls, filename: str = None, format: str = 'jsonl'):
+        '''
+        Shared instrumentation for filename, so the interfaces of all stages of a run export into one
+        set of totals instead of overwriting each other. Disabled when filename is None.
+        '''
+        if filename is None:
+            return cls(format=format, enabled=False)
+        filename = os.path.abspath(filename)
+        with cls._instancesLock:
+            if filename not in cls._instances:
+                cls._instances[filename] = cls(filename, format=format)
+            return cls._instances[filename]
+
+    def __init__(self, filename: str = None, format: str = 'jsonl', enabled: bool = True):
+        '''
+        Parameter definition:
+            filename : JSON-lines file appended per calc folder, or Prometheus text file rewritten on export
+            format : 'jsonl' or 'prometheus'
+            enabled : False turns every call into a no-op
+        '''
+        if format not in self.formats:
+            raise ValueError(f'Unknown instrumentation format {format}, expected one of {self.formats}')
+        self.filename = filename
+        self.format = format
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # calcFolder -> phase -> [seconds, bytes read, bytes written, calls]
+        self._records = defaultdict(lambda: defaultdict(lambda: [0.0, 0, 0, 0]))
+        self._files = dict()
+        # phase -> [seconds, bytes read, bytes written, calls] over all finished calc folders
+        self.totals = defaultdict(lambda: [0.0, 0, 0, 0])
+        # the same over the set-ups of interfaces
+        self.setupTotals = defaultdict(lambda: [0.0, 0, 0, 0])
+        self.dftSeconds = 0.0
+        self.structures = 0
+        # reading the counters is itself a read, measured once and left out of every phase
+        first, second = ioCounters(), ioCounters()
+        self._ioOverhead = second[0] - first[0]
+
+    def _add(self, calcFolder, name, seconds, read, written):
+        calcFolder = os.path.normpath(calcFolder)
+        with self._lock:
+            entry = self._records[calcFolder][name]
+            entry[0] += seconds
+            entry[1] += max(0, read - self._ioOverhead)
+            entry[2] += written
+            entry[3] += 1
+
+    @contextmanager
+    def phase(self, calcFolder, name: str):
+        if not self.enabled:
+            yield
+            return
+        start, (read, written) = time.perf_counter(), ioCounters()
+        try:
+            yield
+        finally:
+            endRead, endWritten = ioCounters()
+            self._add(calcFolder, name, time.perf_counter() - start, endRead - read, endWritten - written)
+
+    def start(self, calcFolder):
+        if self.enabled:
+            self._local.lap = (calcFolder, time.perf_counter(), ioCounters())
+
+    def lap(self, calcFolder, name: str):
+        if not self.enabled:
+            return
+        previous = getattr(self._local, 'lap', None)
+        now, counters = time.perf_counter(), ioCounters()
+        if previous is not None and previous[0] == calcFolder:
+            self._add(calcFolder, name, now - previous[1], counters[0] - previous[2][0], counters[1] - previous[2][1])
+        self._local.lap = (calcFolder, now, counters)
+
+    def countFiles(self, calcFolder: str):
+        '''
+        Record how many files calcFolder holds, OUT.* folders included
+        '''
+        if not self.enabled:
+            return
+        count = 0
+        for _, _, files in os.walk(calcFolder):
+            count += len(files)
+        with self._lock:
+            self._files[os.path.normpath(calcFolder)] = count
+
+    def instrumentAdapter(self, adapter):
+        '''
+        Time read and write of an ASEInterfaceAdapter backend instance, attributed to the calc
+        folder given by their calcFolder, foldername or filename argument
+        '''
+        if not self.enabled:
+            return adapter
+        for method in ('read', 'write'):
+            function = getattr(adapter, method, None)
+            if function is not None:
+                setattr(adapter, method, self._timed(function, f'{type(adapter).__name__}.{method}'))
+        return adapter
+
+    def _timed(self, function, name):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            path = next((arguments[key] for key in ('calcFolder', 'foldername', 'filename') if key in arguments), '')
+            calcFolder = os.path.normpath(str(path))
+            if os.path.basename(calcFolder).startswith('OUT.') or not os.path.isdir(calcFolder):
+                calcFolder = os.path.dirname(calcFolder)
+            with self.phase(calcFolder, name):
+                return function(*args, **kwargs)
+        return timed
+
+    def finish(self, calcFolder: str, log: str = None, **extra):
+        '''
+        Complete the record of calcFolder and export it
+        :param log: running_*.log whose timing table is added as the DFT cost
+        :return: the record, None when disabled
+        '''
+        if not self.enabled:
+            return None
+        dft = parseTimingTable(log) if log is not None else {}
+        calcFolder = os.path.normpath(calcFolder)
+        with self._lock:
+            phases = self._records.pop(calcFolder, {})
+            record = dict(kind='calcFolder', calcFolder=calcFolder, time=time.time(),
+                          files=self._files.pop(calcFolder, None), phases=self._phases(phases, self.totals),
+                          dft=dft, **extra)
+            self.dftSeconds += dft.get('total', 0.0)
+            self.structures += 1
+        self.export(record)
+        return record
+
+    @staticmethod
+    def setupKey(tag: str):
+        '''
+        :return: name under which start() and lap() time the set-up of the interface for tag
+        '''
+        return f'setup:{tag}'
+
+    def finishSetup(self, tag: str):
+        '''
+        Complete and export the record of the set-up of the interface for tag, which counts
+        neither as a calc folder nor as a structure
+        :return: the record, None when disabled
+        '''
+        if not self.enabled:
+            return None
+        with self._lock:
+            phases = self._records.pop(os.path.normpath(self.setupKey(tag)), {})
+            record = dict(kind='setup', tag=str(tag), time=time.time(), phases=self._phases(phases, self.setupTotals))
+        self.export(record)
+        return record
+
+    @staticmethod
+    def _phases(phases: dict, totals: dict):
+        '''
+        :return: phases of a record as dicts, after adding them to totals
+        '''
+        for name, entry in phases.items():
+            total = totals[name]
+            for i in range(4):
+                total[i] += entry[i]
+        return {name: dict(seconds=entry[0], bytesRead=entry[1], bytesWritten=entry[2], calls=entry[3])
+                for name, entry in phases.items()}
+
+    def export(self, record: dict = None):
+        if self.filename is None:
+            return
+        with self._lock:
+            if self.format == 'jsonl':
+                if record is not None:
+                    with open(self.filename, 'a') as f:
+                        f.write(json.dumps(record) + '\n')
+                return
+            lines = ['# TYPE uspex_abacus_phase_seconds_total counter',
+                     '# TYPE uspex_abacus_phase_bytes_read_total counter',
+                     '# TYPE uspex_abacus_phase_bytes_written_total counter',
+                     '# TYPE uspex_abacus_phase_calls_total counter']
+            for name, (seconds, read, written, calls) in sorted(self.totals.items()):
+                lines += [f'uspex_abacus_phase_seconds_total{{phase="{name}"}} {seconds:.6f}',
+                          f'uspex_abacus_phase_bytes_read_total{{phase="{name}"}} {read}',
+                          f'uspex_abacus_phase_bytes_written_total{{phase="{name}"}} {written}',
+                          f'uspex_abacus_phase_calls_total{{phase="{name}"}} {calls}']
+            lines += ['# TYPE uspex_abacus_setup_seconds_total counter']
+            lines += [f'uspex_abacus_setup_seconds_total{{phase="{name}"}} {entry[0]:.6f}'
+                      for name, entry in sorted(self.setupTotals.items())]
+            lines += ['# TYPE uspex_abacus_dft_seconds_total counter',
+                      f'uspex_abacus_dft_seconds_total {self.dftSeconds:.6f}',
+                      '# TYPE uspex_abacus_structures_total counter',
+                      f'uspex_abacus_structures_total {self.structures}']
+            tmp = f'{self.filename}.tmp'
+            with open(tmp, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp, self.filename)
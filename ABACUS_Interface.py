@@ -9,13 +9,25 @@ import logging
 import numpy as np
 import shutil
 import os
+import time
 from os.path import join as pj
 from typing import List
-from ase.io import write,read
 from .KPoints import KPoints, BadKPoints
-from ase.atoms import Atoms
 import glob
-from ase.io.abacus import AbacusOutCalcChunk, AbacusOutHeaderChunk
+from concurrent.futures import ThreadPoolExecutor
+from .ABACUS_Staging import StagingCache
+from .ABACUS_Config import registry
+from .ABACUS_LogTailer import LogTailer
+from .ABACUS_ResultCache import ResultCache, Fingerprint, settingsKey
+from .ABACUS_WarmStart import DensityStore, composition
+from .ABACUS_Monitor import EarlyAbortMonitor
+from .ABACUS_Runner import PackedRunner, writePackScript
+from .ABACUS_Tuner import Layout, ParallelTuner
+from .ABACUS_Prescreen import SurrogatePrescreen
+from .ASEInterfaceAdapter import ASEInterfaceAdapter
+from .ABACUS_Instrumentation import Instrumentation
+from .ABACUS_Archive import ResultArchive
+from .ABACUS_Retry import RetryRegistry, DiscardedStructure, structureKey
 
 logger = logging.getLogger(__name__)
 
@@ -40,8 +52,14 @@ class ABACUS_Interface:
     log2_file = 'OUT.USPEX/running_relax.log'
     log3_file = 'OUT.USPEX/running_scf.log'
     cif_file = 'OUT.USPEX/STRU_NOW.cif'
+    # written into calc folders whose result comes from the result cache, run.sh may skip ABACUS there
+    cached_file = 'USPEX_CACHED'
+    # written into calc folders whose structure the retry registry gave up on, run.sh may skip ABACUS there
+    discarded_file = 'USPEX_DISCARDED'
 
     DEFAULT_SLEEP_TIME = 30
+    # seconds a finished log of a fused job may wait for the runner's USPEX_DONE
+    missingDoneDelay = 300
     aseAdapterType = None
     
     @classmethod
@@ -55,7 +73,52 @@ class ABACUS_Interface:
             kresol : The resolution of kpoints
             input : The location of input file
             targetProperties: Target properties
+            stagingFolder : Per-run cache of pseudopotential/orbital files (default: .abacus_staging)
+            stagingLinkMode : How staged files are placed in calc folders: hardlink, symlink or copy
+            stagingCleanup : keep or exit, whether the staging cache outlives the run
+            resultCache : SQLite file of finished results reused for duplicate structures (disabled by default)
+            resultCacheTolerance : Largest fingerprint distance treated as the same structure
+            resultCacheMaxAge : Cached results unused for this many days are evicted
+            resultCacheMaxEntries : Largest number of cached results kept
+            warmStart : Start the SCF from the stored density of a finished structure of the same
+                        composition and a compatible cell (default False)
+            warmStartFolder : Directory of the stored densities (default: .abacus_density)
+            warmStartTolerance : Largest relative difference of cell lengths for a compatible cell
+            warmStartFingerprintTolerance : Largest fingerprint distance between the two structures (default 0.05)
+            earlyAbort : Stop relaxations whose projected enthalpy is not competitive (default False)
+            earlyAbortMargin : Allowed excess over the median finished enthalpy, eV/atom
+            earlyAbortMinSteps : Ionic steps before a relaxation is judged by its energy
+            earlyAbortKillCommand : Command stopping the job of {calcFolder}, e.g. for remote jobs
+            abacusCommand : ABACUS command of packed runs (default: $USPEX_ABACUS_COMMAND or abacus)
+            mpiCommand : MPI launcher of packed runs, {np} is the number of processes
+            packCores, packWorkers, packOmpThreads : Cores of a packed allocation, calculations run at
+                        the same time in it and OpenMP threads per MPI process
+            tuneParallel : Choose kpar, bndpar and the MPI x OpenMP layout per structure (default False)
+            tunerCores : Cores of one calculation (default: packCores/packWorkers, or cores of this node)
+            tunerHistory : JSON-lines file of observed wall times (default: .abacus_tuning.jsonl)
+            fusedTags : Tags of further stages chained in the same job after this one, each run from
+                        Specific/INPUT_<tag> and restarted from the previous stage (needs ABACUS_Runner)
+            fusedKresols : k-point resolution of each fused stage (default: kresol)
+            prescreen : Rank candidates with a surrogate before they reach ABACUS (default False)
+            prescreenCalculator : ASE calculator (or "package.module.Class") of the surrogate, by default a
+                        model trained on the finished structures is used
+            prescreenFraction, prescreenExploration : Shares of the candidates kept as best ranked and at random
+            prescreenRelaxSteps : Steps of surrogate pre-relaxation before ranking
+            prescreenModel : File keeping the trained model across runs
+            prepareWorkers : Threads used by prepareBatch for the file work of a generation (default 8)
+            instrumentation : File receiving per-phase timings and I/O of every calc folder (disabled by default)
+            instrumentationFormat : jsonl (one record per calc folder) or prometheus (running totals)
+            archive : Directory of the indexed archive of finished calc folders (disabled by default)
+            archiveRetention : What is removed from an archived calc folder: keep, dedupe (pools the staged
+                        files), prune (bulky outputs and staged files, default) or purge (the whole OUT.* trees)
+            archiveLogs : Keep a compressed copy of the logs in the archive (default True)
+            retryMaxAttempts : Reruns of a failed structure before it is discarded (default 3, one per SCF remedy)
+            retryHistory : JSON file counting which remedy fixed which kind of failure
+                        (default: .abacus_retry.json)
         '''
+        self.instrumentation = Instrumentation.forFile(kwargs.get('instrumentation'),
+                                                       format=kwargs.get('instrumentationFormat', 'jsonl'))
+        self.instrumentation.start(Instrumentation.setupKey(tag))
         self.tag = tag
         if input is not None:
             self.input = input
@@ -68,40 +131,137 @@ class ABACUS_Interface:
         self.log_file1='OUT.USPEX/running_cell-relax.log'
         self.log_file2='OUT.USPEX/running_relax.log'
         self.log_file3='OUT.USPEX/running_scf.log'
-        self.adapter = self.aseAdapterType()
+        self.adapter = self.instrumentation.instrumentAdapter(self.aseAdapterType())
         self.kPoints = KPoints(kresol)
 
-        #### Reading potential
-        pseudopotentials = dict()
-
-        with open('Specific/ATOMIC_SPECIES', 'r') as pse:
-            Lines =  pse.readlines()
-            for line in Lines:
-                element = line.rstrip('\n').split()[0]
-                mass = line.rstrip('\n').split()[1]
-                pot = line.rstrip('\n').split()[2]
-                pseudopotentials[element] = pot
-        ### Reading orbital
-        basis = dict()
-        with open('Specific/NUMERICAL_ORBITAL','r') as orb:
-            Lines_orb = orb.readlines()
-            for line_orb in Lines_orb:
-                element_o = line_orb.rstrip('\n').split()[0]
-                Orb = line_orb.rstrip('\n').split()[1]
-                basis[element_o] = Orb
-       # print(self.basis)
-        self.pseudopotentials = {s : p for s, p in pseudopotentials.items()}
-        with open(self.input, 'r') as file:
-            file_content = file.read()
-            if 'lcao' not in file_content:
-                self.basis = None
-            else:
-                self.basis = {s: orbital for s, orbital in basis.items()}
-        print(self.input)
-        print(self.basis)
-        self.failedSystems = []
+        #### Input files are parsed once per process and shared by every stage and structure
+        logger.info(f'{self.input}: basis_type {registry.input(self.input).basisType}')
+        # appended to by USPEX for calc folders to rerun, each failure is diagnosed from the log
+        self.failedSystems = RetryRegistry(history=kwargs.get('retryHistory', pj(os.getcwd(), '.abacus_retry.json')),
+                                           maxAttempts=kwargs.get('retryMaxAttempts'),
+                                           outputFolder=self.output_file)
         self.targetProperties = targetProperties if targetProperties is not None else ['structure', 'enthalpy']
+        self.staging = StagingCache.forFolder(kwargs.get('stagingFolder', pj(os.getcwd(), '.abacus_staging')),
+                                              linkMode=kwargs.get('stagingLinkMode', 'hardlink'),
+                                              cleanup=kwargs.get('stagingCleanup', 'keep'))
+        self.tailer = LogTailer()
+
+        self.resultCache = None
+        if kwargs.get('resultCache') is not None:
+            maxAge = kwargs.get('resultCacheMaxAge')
+            self.resultCache = ResultCache(kwargs['resultCache'],
+                                           tolerance=kwargs.get('resultCacheTolerance', 0.01),
+                                           maxAge=maxAge * 86400 if maxAge is not None else None,
+                                           maxEntries=kwargs.get('resultCacheMaxEntries'))
+        # calcFolder -> cached results / (fingerprint, settings key) to store once finished
+        self.cacheHits = dict()
+        self.cacheKeys = dict()
+
+        self.densities = None
+        if kwargs.get('warmStart', False):
+            self.densities = DensityStore(kwargs.get('warmStartFolder', pj(os.getcwd(), '.abacus_density')),
+                                          tolerance=kwargs.get('warmStartTolerance', 0.02),
+                                          fingerprintTolerance=kwargs.get('warmStartFingerprintTolerance', 0.05))
+        # calcFolder -> density entry it was started from; folders whose warm start diverged start cold
+        self.warmStarted = dict()
+        self.coldStart = set()
+        self.prepareWorkers = kwargs.get('prepareWorkers', 8)
+        # calcFolder -> discarding Remedy, these folders are not run and read as discarded
+        self.discarded = dict()
+
+        self.monitor = None
+        if kwargs.get('earlyAbort', False):
+            self.monitor = EarlyAbortMonitor(margin=kwargs.get('earlyAbortMargin', 0.3),
+                                             minSteps=kwargs.get('earlyAbortMinSteps', 3),
+                                             killCommand=kwargs.get('earlyAbortKillCommand'))
+        # calcFolder -> (number of atoms, external pressure) of the running structure
+        self.running = dict()
+        self.packOptions = dict(cores=kwargs.get('packCores'), workers=kwargs.get('packWorkers', 1),
+                                ompThreads=kwargs.get('packOmpThreads', 1),
+                                abacusCommand=kwargs.get('abacusCommand'), mpiCommand=kwargs.get('mpiCommand'))
+
+        self.tuner = None
+        if kwargs.get('tuneParallel', False):
+            # a packed calculation only gets its share of the allocation
+            cores = self.packOptions['cores'] or os.cpu_count() or 1
+            self.tuner = ParallelTuner(kwargs.get('tunerCores', max(1, cores // max(1, self.packOptions['workers']))),
+                                       history=kwargs.get('tunerHistory', pj(os.getcwd(), '.abacus_tuning.jsonl')))
+        # calcFolder -> (tag, irreducible k-points, number of atoms, LCAO, Layout) of every stage it runs
+        self.layouts = dict()
+
+        self.fusedTags = [str(t) for t in kwargs.get('fusedTags', [])]
+        fusedKresols = kwargs.get('fusedKresols') or [kresol] * len(self.fusedTags)
+        self.fusedStages = [(t, pj(os.getcwd(), f'Specific/INPUT_{t}'), KPoints(k))
+                            for t, k in zip(self.fusedTags, fusedKresols)]
+        for _, fusedInput, _ in self.fusedStages:
+            assert os.path.exists(fusedInput)
+        # calc folders whose finished log came without an USPEX_DONE, reported once each
+        self.missingDone = set()
+        runScript = pj(os.getcwd(), 'Specific/run.sh')
+        if self.fusedStages and os.path.exists(runScript):
+            with open(runScript) as f:
+                if 'ABACUS_Runner' not in f.read():
+                    logger.warning(f'fusedTags need the calculations to run through ABACUS_Runner.py, which '
+                                   f'{runScript} does not call: the later stages will not run and no '
+                                   f'{PackedRunner.doneFile} will mark the calc folders finished')
+
+        self.screen = None
+        if kwargs.get('prescreen', False):
+            self.screen = SurrogatePrescreen(calculator=kwargs.get('prescreenCalculator'),
+                                             fraction=kwargs.get('prescreenFraction', 0.5),
+                                             exploration=kwargs.get('prescreenExploration', 0.1),
+                                             relaxSteps=kwargs.get('prescreenRelaxSteps', 0),
+                                             modelFile=kwargs.get('prescreenModel'))
+
+        self.archive = None
+        if kwargs.get('archive') is not None:
+            self.archive = ResultArchive(kwargs['archive'], retention=kwargs.get('archiveRetention', 'prune'),
+                                         compressLogs=kwargs.get('archiveLogs', True))
 
+        self.instrumentation.lap(Instrumentation.setupKey(tag), '__init__')
+        self.instrumentation.finishSetup(tag)
+
+    @property
+    def pseudopotentials(self):
+        return registry.species(self.potentials_file).pseudopotentials
+
+    @property
+    def basis(self):
+        if not registry.input(self.input).isLCAO:
+            return None
+        return registry.orbitals(self.orbital_file).orbitals
+
+    def clearInputs(self, calcFolder: str):
+        '''
+        Remove the inputs and logs of an earlier run in a reused calc folder. The logs would pass for
+        those of the next run, and a folder left without INPUT makes ABACUS stop at once when
+        Specific/run.sh does not check for USPEX_CACHED or USPEX_DISCARDED.
+        '''
+        stale = [pj(calcFolder, name) for name in (self.input_file, self.kpoints_file, self.stru_file,
+                                                   PackedRunner.stagesFile, PackedRunner.parallelFile)]
+        stale += glob.glob(pj(calcFolder, f'{self.input_file}_*')) + glob.glob(pj(calcFolder, f'{self.kpoints_file}_*'))
+        stale += glob.glob(pj(calcFolder, self.output_file, 'running*.log'))
+        for filename in stale:
+            if os.path.isfile(filename):
+                os.remove(filename)
+        for stage in glob.glob(pj(calcFolder, f'{self.output_file}.*')):
+            if os.path.isdir(stage):
+                shutil.rmtree(stage, ignore_errors=True)
+
+    @staticmethod
+    def applyLayout(inputFile: str, parameters, layout: Layout):
+        '''
+        Append the kpar and bndpar of layout to inputFile, keywords set by the user in INPUT win over the tuner
+        :param parameters: InputParameters the INPUT was copied from
+        :return: Layout the calculation actually runs with
+        '''
+        with open(inputFile, 'a') as myfile:
+            if 'kpar' not in parameters:
+                myfile.write(f'kpar {layout.kpar}\n')
+            if 'bndpar' not in parameters and layout.bndpar > 1:
+                myfile.write(f'bndpar {layout.bndpar}\n')
+        return Layout(layout.mpiProcesses, layout.ompThreads, int(float(parameters.get('kpar', layout.kpar))),
+                      int(float(parameters.get('bndpar', layout.bndpar))))
 
     def prepareLocalCalculation(self, system, calcFolder: str):
         '''
@@ -110,21 +270,35 @@ class ABACUS_Interface:
         '''
  
         structure = system['structure']
+        parameters = registry.input(self.input)
+        remedy = self.failedSystems.remedy(calcFolder, structureKey(structure), parameters,
+                                           parameters.get('calculation', 'scf').lower())
+        self.discarded.pop(calcFolder, None)
+        if remedy is not None and remedy.discard:
+            # not raised here, USPEX would stop the whole run: isConverged and readOutput finish the folder
+            self.discarded[calcFolder] = remedy
+            self.clearInputs(calcFolder)
+            with open(pj(calcFolder, self.discarded_file), 'w') as f:
+                f.write(f'{remedy.failure}\n')
+            return
+        self.instrumentation.start(calcFolder)
+        self.tailer.reset(pj(calcFolder, self.output_file))
+        self.missingDone.discard(calcFolder)
+        self.running[calcFolder] = (len(structure.getAtomTypes()), system['externalPressure'])
+        for marker in (EarlyAbortMonitor.abortedFile, PackedRunner.doneFile, self.discarded_file):
+            if os.path.exists(pj(calcFolder, marker)):
+                os.remove(pj(calcFolder, marker))
+        self.clearInputs(calcFolder)
+        present = {el.short_name for el in structure.getAtomTypes()}
+        pseudopotentials, basis = self.pseudopotentials, self.basis
 
-        with open('Specific/ATOMIC_SPECIES', 'r') as pse:
-             Lines =  pse.readlines()
-             for line in Lines:
-                 upf = line.rstrip('\n').split()[2]
-                 source_file = 'Specific' + "/" + upf
-                 shutil.copy(source_file, calcFolder)
-        
-        if self.basis is not None:
-             with open('Specific/NUMERICAL_ORBITAL', 'r') as orb:
-                 Lines =  orb.readlines()
-                 for line in Lines:
-                     ls = line.rstrip('\n').split()[1]
-                     source_file = 'Specific' + "/" + ls
-                     shutil.copy(source_file, calcFolder)
+        ######################## Pseudopotentials and orbitals ########################
+        # only the species of this structure are staged, as links into the per-run cache
+        for element in present:
+            self.staging.place(pj('Specific', pseudopotentials[element]), calcFolder)
+            if basis is not None:
+                self.staging.place(pj('Specific', basis[element]), calcFolder)
+        self.instrumentation.lap(calcFolder, 'staging')
         
         ############################## INPUT ################################
         source = self.input 
@@ -136,8 +310,9 @@ class ABACUS_Interface:
                 myfile.write(f"press1 \t {10*system['externalPressure']:10f}\n")
                 myfile.write(f"press2 \t {10*system['externalPressure']:10f}\n")
                 myfile.write(f"press3 \t {10*system['externalPressure']:10f}\n")
-        if calcFolder in self.failedSystems:
-            with open(pj(calcFolder, self.input_file), 'a') as myfile: myfile.write('symmetry -1\n')
+        if remedy is not None:
+            with open(pj(calcFolder, self.input_file), 'a') as myfile: myfile.write(remedy.inputLines())
+        self.instrumentation.lap(calcFolder, 'input')
         ############################# KPT #################################
         try:
             kPoints = self.kPoints.build(structure.getCell())
@@ -146,60 +321,378 @@ class ABACUS_Interface:
             logger.info('K-points cannot be built, so it\'s set as   [1, 1, 1]')
             kPoints = [1, 1, 1]
 
-        with open(pj(calcFolder, self.kpoints_file), 'w') as fp:
-            fp.write('K_POINTS\n0\nGamma\n')
-            fp.write('%4d %4d %4d   0   0   0\n' % tuple(kPoints))
+        self.adapter.writeKPoints(pj(calcFolder, self.kpoints_file), kPoints)
+
+        ############################# Fused stages #############################
+        stagesFile = pj(calcFolder, PackedRunner.stagesFile)
+        # INPUT and k-mesh of every fused stage, they shape the result as much as those of the first
+        fusedSettings = []
+        # (tag, INPUT, k-mesh) of every stage the job runs, tuned one by one below
+        stageMeshes = [(str(self.tag), self.input, kPoints)]
+        # out_chg is appended at most once and never over the user's own setting
+        writesDensity = 'out_chg' in parameters
+        if self.fusedStages:
+            # every stage but the last leaves its density for the next one
+            if not writesDensity:
+                with open(pj(calcFolder, self.input_file), 'a') as myfile:
+                    myfile.write('out_chg 1\n')
+                writesDensity = True
+            for i, (tag, fusedInput, fusedKPoints) in enumerate(self.fusedStages):
+                dest = pj(calcFolder, f'{self.input_file}_{tag}')
+                shutil.copy2(fusedInput, dest)
+                with open(dest, 'a') as myfile:
+                    if system['externalPressure']:
+                        for press in ('press1', 'press2', 'press3'):
+                            myfile.write(f"{press} \t {10*system['externalPressure']:10f}\n")
+                    if remedy is not None:
+                        myfile.write(remedy.inputLines())
+                    # the last stage keeps its density only for the warm start store
+                    lastStage = i == len(self.fusedStages) - 1
+                    if (not lastStage or self.densities is not None) and 'out_chg' not in registry.input(fusedInput):
+                        myfile.write('out_chg 1\n')
+                try:
+                    stageKPoints = fusedKPoints.build(structure.getCell())
+                except BadKPoints:
+                    stageKPoints = [1, 1, 1]
+                self.adapter.writeKPoints(pj(calcFolder, f'{self.kpoints_file}_{tag}'), stageKPoints)
+                stageMeshes.append((tag, fusedInput, stageKPoints))
+                with open(dest, 'rb') as f:
+                    fusedSettings += [tag, f.read(), tuple(stageKPoints)]
+            with open(stagesFile, 'w') as fp:
+                fp.write('\n'.join([str(self.tag)] + self.fusedTags) + '\n')
+        self.instrumentation.lap(calcFolder, 'kpoints')
+
+        ############################# Result cache #############################
+        self.cacheHits.pop(calcFolder, None)
+        self.cacheKeys.pop(calcFolder, None)
+        if self.resultCache is not None:
+            with open(pj(calcFolder, self.input_file), 'rb') as f:
+                key = settingsKey(f.read(), tuple(kPoints), system['externalPressure'], sorted(self.targetProperties),
+                                  *fusedSettings)
+            fingerprint = Fingerprint(structure)
+            cached = self.resultCache.lookup(fingerprint, key)
+            marker = pj(calcFolder, self.cached_file)
+            if cached is not None:
+                self.cacheHits[calcFolder] = cached
+                self.clearInputs(calcFolder)
+                with open(marker, 'w') as f:
+                    f.write(f'{fingerprint.composition}\n')
+                self.instrumentation.lap(calcFolder, 'resultCache')
+                self.instrumentation.countFiles(calcFolder)
+                return ''
+            else:
+                self.cacheKeys[calcFolder] = (fingerprint, key)
+                if os.path.exists(marker):
+                    os.remove(marker)
+            self.instrumentation.lap(calcFolder, 'resultCache')
+
+        ############################# Warm start #############################
+        self.warmStarted.pop(calcFolder, None)
+        if self.densities is not None and calcFolder not in self.cacheHits:
+            with open(pj(calcFolder, self.input_file), 'a') as myfile:
+                if not writesDensity:
+                    myfile.write('out_chg 1\n')
+                entry = None
+                if calcFolder not in self.coldStart:
+                    # reused from the result cache lookup when there was one
+                    cacheKey = self.cacheKeys.get(calcFolder)
+                    fingerprint = cacheKey[0] if cacheKey is not None else Fingerprint(structure)
+                    entry = self.densities.find(self.tag, composition(structure), structure.getCell().getCellVectors(),
+                                                fingerprint)
+                if entry is not None and self.densities.place(entry, pj(calcFolder, self.output_file)):
+                    myfile.write('init_chg file\n')
+                    self.warmStarted[calcFolder] = entry
+                    logger.info(f'{calcFolder}: SCF starts from the density of {entry}')
+            self.instrumentation.lap(calcFolder, 'warmStart')
+
+        ############################# Parallel layout #############################
+        self.layouts.pop(calcFolder, None)
+        if self.tuner is not None and calcFolder not in self.cacheHits:
+            natoms = len(structure.getAtomTypes())
+            overrides = remedy.overrides if remedy is not None else {}
+            self.layouts[calcFolder] = []
+            layout = None
+            for i, (tag, stageInput, stageKPoints) in enumerate(stageMeshes):
+                stageParameters = registry.input(stageInput)
+                symmetry = int(float(overrides.get('symmetry', stageParameters.get('symmetry', 1))))
+                nk = self.tuner.irreducibleKPoints(stageKPoints, structure, symmetry)
+                if layout is None:
+                    stageLayout = layout = self.tuner.choose(nk, natoms, stageParameters.isLCAO)
+                else:
+                    # the MPI x OpenMP split of the job is that of the first stage, only the pools differ
+                    stageLayout = Layout(layout.mpiProcesses, layout.ompThreads,
+                                         *self.tuner.pools(nk, natoms, stageParameters.isLCAO, layout.mpiProcesses))
+                dest = pj(calcFolder, self.input_file if i == 0 else f'{self.input_file}_{tag}')
+                used = self.applyLayout(dest, stageParameters, stageLayout)
+                self.layouts[calcFolder].append((tag, nk, natoms, stageParameters.isLCAO, used))
+            # sourced by Specific/run.sh, read by the packed runner
+            with open(pj(calcFolder, PackedRunner.parallelFile), 'w') as fp:
+                fp.write(f'export OMP_NUM_THREADS={layout.ompThreads}\n')
+                fp.write(f'export USPEX_MPI_PROCESSES={layout.mpiProcesses}\n')
+            self.instrumentation.lap(calcFolder, 'tuning')
 
     ############################# STRU ##################################
-        #system['ase'] = self.adapter.write( structure, self.pseudopotentials, self.basis, calcFolder)
-        cell = structure.getCell()
-        symbols = np.asarray([el.short_name for el in structure.getAtomTypes()])
-        order = np.argsort(symbols)
-        atoms = Atoms(symbols[order], structure.getCartesianCoordinates()[order], cell=cell.getCellVectors())
-
-        if  self.pseudopotentials is not None:
-            pse = {element : poten for element, poten in self.pseudopotentials.items() if element in set(symbols)}
+        if  pseudopotentials is not None:
+            pse = {element : poten for element, poten in pseudopotentials.items() if element in present}
         else:
             pse = None
 
-        if self.basis is not None:
-            bas = {element : basi for element, basi in self.basis.items() if element in set(symbols)}
+        if basis is not None:
+            bas = {element : basi for element, basi in basis.items() if element in present}
         else:
             bas = None
         system['ase']=self.adapter.write(pj(calcFolder,self.stru_file), structure, pp = pse, basis = bas)
+        if remedy is not None and remedy.restart is not None and os.path.exists(remedy.restart):
+            # continue from the last ionic frame of the failed run
+            shutil.copy2(remedy.restart, pj(calcFolder, self.stru_file))
+        self.instrumentation.lap(calcFolder, 'stru')
+        self.instrumentation.countFiles(calcFolder)
 
         return ''
 
+    def prescreen(self, systems: List[dict]):
+        '''
+        Surrogate ranking of a generation before it is prepared
+        :param systems: candidate systems
+        :return: the systems worth an ABACUS calculation, all of them when prescreening is off
+        '''
+        if self.screen is None:
+            return list(systems)
+        return self.screen.screen(systems)
+
+    def prepareBatch(self, systems: List[dict], calcFolders: List[str], maxWorkers: int = None):
+        '''
+        prepareLocalCalculation for a whole generation. The input files are parsed once up front,
+        the per-folder copies and writes overlap on a pool of maxWorkers threads.
+        :param systems: our systems
+        :param calcFolders: calc folder of each system
+        :return: dict calcFolder -> exception for the folders that could not be prepared,
+                 DiscardedStructure for those the retry registry gave up on
+        '''
+        if len(systems) != len(calcFolders):
+            raise ValueError(f'{len(systems)} systems for {len(calcFolders)} calc folders')
+        # warm the registry so the workers only read parsed configuration
+        _ = self.pseudopotentials, self.basis
+
+        def prepare(system, calcFolder):
+            try:
+                self.prepareLocalCalculation(system, calcFolder)
+                if calcFolder in self.discarded:
+                    raise DiscardedStructure(f'{calcFolder}: structure discarded after '
+                                             f'{self.discarded[calcFolder].failure} failures')
+            except Exception as e:
+                logger.warning(f'{calcFolder}: preparation failed: {e!r}')
+                return calcFolder, e
+            return calcFolder, None
+
+        maxWorkers = maxWorkers or self.prepareWorkers
+        with ThreadPoolExecutor(max_workers=max(1, min(maxWorkers, len(systems) or 1))) as pool:
+            outcomes = list(pool.map(prepare, systems, calcFolders))
+        return {calcFolder: error for calcFolder, error in outcomes if error is not None}
+
+    def packScript(self, calcFolders: List[str], filename: str):
+        '''
+        Write a script running all calcFolders inside one allocation, to be submitted as a single job
+        instead of Specific/run.sh in every folder. Each folder gets a USPEX_DONE marker when it ends.
+        :return: filename
+        '''
+        return writePackScript(filename, calcFolders, **self.packOptions)
+
     # Checking whether the SCF has converged
     def isConverged(self, calcFolder: str):
-        filename  = pj(calcFolder, self.output_file)
-        for i in os.listdir(filename):
-            if i.startswith('running') and i.endswith('log'):
-                log = i
-                with open(pj(filename,log), 'r') as file:
-                    content = file.read()
-                    header = AbacusOutHeaderChunk(content)
-                    result= AbacusOutCalcChunk(content,header=header)
+        '''
+        Only the bytes appended to the log since the previous poll are read
+        :return: LogState of the calculation (truthy when converged), False if there is no log yet or
+                 USPEX_DONE holds a non-zero return code
+        '''
+        with self.instrumentation.phase(calcFolder, 'isConverged'):
+            return self._isConverged(calcFolder)
+
+    def _isConverged(self, calcFolder: str):
+        if calcFolder in self.cacheHits or calcFolder in self.discarded or EarlyAbortMonitor.isAborted(calcFolder):
+            return True
+        state = self.tailer.poll(pj(calcFolder, self.output_file))
+        returnCode = PackedRunner.readDone(calcFolder)
+        if returnCode:
+            # a crashed run may leave a log that reads as converged up to the crash
+            logger.info(f'{calcFolder}: ABACUS exited with return code {returnCode}')
+            return False
+        if self.fusedStages and returnCode is None:
+            # the log of a finished intermediate stage is not the end of the job
+            if state is not None and state.finished and calcFolder not in self.missingDone \
+                    and os.path.exists(state.filename) \
+                    and time.time() - os.path.getmtime(state.filename) > self.missingDoneDelay:
+                self.missingDone.add(calcFolder)
+                logger.warning(f'{calcFolder}: ABACUS finished more than {self.missingDoneDelay} s ago but there is '
+                               f'no {PackedRunner.doneFile}, is the calculation run through ABACUS_Runner.py?')
+            return False
+        if state is None:
+            logger.info('No log file.')
+            return False
+        if state.scfConverged is False and calcFolder in self.warmStarted:
+            # the stored density did not help this structure, it is rerun from atomic charge
+            logger.info(f'{calcFolder}: SCF diverged from {self.warmStarted.pop(calcFolder)}, next run starts cold')
+            self.coldStart.add(calcFolder)
+        if self.monitor is not None and calcFolder in self.running:
+            reason = self.monitor.reason(state, *self.running[calcFolder])
+            if reason is not None:
+                self.monitor.abort(calcFolder, reason)
+                return True
+        return state
+
+    def readStages(self, system: dict, calcFolder: str, aseResults: dict):
+        '''
+        :return: dict tag -> energy, enthalpy, volume and convergence of every stage that ran,
+                 the last entry being the stage whose output is in OUT.USPEX
+        '''
+        def summary(extracted):
+            energy = extracted['energy']
+            enthalpy = None
+            if energy is not None:
+                enthalpy = self.enthalpy(energy, extracted['volume'], system['externalPressure'])
+            return dict(energy=energy, enthalpy=enthalpy,
+                        volume=extracted['volume'], converged=extracted['converged'],
+                        relaxConverged=extracted['relaxConverged'], ionicSteps=extracted['ionicSteps'])
+
+        stages = dict()
+        tags = [str(self.tag)] + self.fusedTags
+        for tag in tags:
+            folder = pj(calcFolder, f'{self.output_file}.{tag}')
+            if not os.path.isdir(folder):
                 break
+            try:
+                stages[tag] = summary(self.adapter.extract(folder))
+            except Exception as e:
+                logger.warning(f'{folder}: cannot read stage {tag}: {e}')
+                stages[tag] = None
+        if len(stages) < len(tags):
+            stages[tags[len(stages)]] = summary(aseResults)
+        return stages
+
+    @staticmethod
+    def enthalpy(energy: float, volume: float, externalPressure: float):
+        '''
+        :param externalPressure: GPa, volume in A^3
+        :return: enthalpy in eV
+        '''
+        return energy + externalPressure * volume * ASEInterfaceAdapter.Results.EV_PER_CUBIC_ANGSTREM_PER_GPA
+
+    def discardedResults(self, system: dict, calcFolder: str):
+        '''
+        :return: results of a discarded structure, flagged and with an infinite energy so it never
+                 competes, the structure being the one submitted
+        '''
+        remedy = self.discarded.pop(calcFolder)
+        if calcFolder in self.failedSystems:
+            self.failedSystems.remove(calcFolder)
+        logger.info(f'{calcFolder}: no result, structure discarded after {remedy.failure} failures')
+        structure = system['structure']
+        results = dict(discarded=True)
+        if 'structure' in self.targetProperties:
+            results['structure'] = structure
+        if 'enthalpy' in self.targetProperties:
+            results['enthalpy'] = np.inf
+        if 'energy' in self.targetProperties:
+            results['energy'] = np.inf
+        if 'forces' in self.targetProperties:
+            results['forces'] = np.zeros((len(structure.getAtomTypes()), 3))
+        return results
+
+    def recordLayouts(self, calcFolder: str, state):
+        '''
+        Add the wall time of every stage that ran in calcFolder to the tuner history, under the
+        layout it ran with
+        :param state: LogState of the log in OUT.USPEX
+        '''
+        stages = self.layouts.pop(calcFolder)
+        for tag, nk, natoms, lcao, layout in stages:
+            kept = pj(calcFolder, f'{self.output_file}.{tag}')
+            if os.path.isdir(kept):
+                # a finished earlier stage of a fused job, timed by its own log
+                stageState = LogTailer().poll(kept)
+                seconds = stageState.wallTime if stageState is not None else None
             else:
-                logger.info('No log file.')
- 
-        return result
+                seconds = state.wallTime if state is not None and state.wallTime else None
+                if seconds is None and len(stages) == 1:
+                    seconds = PackedRunner.readDoneTime(calcFolder)
+            self.tuner.record(nk, natoms, lcao, layout, seconds)
+            if not os.path.isdir(kept):
+                # the stage in OUT.USPEX is the last one that ran
+                break
 
 ############   Read
     def readOutput(self, system: dict, calcFolder: str):
+        self.instrumentation.start(calcFolder)
+        if calcFolder in self.cacheHits:
+            system.pop('ase', None)
+            self.instrumentation.lap(calcFolder, 'readOutput')
+            self.instrumentation.finish(calcFolder, cached=True)
+            return dict(self.cacheHits.pop(calcFolder))
+        if calcFolder in self.discarded:
+            system.pop('ase', None)
+            self.instrumentation.lap(calcFolder, 'readOutput')
+            self.instrumentation.finish(calcFolder, discarded=True)
+            return self.discardedResults(system, calcFolder)
         filename=pj(calcFolder, self.output_file)
-        aseResults = self.adapter.read(filename, **system.pop('ase'))
+        # the log state built by isConverged is shared, so the log is parsed once more at most
+        state = self.tailer.poll(filename)
+        self.instrumentation.lap(calcFolder, 'logPoll')
+        aseResults = self.adapter.read(filename, state=state, **system.pop('ase'))
+        # the adapter read is timed on its own, the readOutput lap only covers what follows
+        self.instrumentation.start(calcFolder)
         results = {}
         logger.info(f"aseResults['results'].results.keys()")
+        aborted = EarlyAbortMonitor.isAborted(calcFolder)
+        if aborted:
+            # the last frame of a stopped relaxation, flagged so it is not mistaken for a minimum
+            results['aborted'] = True
         if 'structure' in self.targetProperties:
             results['structure'] = aseResults['structure']
         if 'enthalpy' in self.targetProperties:
-            volume = aseResults['volume']
-            results['enthalpy'] = aseResults['results'].results['energy'] + system['externalPressure'] * volume
+            results['enthalpy'] = self.enthalpy(aseResults['results'].results['energy'], aseResults['volume'],
+                                                system['externalPressure'])
         if 'energy' in self.targetProperties:
             results['energy'] = aseResults['results'].results['energy']
         if 'forces' in self.targetProperties:
             results['forces'] = aseResults['results'].results['forces']
+        if self.fusedStages:
+            results['stages'] = self.readStages(system, calcFolder, aseResults)
+
+        self.running.pop(calcFolder, None)
+        if self.monitor is not None and not aborted and aseResults['energy'] is not None:
+            enthalpy = self.enthalpy(aseResults['energy'], aseResults['volume'], system['externalPressure'])
+            self.monitor.record(enthalpy / len(aseResults['atoms']))
+
+        cacheKey = self.cacheKeys.pop(calcFolder, None)
+        # only results that a rerun would reproduce: converged, relaxed and not cut short
+        if cacheKey is not None and not aborted and aseResults['converged'] \
+                and aseResults['relaxConverged'] is not False and not PackedRunner.readDone(calcFolder):
+            self.resultCache.store(*cacheKey, results)
+        if self.screen is not None and not aborted and aseResults['energy'] is not None:
+            # trained on the structure as submitted, which is what the surrogate ranks
+            enthalpy = self.enthalpy(aseResults['energy'], aseResults['volume'], system['externalPressure'])
+            self.screen.add(system['structure'], enthalpy / len(aseResults['atoms']),
+                            fingerprint=cacheKey[0] if cacheKey is not None else None)
+        if self.densities is not None and aseResults['converged'] and not aborted:
+            structure = aseResults['structure']
+            self.densities.store(self.tag, composition(structure), structure.getCell().getCellVectors(), filename,
+                                 Fingerprint(structure))
+        if aseResults['converged'] and not aborted:
+            self.failedSystems.succeeded(calcFolder)
+        self.warmStarted.pop(calcFolder, None)
+        self.coldStart.discard(calcFolder)
+        if calcFolder in self.layouts and not aborted:
+            self.recordLayouts(calcFolder, state)
+        self.instrumentation.lap(calcFolder, 'readOutput')
+        self.instrumentation.countFiles(calcFolder)
+        self.instrumentation.finish(calcFolder, log=state.filename if state is not None else None,
+                                    aborted=aborted, ionicSteps=aseResults['ionicSteps'])
+        if self.archive is not None:
+            # last, every consumer above is done with the densities and the log
+            present = {el.short_name for el in aseResults['structure'].getAtomTypes()}
+            basis = self.basis or {}
+            staged = [self.pseudopotentials[el] for el in present] + [basis[el] for el in present if el in basis]
+            self.archive.store(self.tag, calcFolder, aseResults, enthalpy=results.get('enthalpy'), aborted=aborted,
+                               stages=results.get('stages'), staged=staged)
         
         return results 
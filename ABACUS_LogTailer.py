@@ -0,0 +1,178 @@
+"""
+USPEX.Stages.ABACUS_LogTailer
+
+Incremental reader of OUT.*/running_*.log used while polling running calculations
+
+===========================
+"""
+import logging
+import os
+import re
+import threading
+from os.path import join as pj
+
+logger = logging.getLogger(__name__)
+
+
+class LogState:
+    '''
+    Convergence and ionic-step state of one running_*.log, updated line by line
+    '''
+
+    wallTimePattern = re.compile(r'([\d.]+)\s*(h|mins?|secs?)\b')
+    wallTimeUnits = {'h': 3600, 'min': 60, 'mins': 60, 'sec': 1, 'secs': 1}
+
+    ionicStepPatterns = [re.compile(r'ION=\s*(\d+)'),
+                         re.compile(r'STEP OF (?:ION )?RELAXATION\s*:\s*(\d+)'),
+                         re.compile(r'RELAX IONS\s*:\s*\d+\s*\(in total:\s*(\d+)\)'),
+                         re.compile(r'STEP OF MOLECULAR DYNAMICS\s*:\s*(\d+)')]
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.inode = None
+        self.offset = 0
+        self.partial = b''
+        # first bytes of the log, the header with the start time tells a rewritten log from an appended one
+        self.head = b''
+
+        self.ionicSteps = 0
+        # one energy per ionic step, energyStep is the step of the last one
+        self.energies = []
+        self.energyStep = None
+        self.volume = None
+        self.scfConverged = None
+        # consecutive ionic steps whose SCF did not converge
+        self.scfFailures = 0
+        self.relaxConverged = None
+        self.finished = False
+        self.wallTime = None
+
+    @property
+    def converged(self):
+        '''
+        True when the SCF of the last ionic step has converged
+        '''
+        return self.scfConverged is True
+
+    def __bool__(self):
+        return self.converged
+
+    def feed(self, line: str):
+        if 'ION' in line or 'STEP OF' in line:
+            for pattern in self.ionicStepPatterns:
+                match = pattern.search(line)
+                if match:
+                    self.ionicSteps = max(self.ionicSteps, int(match.group(1)))
+                    self.scfConverged = None
+                    return
+        if 'charge density convergence is achieved' in line:
+            self.scfConverged = True
+            self.scfFailures = 0
+        elif 'convergence has not been achieved' in line.lower():
+            self.scfConverged = False
+            self.scfFailures += 1
+        elif '!FINAL_ETOT_IS' in line:
+            self.addEnergy(float(line.split()[1]))
+        elif 'final etot is' in line:
+            self.addEnergy(float(line.split()[-2]))
+        elif 'Volume (A^3)' in line:
+            self.volume = float(line.split('=')[1])
+        elif 'relaxation is not converged' in line.lower():
+            self.relaxConverged = False
+        elif 'elaxation is converged' in line:
+            self.relaxConverged = True
+        elif 'Total  Time' in line or 'TOTAL  Time' in line:
+            self.finished = True
+            # " Total  Time  : 0 h 1 mins 12 secs" or a plain number of seconds
+            text = line.split(':', 1)[-1]
+            parts = self.wallTimePattern.findall(text)
+            try:
+                self.wallTime = sum(float(value) * self.wallTimeUnits[unit] for value, unit in parts) if parts \
+                    else float(text.split()[0])
+            except (ValueError, IndexError):
+                pass
+
+    def addEnergy(self, energy: float):
+        '''
+        The last ionic step prints its energy twice ("final etot is" and "!FINAL_ETOT_IS"),
+        a second energy of the same step replaces the first
+        '''
+        if self.energies and self.energyStep == self.ionicSteps:
+            self.energies[-1] = energy
+        else:
+            self.energies.append(energy)
+        self.energyStep = self.ionicSteps
+
+
+class LogTailer:
+    '''
+    Remembers the byte offset and parsed state of the log in each calc folder, so
+    every poll only reads what was appended since the previous one
+    '''
+
+    blockSize = 1 << 23
+    headSize = 4096
+
+    def __init__(self):
+        self._states = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def findLog(outputFolder: str):
+        '''
+        :return: the most recent running_*.log in outputFolder, or None
+        '''
+        try:
+            logs = [pj(outputFolder, f) for f in os.listdir(outputFolder)
+                    if f.startswith('running') and f.endswith('log')]
+        except FileNotFoundError:
+            return None
+        if not logs:
+            return None
+        return max(logs, key=lambda f: os.stat(f).st_mtime_ns)
+
+    def reset(self, outputFolder: str):
+        '''
+        Forget the state of outputFolder, called when its calc folder is reused
+        '''
+        with self._lock:
+            self._states.pop(os.path.abspath(outputFolder), None)
+
+    def poll(self, outputFolder: str):
+        '''
+        :param outputFolder: OUT.* folder of a calculation
+        :return: up-to-date LogState, or None when no log exists yet
+        '''
+        key = os.path.abspath(outputFolder)
+        with self._lock:
+            state = self._states.get(key)
+        filename = state.filename if state is not None and os.path.exists(state.filename) else self.findLog(key)
+        if filename is None:
+            return None
+
+        try:
+            with open(filename, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if state is None or state.filename != filename or state.inode != stat.st_ino \
+                        or stat.st_size < state.offset or f.read(len(state.head)) != state.head:
+                    state = LogState(filename)
+                    state.inode = stat.st_ino
+                f.seek(state.offset)
+                while state.offset < stat.st_size:
+                    chunk = f.read(min(self.blockSize, stat.st_size - state.offset))
+                    if not chunk:
+                        break
+                    if len(state.head) < self.headSize:
+                        state.head += chunk[:self.headSize - len(state.head)]
+                    state.offset += len(chunk)
+                    chunk = state.partial + chunk
+                    end = chunk.rfind(b'\n') + 1
+                    state.partial = chunk[end:]
+                    for line in chunk[:end].decode(errors='replace').splitlines():
+                        state.feed(line)
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            self._states[key] = state
+        return state
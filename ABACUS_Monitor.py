@@ -0,0 +1,157 @@
+"""
+USPEX.Stages.ABACUS_Monitor
+
+Early abort of running relaxations that cannot become competitive
+
+===========================
+"""
+import logging
+import os
+import shlex
+import signal
+import subprocess
+from collections import deque
+from os.path import join as pj
+
+import numpy as np
+
+from .ASEInterfaceAdapter import ASEInterfaceAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class EarlyAbortMonitor:
+    '''
+    Judges running calculations from the LogState of their log.
+
+    The final energy of a relaxation is projected from the ionic-step energies assuming the
+    steps shrink geometrically. A job is aborted when its projected enthalpy per atom exceeds
+    the chosen quantile of the recently finished structures by more than margin, when the SCF
+    has failed for several ionic steps in a row, or when the energy oscillates without progress.
+    '''
+
+    abortedFile = 'USPEX_ABORTED'
+
+    def __init__(self, margin: float = 0.3, quantile: float = 0.5, minSteps: int = 3, minPopulation: int = 10,
+                 maxScfFailures: int = 3, oscillationWindow: int = 6, window: int = 500, killCommand: str = None):
+        '''
+        Parameter definition:
+            margin : Allowed excess of the projected enthalpy per atom over the reference, eV
+            quantile : Quantile of the finished enthalpies per atom used as the reference
+            minSteps : Ionic steps before a job is judged by its energy
+            minPopulation : Finished structures needed before jobs are judged by their energy
+            maxScfFailures : Consecutive ionic steps without SCF convergence before a job is aborted
+            oscillationWindow : Ionic steps inspected for energy oscillation
+            window : Number of most recent finished structures forming the distribution
+            killCommand : Command template run to stop a job, {calcFolder} is replaced by the folder.
+                          By default processes whose working directory is the calc folder get SIGTERM.
+        '''
+        self.margin = margin
+        self.quantile = quantile
+        self.minSteps = minSteps
+        self.minPopulation = minPopulation
+        self.maxScfFailures = maxScfFailures
+        self.oscillationWindow = oscillationWindow
+        self.killCommand = killCommand
+        self.enthalpies = deque(maxlen=window)
+        self.aborted = 0
+
+    def record(self, enthalpyPerAtom: float):
+        '''
+        Add the enthalpy per atom of a finished structure to the distribution
+        '''
+        if enthalpyPerAtom is not None and np.isfinite(enthalpyPerAtom):
+            self.enthalpies.append(float(enthalpyPerAtom))
+
+    @staticmethod
+    def projectEnergy(energies: list):
+        '''
+        :return: final energy expected when the remaining ionic steps shrink like the last ones
+        '''
+        if len(energies) < 3:
+            return energies[-1]
+        steps = np.diff(energies[-4:])
+        ratios = [b / a for a, b in zip(steps[:-1], steps[1:]) if a < 0 and b < 0]
+        if not ratios:
+            return energies[-1]
+        ratio = min(np.mean(ratios), 0.9)
+        return energies[-1] + steps[-1] * ratio / (1 - ratio)
+
+    def oscillates(self, energies: list):
+        '''
+        True when the energy changed direction in most of the last steps without net descent
+        '''
+        if len(energies) < self.oscillationWindow:
+            return False
+        recent = np.asarray(energies[-self.oscillationWindow:])
+        steps = np.diff(recent)
+        turns = np.count_nonzero(np.sign(steps[1:]) * np.sign(steps[:-1]) < 0)
+        return turns >= len(steps) - 1 and recent[-1] >= recent.min() + np.abs(steps).mean() / 2
+
+    def reason(self, state, natoms: int, externalPressure: float = 0.0):
+        '''
+        :param state: LogState of a running calculation
+        :param externalPressure: GPa
+        :return: why the calculation should be aborted, None when it should go on
+        '''
+        if state is None or state.finished:
+            return None
+        if state.scfFailures >= self.maxScfFailures:
+            return f'SCF not converged in {state.scfFailures} consecutive ionic steps'
+        energies = state.energies
+        if self.oscillates(energies):
+            return f'energy oscillates over the last {self.oscillationWindow} ionic steps'
+        if len(energies) < self.minSteps or len(self.enthalpies) < self.minPopulation or state.volume is None:
+            return None
+        pv = externalPressure * state.volume * ASEInterfaceAdapter.Results.EV_PER_CUBIC_ANGSTREM_PER_GPA
+        projected = (self.projectEnergy(energies) + pv) / natoms
+        reference = np.quantile(self.enthalpies, self.quantile)
+        if projected > reference + self.margin:
+            return f'projected enthalpy {projected:.4f} eV/atom exceeds {reference:.4f} + {self.margin} eV/atom'
+        return None
+
+    def abort(self, calcFolder: str, reason: str):
+        '''
+        Mark calcFolder as aborted and stop its ABACUS processes
+        '''
+        with open(pj(calcFolder, self.abortedFile), 'w') as f:
+            f.write(f'{reason}\n')
+        self.aborted += 1
+        logger.info(f'{calcFolder}: aborted, {reason}')
+        if self.killCommand is not None:
+            command = shlex.split(self.killCommand.format(calcFolder=shlex.quote(os.path.abspath(calcFolder))))
+            try:
+                subprocess.run(command, check=False, timeout=60)
+            except (OSError, subprocess.SubprocessError) as e:
+                logger.warning(f'{calcFolder}: {" ".join(command)} failed: {e}')
+            return
+        for pid in self.processesIn(calcFolder):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                logger.debug(f'Cannot stop process {pid}: {e}')
+
+    @staticmethod
+    def processesIn(calcFolder: str):
+        '''
+        :return: pids of the local processes whose working directory is calcFolder
+        '''
+        calcFolder = os.path.realpath(calcFolder)
+        pids = []
+        try:
+            entries = os.listdir('/proc')
+        except OSError:
+            return pids
+        for entry in entries:
+            if not entry.isdigit() or int(entry) == os.getpid():
+                continue
+            try:
+                if os.readlink(pj('/proc', entry, 'cwd')) == calcFolder:
+                    pids.append(int(entry))
+            except OSError:
+                continue
+        return pids
+
+    @classmethod
+    def isAborted(cls, calcFolder: str):
+        return os.path.exists(pj(calcFolder, cls.abortedFile))
@@ -0,0 +1,194 @@
+"""
+USPEX.Stages.ABACUS_Prescreen
+
+Cheap surrogate ranking of candidate structures before they are sent to ABACUS
+
+===========================
+"""
+import importlib
+import logging
+import math
+import pickle
+import random
+import threading
+
+import numpy as np
+
+from .ABACUS_ResultCache import Fingerprint
+from .ASEInterfaceAdapter import ASEInterfaceAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class RidgeModel:
+    '''
+    Ridge regression of the enthalpy per atom on fingerprint features.
+
+    Only the normal equations (XᵀX, Xᵀy) are accumulated, so adding a structure costs the same
+    however large the training set grows. Features are named, new species pairs extend the
+    matrices with zeros.
+    '''
+
+    # pair-distance bins merged into one feature
+    coarsening = 5
+
+    def __init__(self, regularization: float = 1e-3):
+        self.regularization = regularization
+        self.features = dict()
+        self.xtx = np.zeros((0, 0))
+        self.xty = np.zeros(0)
+        self.samples = 0
+        self._weights = None
+
+    def featurize(self, fingerprint: Fingerprint):
+        '''
+        :return: dict feature name -> value
+        '''
+        features = {'bias': 1.0, 'volume': fingerprint.volume}
+        for element, count in fingerprint.counts.items():
+            features[f'x_{element}'] = count / fingerprint.natoms
+        histograms = np.split(fingerprint.vector, len(fingerprint.pairs)) if fingerprint.pairs else []
+        for (a, b), histogram in zip(fingerprint.pairs, histograms):
+            usable = len(histogram) - len(histogram) % self.coarsening
+            coarse = histogram[:usable].reshape(-1, self.coarsening).sum(axis=1)
+            for i, value in enumerate(coarse):
+                features[f'{a}-{b}_{i}'] = value
+        return features
+
+    def vector(self, features: dict, grow: bool = False):
+        if grow:
+            new = [name for name in features if name not in self.features]
+            if new:
+                for name in new:
+                    self.features[name] = len(self.features)
+                size = len(self.features)
+                xtx, xty = np.zeros((size, size)), np.zeros(size)
+                xtx[:len(self.xty), :len(self.xty)], xty[:len(self.xty)] = self.xtx, self.xty
+                self.xtx, self.xty = xtx, xty
+        x = np.zeros(len(self.features))
+        for name, value in features.items():
+            index = self.features.get(name)
+            if index is not None:
+                x[index] = value
+        return x
+
+    def add(self, fingerprint: Fingerprint, target: float):
+        x = self.vector(self.featurize(fingerprint), grow=True)
+        self.xtx += np.outer(x, x)
+        self.xty += x * target
+        self.samples += 1
+        self._weights = None
+
+    def predict(self, fingerprint: Fingerprint):
+        if self._weights is None:
+            size = len(self.xty)
+            scale = np.trace(self.xtx) / size if size else 1.0
+            self._weights = np.linalg.solve(self.xtx + self.regularization * scale * np.eye(size), self.xty)
+        return float(self.vector(self.featurize(fingerprint)) @ self._weights)
+
+
+class SurrogatePrescreen:
+    '''
+    Ranks candidates by a surrogate enthalpy per atom and keeps the best fraction of them plus
+    a random exploration quota of the rest.
+
+    The surrogate is either a user ASE calculator, optionally relaxing every candidate for a few
+    steps first, or a RidgeModel trained on the structures ABACUS has already finished. Until
+    either is available every candidate is kept.
+    '''
+
+    def __init__(self, calculator=None, fraction: float = 0.5, exploration: float = 0.1, relaxSteps: int = 0,
+                 fmax: float = 0.1, minTraining: int = 20, modelFile: str = None, seed: int = None):
+        '''
+        Parameter definition:
+            calculator : ASE calculator, or "package.module.Class" of one built without arguments
+            fraction : Share of the candidates with the lowest surrogate enthalpy that is kept
+            exploration : Share of the candidates kept at random from the remaining ones
+            relaxSteps : BFGS steps with the calculator before a candidate is ranked (0: single point)
+            fmax : Force threshold of the pre-relaxation, eV/A
+            minTraining : Finished structures needed before the trained model ranks candidates
+            modelFile : Pickle of the trained model, reloaded and extended across runs
+            seed : Seed of the exploration picks
+        '''
+        if isinstance(calculator, str):
+            module, _, name = calculator.rpartition('.')
+            calculator = getattr(importlib.import_module(module), name)()
+        self.calculator = calculator
+        self.fraction = fraction
+        self.exploration = exploration
+        self.relaxSteps = relaxSteps
+        self.fmax = fmax
+        self.minTraining = minTraining
+        self.modelFile = modelFile
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.model = RidgeModel()
+        if modelFile is not None:
+            try:
+                with open(modelFile, 'rb') as f:
+                    self.model = pickle.load(f)
+                logger.info(f'Surrogate model with {self.model.samples} structures loaded from {modelFile}')
+            except FileNotFoundError:
+                pass
+
+    def add(self, structure, enthalpyPerAtom: float, fingerprint: Fingerprint = None):
+        '''
+        Train the model with a structure as it was submitted and the enthalpy per atom ABACUS found for it
+        '''
+        if enthalpyPerAtom is None or not np.isfinite(enthalpyPerAtom):
+            return
+        fingerprint = fingerprint if fingerprint is not None else Fingerprint(structure)
+        with self._lock:
+            self.model.add(fingerprint, enthalpyPerAtom)
+            if self.modelFile is not None:
+                with open(self.modelFile, 'wb') as f:
+                    pickle.dump(self.model, f)
+
+    def evaluate(self, system: dict):
+        '''
+        :return: surrogate enthalpy per atom of system, with system['structure'] replaced by the
+                 pre-relaxed structure when relaxSteps is set; None without a usable surrogate
+        '''
+        structure = system['structure']
+        if self.calculator is not None:
+            from ase.optimize import BFGS
+            atoms, order = ASEInterfaceAdapter.toAtoms(structure)
+            atoms.pbc = structure.getCell().getPBC()
+            atoms.calc = self.calculator
+            if self.relaxSteps:
+                BFGS(atoms, logfile=None).run(fmax=self.fmax, steps=self.relaxSteps)
+                system['structure'] = ASEInterfaceAdapter.fromAtoms(atoms, structure.getCell().getPBC(), order)
+            pv = system['externalPressure'] * atoms.get_volume()
+            pv *= ASEInterfaceAdapter.Results.EV_PER_CUBIC_ANGSTREM_PER_GPA
+            return (atoms.get_potential_energy() + pv) / len(atoms)
+        if self.model.samples < self.minTraining:
+            return None
+        with self._lock:
+            return self.model.predict(Fingerprint(structure))
+
+    def screen(self, systems: list):
+        '''
+        :return: the systems to submit, best ranked first, followed by the exploration picks
+        '''
+        if not systems:
+            return []
+        scores = []
+        for system in systems:
+            try:
+                scores.append(self.evaluate(system))
+            except Exception as e:
+                logger.warning(f'Surrogate evaluation failed, candidate kept: {e!r}')
+                scores.append(None)
+        if all(score is None for score in scores):
+            return list(systems)
+
+        # candidates without a score are never screened out
+        unscored = [system for system, score in zip(systems, scores) if score is None]
+        ranked = sorted((score, i) for i, score in enumerate(scores) if score is not None)
+        keep = math.ceil(self.fraction * len(systems))
+        selected = [systems[i] for _, i in ranked[:keep]]
+        rest = [systems[i] for _, i in ranked[keep:]]
+        explore = self.random.sample(rest, min(len(rest), math.ceil(self.exploration * len(systems))))
+        logger.info(f'Prescreen: {len(selected)} best and {len(explore)} random of {len(systems)} candidates '
+                    f'go to ABACUS')
+        return unscored + selected + explore
@@ -0,0 +1,186 @@
+"""
+USPEX.Stages.ABACUS_ResultCache
+
+Persistent store of finished ABACUS results keyed by a structure fingerprint
+
+===========================
+"""
+import hashlib
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class Fingerprint:
+    '''
+    Species-resolved pair-distance histogram of a periodic structure. It does not depend on
+    atom order, origin or the choice of cell vectors, so symmetry-equivalent copies of one
+    structure share (almost) the same vector.
+    '''
+
+    cutoff = 6.0
+    binWidth = 0.1
+    smoothing = np.array([0.25, 0.5, 0.25])
+
+    def __init__(self, structure):
+        cell = np.asarray(structure.getCell().getCellVectors(), dtype=float)
+        symbols = np.array([el.short_name for el in structure.getAtomTypes()])
+        positions = np.asarray(structure.getCartesianCoordinates(), dtype=float)
+        species = sorted(set(symbols))
+
+        self.counts = {s: int(np.count_nonzero(symbols == s)) for s in species}
+        self.composition = ' '.join(f'{s}{n}' for s, n in self.counts.items())
+        self.natoms = len(symbols)
+        volume = abs(np.linalg.det(cell))
+        self.volume = volume / self.natoms
+
+        # fractional separations are wrapped into [-0.5, 0.5), so the periodic images within
+        # cutoff/height + 1/2 cells cover the cutoff along every lattice plane normal
+        heights = volume / np.linalg.norm(np.cross(cell[[1, 2, 0]], cell[[2, 0, 1]]), axis=1)
+        reach = np.ceil(self.cutoff / heights + 0.5).astype(int)
+        images = np.stack(np.meshgrid(*[np.arange(-n, n + 1) for n in reach], indexing='ij'), axis=-1).reshape(-1, 3)
+        fractional = positions @ np.linalg.inv(cell)
+
+        # bin edges sit half-way between round distances, so lattice translations of round length
+        # do not flip between bins on floating-point noise
+        bins = np.arange(self.binWidth / 2, self.cutoff + self.binWidth, self.binWidth)
+        histograms = []
+        # species pair of each histogram in vector
+        self.pairs = []
+        for i, a in enumerate(species):
+            fa = fractional[symbols == a]
+            for b in species[i:]:
+                separations = fractional[symbols == b][None, :, :] - fa[:, None, :]
+                separations = (separations - np.round(separations)).reshape(-1, 3)
+                histogram = np.zeros(len(bins) - 1)
+                for image in images:
+                    d = np.linalg.norm((separations + image) @ cell, axis=-1)
+                    histogram += np.histogram(d[(d > 1e-8) & (d < self.cutoff)], bins=bins)[0]
+                histograms.append(np.convolve(histogram / len(fa), self.smoothing, mode='same'))
+                self.pairs.append((a, b))
+        self.vector = np.concatenate(histograms)
+
+    def distance(self, vector: np.ndarray):
+        '''
+        :return: cosine distance between this fingerprint and vector
+        '''
+        norm = np.linalg.norm(self.vector) * np.linalg.norm(vector)
+        if norm == 0:
+            return 0.0 if not self.vector.any() and not vector.any() else 1.0
+        return float(1 - np.dot(self.vector, vector) / norm)
+
+
+def settingsKey(*parts):
+    '''
+    Hash of everything besides the structure that determines a result (INPUT, KPT, pressure)
+    '''
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(part if isinstance(part, bytes) else repr(part).encode())
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+class ResultCache:
+    '''
+    SQLite store of results. A lookup matches structures with the same settings key and
+    composition whose volume per atom and fingerprint agree within the tolerances.
+    '''
+
+    schema = '''CREATE TABLE IF NOT EXISTS results (
+                    id INTEGER PRIMARY KEY,
+                    settings TEXT NOT NULL,
+                    composition TEXT NOT NULL,
+                    volume REAL NOT NULL,
+                    fingerprint BLOB NOT NULL,
+                    results BLOB NOT NULL,
+                    created REAL NOT NULL,
+                    lastUsed REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0);
+                CREATE INDEX IF NOT EXISTS results_key ON results (settings, composition);'''
+
+    def __init__(self, filename: str, tolerance: float = 0.01, volumeTolerance: float = 0.02,
+                 maxAge: float = None, maxEntries: int = None):
+        '''
+        Parameter definition:
+            filename : SQLite database
+            tolerance : Largest cosine distance between fingerprints counted as the same structure
+            volumeTolerance : Largest relative difference of volume per atom
+            maxAge : Entries unused for longer than maxAge seconds are evicted
+            maxEntries : Only the maxEntries most recently used entries are kept
+        '''
+        self.filename = filename
+        self.tolerance = tolerance
+        self.volumeTolerance = volumeTolerance
+        self.maxAge = maxAge
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self._db.executescript(self.schema)
+        self.evict()
+
+    def lookup(self, fingerprint: Fingerprint, settings: str):
+        '''
+        :return: cached results of the closest matching structure, or None
+        '''
+        with self._lock:
+            rows = self._db.execute('SELECT id, volume, fingerprint, results FROM results '
+                                    'WHERE settings = ? AND composition = ? AND volume BETWEEN ? AND ?',
+                                    (settings, fingerprint.composition,
+                                     fingerprint.volume * (1 - self.volumeTolerance),
+                                     fingerprint.volume * (1 + self.volumeTolerance))).fetchall()
+            best, bestDistance = None, self.tolerance
+            for id, volume, vector, results in rows:
+                vector = np.frombuffer(vector)
+                if len(vector) != len(fingerprint.vector):
+                    continue
+                distance = fingerprint.distance(vector)
+                if distance <= bestDistance:
+                    best, bestDistance = (id, results), distance
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self._db:
+                self._db.execute('UPDATE results SET lastUsed = ?, hits = hits + 1 WHERE id = ?', (time.time(), best[0]))
+        logger.info(f'Result cache hit for {fingerprint.composition} (distance {bestDistance:.4f})')
+        return pickle.loads(best[1])
+
+    def store(self, fingerprint: Fingerprint, settings: str, results: dict):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute('INSERT INTO results (settings, composition, volume, fingerprint, results, created, lastUsed) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (settings, fingerprint.composition, fingerprint.volume,
+                              fingerprint.vector.astype(float).tobytes(), pickle.dumps(results), now, now))
+            self.stores += 1
+        if self.maxEntries is not None and self.stores % 100 == 0:
+            self.evict()
+
+    def evict(self):
+        with self._lock, self._db:
+            if self.maxAge is not None:
+                self._db.execute('DELETE FROM results WHERE lastUsed < ?', (time.time() - self.maxAge,))
+            if self.maxEntries is not None:
+                self._db.execute('DELETE FROM results WHERE id NOT IN '
+                                 '(SELECT id FROM results ORDER BY lastUsed DESC LIMIT ?)', (self.maxEntries,))
+
+    def statistics(self):
+        with self._lock:
+            entries = self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        lookups = self.hits + self.misses
+        return dict(entries=entries, hits=self.hits, misses=self.misses, stores=self.stores,
+                    hitRate=self.hits / lookups if lookups else 0.0)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
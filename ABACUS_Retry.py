@@ -0,0 +1,332 @@
+"""
+USPEX.Stages.ABACUS_Retry
+
+Diagnosis of failed ABACUS calculations and the remedies applied when they are rerun
+
+===========================
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+from collections import defaultdict
+from os.path import join as pj
+
+import numpy as np
+
+from .ABACUS_LogTailer import LogTailer
+from .ABACUS_Runner import PackedRunner
+
+logger = logging.getLogger(__name__)
+
+
+class DiscardedStructure(Exception):
+    '''
+    Raised when preparing a calc folder whose structure is not worth another run
+    '''
+
+
+def structureKey(structure):
+    '''
+    :return: digest of the atom types, cell and positions, telling a rerun from a new structure
+    '''
+    sha = hashlib.sha1()
+    sha.update(' '.join(el.short_name for el in structure.getAtomTypes()).encode())
+    sha.update(np.round(np.asarray(structure.getCell().getCellVectors(), dtype=float), 6).tobytes())
+    sha.update(np.round(np.asarray(structure.getCartesianCoordinates(), dtype=float), 6).tobytes())
+    return sha.hexdigest()
+
+
+def diagnose(calcFolder: str, outputFolder: str = 'OUT.USPEX', tail: int = 1 << 16):
+    '''
+    Failure class of a calculation from its log, warning.log, stdout/stderr and return code:
+        overlap : atoms too close to each other
+        cell : lattice vectors ABACUS rejects or a collapsed/exploded cell
+        symmetry : symmetry analysis failed
+        walltime : killed by the scheduler or a timeout, or the log ends mid-run
+        scf : the SCF did not converge
+        unknown : none of the above
+    '''
+    texts = []
+    for filename in (pj(calcFolder, outputFolder, 'warning.log'), pj(calcFolder, PackedRunner.outputFile),
+                     pj(calcFolder, PackedRunner.errorFile)):
+        try:
+            with open(filename, 'rb') as f:
+                f.seek(max(0, os.fstat(f.fileno()).st_size - tail))
+                texts.append(f.read().decode(errors='replace'))
+        except OSError:
+            continue
+    state = LogTailer().poll(pj(calcFolder, outputFolder))
+    if state is not None:
+        try:
+            with open(state.filename, 'rb') as f:
+                f.seek(max(0, os.fstat(f.fileno()).st_size - tail))
+                texts.append(f.read().decode(errors='replace'))
+        except OSError:
+            pass
+    text = '\n'.join(texts)
+
+    for failure, pattern in RetryRegistry.patterns:
+        if pattern.search(text):
+            return failure
+    returnCode = PackedRunner.readDone(calcFolder)
+    if returnCode is not None and returnCode in RetryRegistry.killedCodes:
+        return 'walltime'
+    if state is not None and (state.scfConverged is False or state.scfFailures > 0):
+        return 'scf'
+    if state is not None and not state.finished and state.ionicSteps > 0:
+        return 'walltime'
+    return 'unknown'
+
+
+class Remedy:
+    '''
+    Changes applied to the rerun of a failed calc folder
+    '''
+
+    def __init__(self, name: str, failure: str, overrides: dict = None, restart: str = None, discard: bool = False):
+        self.name = name
+        self.failure = failure
+        self.overrides = dict(overrides or {})
+        self.restart = restart
+        self.discard = discard
+
+    def inputLines(self):
+        '''
+        :return: INPUT lines overriding the earlier keywords, ABACUS keeps the last occurrence
+        '''
+        return ''.join(f'{keyword} {value}\n' for keyword, value in self.overrides.items())
+
+    def __repr__(self):
+        return f'{self.name} for {self.failure}'
+
+
+class RetryState:
+    '''
+    Failures and remedies of one calc folder
+    '''
+
+    def __init__(self, key: str = None):
+        self.key = key
+        self.failures = []
+        self.remedies = []
+        self.overrides = dict()
+        self.restart = None
+        # remedy applied to the running attempt, judged when it finishes or fails again
+        self.pending = None
+
+    @property
+    def attempts(self):
+        return len(self.failures)
+
+
+class RetryRegistry:
+    '''
+    Replaces the list of failed calc folders: append() and "in" behave as before, in constant
+    time, and every append diagnoses the failure.
+
+    remedy() picks what the rerun of a failed folder changes: for SCF failures a smaller
+    mixing_beta with more scf_nmax, then smearing, then another relax_method; symmetry -1 for
+    symmetry errors; another relax_method for a broken cell; a restart from the last ionic
+    frame after the wall time ran out; too-close atoms and folders out of attempts are
+    discarded. Remedies build on the ones already applied to the folder. Which remedy ended in
+    a converged result is counted per failure class, remedies with a better record are tried
+    first, and the counts can be kept in a JSON file across runs.
+    '''
+
+    patterns = [('overlap', re.compile(r'too\s+close|overlap(ping)?\s+atoms|distance\s+between\s+atoms', re.I)),
+                ('cell', re.compile(r'right[\s-]*hand|volume\s+(of\s+(the\s+)?cell\s+)?is\s+negative|'
+                                    r'negative\s+volume|lattice\s+vectors?\s+(are\s+)?(wrong|invalid|singular)', re.I)),
+                ('symmetry', re.compile(r'symmetry[^\n]*(error|fail|not\s+(match|found|right)|wrong)|'
+                                        r'(error|fail)[^\n]*symmetry', re.I)),
+                ('walltime', re.compile(r'time\s+limit|walltime|wall\s+time\s+(exceeded|limit)', re.I))]
+    # return codes of processes killed by SIGKILL/SIGTERM, or by the runner's timeout
+    killedCodes = (-9, -15, 137, 143)
+
+    ladders = {'scf': ('mixing', 'smearing', 'relaxMethod'),
+               'symmetry': ('symmetryOff',),
+               'cell': ('relaxMethod',),
+               'overlap': (),
+               'walltime': ('restart', 'restart'),
+               'unknown': ('symmetryOff',)}
+    relaxMethods = {'cg': 'bfgs', 'bfgs': 'cg', 'cg_bfgs': 'cg', 'sd': 'cg', 'fire': 'cg'}
+
+    def __init__(self, history: str = None, maxAttempts: int = None, outputFolder: str = 'OUT.USPEX'):
+        '''
+        Parameter definition:
+            history : JSON file of remedy successes per failure class, shared between runs
+            maxAttempts : Reruns of one structure, it is discarded when the last one fails too
+                          (default: length of the longest remedy ladder, so every remedy gets a run)
+            outputFolder : OUT.* folder of the calculations
+        '''
+        self.history = history
+        self.maxAttempts = maxAttempts if maxAttempts is not None else max(map(len, self.ladders.values()))
+        self.outputFolder = outputFolder
+        self._states = dict()
+        # calcFolder -> structureKey of the structure last prepared in it
+        self._keys = dict()
+        self._lock = threading.Lock()
+        # failure class -> remedy -> [successes, tries]
+        self.outcomes = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+        if history is not None and os.path.exists(history):
+            try:
+                with open(history) as f:
+                    for failure, remedies in json.load(f).items():
+                        for name, (successes, tries) in remedies.items():
+                            self.outcomes[failure][name] = [successes, tries]
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning(f'Cannot read retry history {history}: {e}')
+
+    ############################## list compatibility ##############################
+    def append(self, calcFolder: str):
+        '''
+        Register a failure of calcFolder, diagnosed from what the calculation left behind
+        '''
+        failure = diagnose(calcFolder, self.outputFolder)
+        with self._lock:
+            key = self._keys.get(calcFolder)
+            state = self._states.get(calcFolder)
+            if state is None or (key is not None and state.key not in (None, key)):
+                state = self._states[calcFolder] = RetryState(key)
+            state.key = state.key or key
+            state.failures.append(failure)
+            pending, state.pending = state.pending, None
+        if pending is not None:
+            self.record(pending, False)
+        # the last ionic frame survives the cleanup of the output folder
+        lastFrame = pj(calcFolder, self.outputFolder, 'STRU_ION_D')
+        if os.path.exists(lastFrame):
+            state.restart = pj(calcFolder, 'STRU_RESTART')
+            shutil.copy2(lastFrame, state.restart)
+        logger.info(f'{calcFolder}: failure {state.attempts} diagnosed as {failure}')
+
+    def __contains__(self, calcFolder):
+        return calcFolder in self._states
+
+    def __len__(self):
+        return len(self._states)
+
+    def __iter__(self):
+        return iter(list(self._states))
+
+    def remove(self, calcFolder: str):
+        with self._lock:
+            del self._states[calcFolder]
+
+    def state(self, calcFolder: str):
+        return self._states.get(calcFolder)
+
+    ############################## Remedies ##############################
+    def ranked(self, failure: str, ladder):
+        '''
+        Remedies of ladder, those that succeeded more often for failure first
+        '''
+        outcomes = self.outcomes.get(failure, {})
+
+        def rate(name):
+            successes, tries = outcomes.get(name, (0, 0))
+            return (successes + 1) / (tries + 2)
+        return sorted(ladder, key=lambda name: -rate(name))
+
+    def remedy(self, calcFolder: str, key: str = None, parameters=None, calculation: str = 'scf'):
+        '''
+        Remedy for the next run of calcFolder
+        :param key: structureKey of the structure about to be prepared, kept so that a failure of
+                    this run is tied to it; a different one than at the failure means the folder
+                    got a new structure and its history is dropped
+        :param parameters: InputParameters of the stage, the remedies start from its values
+        :return: Remedy, None when calcFolder has not failed
+        '''
+        with self._lock:
+            if key is not None:
+                self._keys[calcFolder] = key
+            state = self._states.get(calcFolder)
+            if state is None:
+                return None
+            if key is not None and state.key is not None and state.key != key:
+                del self._states[calcFolder]
+                return None
+            failure = state.failures[-1]
+            ladder = [name for name in self.ladders.get(failure, ())
+                      if name != 'relaxMethod' or calculation in ('relax', 'cell-relax')]
+            # a remedy that already failed for this folder is not tried again, restarts may repeat
+            for name in state.remedies:
+                if name in ladder and name != 'restart':
+                    ladder.remove(name)
+            if failure == 'walltime':
+                ladder = ladder[state.failures.count('walltime') - 1:]
+            if state.attempts > self.maxAttempts or not ladder:
+                remedy = Remedy('discard', failure, discard=True)
+                logger.info(f'{calcFolder}: discarded after {state.attempts} failures ({", ".join(state.failures)})')
+                return remedy
+            name = self.ranked(failure, ladder)[0]
+            overrides = self.overrides(name, {**self.defaults(parameters), **state.overrides})
+            state.overrides.update(overrides)
+            state.remedies.append(name)
+            remedy = Remedy(name, failure, state.overrides, restart=state.restart if name == 'restart' else None)
+            state.pending = remedy
+        logger.info(f'{calcFolder}: rerun with {remedy}')
+        return remedy
+
+    @staticmethod
+    def defaults(parameters):
+        values = dict(mixing_beta='0.7', scf_nmax='100', smearing_sigma='0.015', relax_method='cg')
+        if parameters is not None:
+            for keyword in values:
+                if keyword in parameters:
+                    values[keyword] = parameters.get(keyword)
+        return values
+
+    def overrides(self, name: str, current: dict):
+        '''
+        :param current: INPUT values in effect, after the remedies applied so far
+        :return: INPUT keywords set by remedy name
+        '''
+        if name == 'mixing':
+            return dict(mixing_beta=f'{max(0.05, float(current["mixing_beta"]) / 2):g}',
+                        scf_nmax=str(min(1000, max(200, 2 * int(float(current['scf_nmax']))))))
+        if name == 'smearing':
+            return dict(smearing_method='gaussian',
+                        smearing_sigma=f'{max(0.02, 2 * float(current["smearing_sigma"])):g}')
+        if name == 'relaxMethod':
+            return dict(relax_method=self.relaxMethods.get(str(current['relax_method']).lower(), 'cg'))
+        if name == 'symmetryOff':
+            return dict(symmetry='-1')
+        return dict()
+
+    ############################## Outcomes ##############################
+    def succeeded(self, calcFolder: str):
+        '''
+        The rerun of calcFolder converged: the remedy is credited and the folder forgotten
+        '''
+        with self._lock:
+            state = self._states.pop(calcFolder, None)
+        if state is None:
+            return
+        if state.pending is not None:
+            self.record(state.pending, True)
+            logger.info(f'{calcFolder}: {state.pending} succeeded after {state.attempts} failures')
+        if state.restart is not None and os.path.exists(state.restart):
+            os.remove(state.restart)
+
+    def record(self, remedy: Remedy, success: bool):
+        with self._lock:
+            outcome = self.outcomes[remedy.failure][remedy.name]
+            outcome[0] += int(success)
+            outcome[1] += 1
+            if self.history is not None:
+                tmp = f'{self.history}.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump({failure: dict(remedies) for failure, remedies in self.outcomes.items()}, f, indent=1)
+                os.replace(tmp, self.history)
+
+    def statistics(self):
+        '''
+        :return: dict failure class -> remedy -> (successes, tries)
+        '''
+        with self._lock:
+            return {failure: {name: tuple(outcome) for name, outcome in remedies.items()}
+                    for failure, remedies in self.outcomes.items()}
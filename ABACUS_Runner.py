@@ -0,0 +1,300 @@
+"""
+USPEX.Stages.ABACUS_Runner
+
+Packed execution of many prepared ABACUS calc folders inside one allocation
+
+===========================
+"""
+import argparse
+import glob
+import logging
+import os
+import queue
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from os.path import join as pj
+
+try:
+    from .ABACUS_LogTailer import LogTailer
+except ImportError:
+    # started as a script by a packed job
+    from ABACUS_LogTailer import LogTailer
+
+logger = logging.getLogger(__name__)
+
+
+class PackedRunner:
+    '''
+    Pulls calc folders from a queue and runs ABACUS in each of them, several at a time.
+
+    The cores of the allocation are split evenly between the workers, each calculation gets
+    cores/workers cores as MPI processes times OpenMP threads. When a calculation ends its
+    folder receives a USPEX_DONE marker holding the return code and the wall time.
+
+    A folder with a STAGES file runs the listed stages one after the other: the first from
+    INPUT/KPT, every later one from INPUT_<tag>/KPT_<tag>, restarting from the relaxed
+    structure (and the charge density when the cell and cutoff are unchanged) of the stage
+    before, whose output is kept as OUT.USPEX.<tag>. A failing stage ends the folder.
+    '''
+
+    doneFile = 'USPEX_DONE'
+    # per-folder layout written by the parallel tuner, overrides the even split
+    parallelFile = 'PARALLEL'
+    stagesFile = 'STAGES'
+    outputFolder = 'OUT.USPEX'
+    densityPatterns = ('SPIN*_CHG.cube', 'chg*.cube')
+    cachedFile = 'USPEX_CACHED'
+    discardedFile = 'USPEX_DISCARDED'
+    outputFile, errorFile = 'output', 'error'
+
+    def __init__(self, abacusCommand: str = None, cores: int = None, workers: int = 1, ompThreads: int = 1,
+                 mpiCommand: str = 'mpirun -np {np}', timeout: float = None):
+        '''
+        Parameter definition:
+            abacusCommand : ABACUS executable with arguments (default: $USPEX_ABACUS_COMMAND or abacus)
+            cores : Cores of the allocation (default: all cores of this node)
+            workers : Calculations running at the same time
+            ompThreads : OpenMP threads per MPI process
+            mpiCommand : MPI launcher, {np} is replaced by the number of processes; empty runs ABACUS directly
+            timeout : Seconds after which a calculation is killed
+        '''
+        self.abacusCommand = abacusCommand or os.environ.get('USPEX_ABACUS_COMMAND', 'abacus')
+        self.cores = cores or os.cpu_count() or 1
+        self.workers = max(1, workers)
+        self.ompThreads = max(1, ompThreads)
+        self.mpiProcesses = max(1, self.cores // self.workers // self.ompThreads)
+        self.mpiCommand = mpiCommand
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.returnCodes = dict()
+        self._lock = threading.Lock()
+
+    def command(self, mpiProcesses: int = None):
+        command = shlex.split(self.abacusCommand)
+        if self.mpiCommand:
+            command = shlex.split(self.mpiCommand.format(np=mpiProcesses or self.mpiProcesses)) + command
+        return command
+
+    @classmethod
+    def readParallel(cls, calcFolder: str):
+        '''
+        :return: (MPI processes, OpenMP threads) from the PARALLEL file of calcFolder, None where unset
+        '''
+        variables = dict()
+        try:
+            with open(pj(calcFolder, cls.parallelFile)) as f:
+                for line in f:
+                    name, _, value = line.replace('export', '', 1).strip().partition('=')
+                    variables[name.strip()] = value.strip()
+        except OSError:
+            pass
+        mpi, omp = variables.get('USPEX_MPI_PROCESSES'), variables.get('OMP_NUM_THREADS')
+        return (int(mpi) if mpi and mpi.isdigit() else None), (int(omp) if omp and omp.isdigit() else None)
+
+    def share(self, mpiProcesses: int = None, ompThreads: int = None):
+        '''
+        Fit a layout from a PARALLEL file into the cores of one worker, cores // workers, so that
+        the workers running at the same time do not oversubscribe the allocation
+        :return: (MPI processes, OpenMP threads)
+        '''
+        cores = max(1, self.cores // self.workers)
+        ompThreads = min(ompThreads or self.ompThreads, cores)
+        mpiProcesses = min(mpiProcesses or self.mpiProcesses, max(1, cores // ompThreads))
+        return mpiProcesses, ompThreads
+
+    @classmethod
+    def writeDone(cls, calcFolder: str, returnCode: int, seconds: float):
+        tmp = pj(calcFolder, f'{cls.doneFile}.tmp')
+        with open(tmp, 'w') as f:
+            f.write(f'{returnCode} {seconds:.1f}\n')
+        os.replace(tmp, pj(calcFolder, cls.doneFile))
+
+    @classmethod
+    def readDone(cls, calcFolder: str):
+        '''
+        :return: return code written by the runner for calcFolder, None while it has not finished
+        '''
+        try:
+            with open(pj(calcFolder, cls.doneFile)) as f:
+                return int(f.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            return None
+
+    @classmethod
+    def readDoneTime(cls, calcFolder: str):
+        '''
+        :return: wall time in seconds written by the runner for calcFolder, None while it has not finished
+        '''
+        try:
+            with open(pj(calcFolder, cls.doneFile)) as f:
+                return float(f.read().split()[1])
+        except (OSError, ValueError, IndexError):
+            return None
+
+    @classmethod
+    def readStages(cls, calcFolder: str):
+        '''
+        :return: tags of the fused stages of calcFolder, empty for a single stage
+        '''
+        try:
+            with open(pj(calcFolder, cls.stagesFile)) as f:
+                return [line.strip() for line in f if line.strip()]
+        except OSError:
+            return []
+
+    @staticmethod
+    def readInput(filename: str):
+        parameters = dict()
+        with open(filename) as f:
+            for line in f:
+                words = line.split('#')[0].split(None, 1)
+                if len(words) == 2:
+                    parameters[words[0].lower()] = words[1].strip()
+        return parameters
+
+    def stageSucceeded(self, calcFolder: str):
+        state = LogTailer().poll(pj(calcFolder, self.outputFolder))
+        return state is not None and state.finished and state.scfConverged is not False
+
+    def advanceStage(self, calcFolder: str, previous: str, tag: str):
+        '''
+        Keep the output of stage previous and set calcFolder up for stage tag
+        '''
+        output = pj(calcFolder, self.outputFolder)
+        kept = f'{output}.{previous}'
+        if os.path.exists(kept):
+            shutil.rmtree(kept)
+        os.replace(output, kept)
+
+        before, after = self.readInput(pj(calcFolder, 'INPUT')), self.readInput(pj(calcFolder, f'INPUT_{tag}'))
+        for name in ('INPUT', 'KPT', 'STRU'):
+            shutil.copy2(pj(calcFolder, name), pj(calcFolder, f'{name}.{previous}'))
+        relaxed = pj(kept, 'STRU_ION_D')
+        if os.path.exists(relaxed):
+            shutil.copy2(relaxed, pj(calcFolder, 'STRU'))
+        shutil.copy2(pj(calcFolder, f'INPUT_{tag}'), pj(calcFolder, 'INPUT'))
+        if os.path.exists(pj(calcFolder, f'KPT_{tag}')):
+            shutil.copy2(pj(calcFolder, f'KPT_{tag}'), pj(calcFolder, 'KPT'))
+
+        # the density only fits the real-space grid when neither the cell nor the cutoff changed
+        densities = sorted({f for pattern in self.densityPatterns for f in glob.glob(pj(kept, pattern))})
+        sameGrid = before.get('calculation', 'scf').lower() != 'cell-relax' and \
+            before.get('ecutwfc') == after.get('ecutwfc') and before.get('ecutrho') == after.get('ecutrho')
+        if densities and sameGrid and 'init_chg' not in after:
+            os.makedirs(output, exist_ok=True)
+            for f in densities:
+                shutil.copy2(f, output)
+            with open(pj(calcFolder, 'INPUT'), 'a') as f:
+                f.write('init_chg file\n')
+        logger.info(f'{calcFolder}: stage {previous} done, starting stage {tag}')
+
+    def runOne(self, calcFolder: str):
+        if os.path.exists(pj(calcFolder, self.cachedFile)) or os.path.exists(pj(calcFolder, self.discardedFile)):
+            # the result comes from the result cache or the structure was discarded, nothing to compute
+            self.writeDone(calcFolder, 0, 0.0)
+            return 0
+        mpiProcesses, ompThreads = self.share(*self.readParallel(calcFolder))
+        env = dict(os.environ, OMP_NUM_THREADS=str(ompThreads))
+        stages = self.readStages(calcFolder) or [None]
+        start = time.time()
+        for i, tag in enumerate(stages):
+            if i > 0:
+                self.advanceStage(calcFolder, stages[i - 1], tag)
+            try:
+                with open(pj(calcFolder, self.outputFile), 'w' if i == 0 else 'a') as out, \
+                        open(pj(calcFolder, self.errorFile), 'w' if i == 0 else 'a') as err:
+                    returnCode = subprocess.run(self.command(mpiProcesses), cwd=calcFolder, env=env,
+                                                stdout=out, stderr=err, timeout=self.timeout).returncode
+            except subprocess.TimeoutExpired:
+                logger.warning(f'{calcFolder}: killed after {self.timeout} s')
+                returnCode = -9
+            except OSError as e:
+                logger.error(f'{calcFolder}: cannot run {self.abacusCommand}: {e}')
+                returnCode = 127
+            if i < len(stages) - 1 and returnCode == 0 and not self.stageSucceeded(calcFolder):
+                returnCode = 1
+            if returnCode != 0:
+                if len(stages) > 1:
+                    logger.info(f'{calcFolder}: stage {tag} failed, skipping the remaining stages')
+                break
+        self.writeDone(calcFolder, returnCode, time.time() - start)
+        return returnCode
+
+    def _work(self):
+        while True:
+            try:
+                calcFolder = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            returnCode = self.runOne(calcFolder)
+            with self._lock:
+                self.returnCodes[calcFolder] = returnCode
+            logger.info(f'{calcFolder}: finished with return code {returnCode}')
+
+    def run(self, calcFolders: list):
+        '''
+        Run every calc folder
+        :return: dict calcFolder -> return code
+        '''
+        for calcFolder in calcFolders:
+            self.queue.put(calcFolder)
+        logger.info(f'{len(calcFolders)} calculations on {self.cores} cores: {self.workers} at a time, '
+                    f'{self.mpiProcesses} MPI x {self.ompThreads} OMP each')
+        threads = [threading.Thread(target=self._work, daemon=True)
+                   for _ in range(min(self.workers, len(calcFolders)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return dict(self.returnCodes)
+
+
+def writePackScript(filename: str, calcFolders: list, cores: int = None, workers: int = 1, ompThreads: int = 1,
+                    abacusCommand: str = None, mpiCommand: str = None):
+    '''
+    Shell script running calcFolders through this module, to be submitted as one job
+    '''
+    arguments = ['--workers', str(workers), '--omp', str(ompThreads)]
+    if cores is not None:
+        arguments += ['--cores', str(cores)]
+    if abacusCommand is not None:
+        arguments += ['--command', abacusCommand]
+    if mpiCommand is not None:
+        arguments += ['--mpi', mpiCommand]
+    command = [sys.executable, os.path.abspath(__file__)] + arguments + [os.path.abspath(f) for f in calcFolders]
+    with open(filename, 'w') as f:
+        f.write('#!/bin/sh\n')
+        f.write(' '.join(shlex.quote(word) for word in command) + '\n')
+    os.chmod(filename, 0o755)
+    return filename
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run prepared ABACUS calc folders inside one allocation')
+    parser.add_argument('folders', nargs='*', help='calc folders')
+    parser.add_argument('--list', help='file with one calc folder per line')
+    parser.add_argument('--cores', type=int, help='cores of the allocation (default: all)')
+    parser.add_argument('--workers', type=int, default=1, help='calculations running at the same time')
+    parser.add_argument('--omp', type=int, default=1, help='OpenMP threads per MPI process')
+    parser.add_argument('--command', help='ABACUS command (default: $USPEX_ABACUS_COMMAND or abacus)')
+    parser.add_argument('--mpi', default='mpirun -np {np}', help='MPI launcher, empty to run ABACUS directly')
+    parser.add_argument('--timeout', type=float, help='seconds after which a calculation is killed')
+    args = parser.parse_args(argv)
+
+    folders = list(args.folders)
+    if args.list:
+        with open(args.list) as f:
+            folders += [line.strip() for line in f if line.strip()]
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    runner = PackedRunner(abacusCommand=args.command, cores=args.cores, workers=args.workers,
+                          ompThreads=args.omp, mpiCommand=args.mpi, timeout=args.timeout)
+    returnCodes = runner.run(folders)
+    return 0 if all(code == 0 for code in returnCodes.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+"""
+USPEX.Stages.ABACUS_Staging
+
+Content-addressed staging of pseudopotential and orbital files
+
+===========================
+"""
+import atexit
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+from os.path import join as pj
+
+logger = logging.getLogger(__name__)
+
+
+class StagingCache:
+    '''
+    Per-run store of pseudopotential/orbital files.
+
+    Every source file is hashed once per process and kept in cacheFolder under its
+    sha256 digest. Calc folders get a hardlink (or symlink, or copy as the last resort)
+    to the cached file instead of a fresh copy of the source.
+    '''
+
+    linkModes = ('hardlink', 'symlink', 'copy')
+    cleanupPolicies = ('keep', 'exit')
+    chunkSize = 1 << 20
+
+    _instances = dict()
+    _instancesLock = threading.Lock()
+
+    @classmethod
+    def forFolder(cls, cacheFolder: str, linkMode: str = 'hardlink', cleanup: str = 'keep'):
+        '''
+        Shared cache for cacheFolder, so all stages of a run stage into one place
+        '''
+        cacheFolder = os.path.abspath(cacheFolder)
+        with cls._instancesLock:
+            if cacheFolder not in cls._instances:
+                cls._instances[cacheFolder] = cls(cacheFolder, linkMode=linkMode, cleanup=cleanup)
+            return cls._instances[cacheFolder]
+
+    def __init__(self, cacheFolder: str, linkMode: str = 'hardlink', cleanup: str = 'keep', verify: bool = True):
+        '''
+        Parameter definition:
+            cacheFolder : Directory holding the cached files
+            linkMode : Preferred placement, one of 'hardlink', 'symlink', 'copy'
+            cleanup : 'keep' leaves the cache for later runs, 'exit' removes it at interpreter exit
+            verify : Re-hash every cached file once per process before it is first placed
+        '''
+        if linkMode not in self.linkModes:
+            raise ValueError(f'Unknown link mode {linkMode}, expected one of {self.linkModes}')
+        if cleanup not in self.cleanupPolicies:
+            raise ValueError(f'Unknown cleanup policy {cleanup}, expected one of {self.cleanupPolicies}')
+        self.cacheFolder = cacheFolder
+        self.linkMode = linkMode
+        self.cleanup = cleanup
+        self.verify = verify
+        os.makedirs(self.cacheFolder, exist_ok=True)
+
+        # source path -> (mtime_ns, size, digest)
+        self._entries = dict()
+        self._verified = set()
+        self._lock = threading.RLock()
+        if self.cleanup == 'exit':
+            atexit.register(self.clear)
+
+    @classmethod
+    def digest(cls, filename: str):
+        sha = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(cls.chunkSize), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def stage(self, source: str):
+        '''
+        :param source: pseudopotential or orbital file
+        :return: path of the cached copy of source
+        '''
+        source = os.path.abspath(source)
+        stat = os.stat(source)
+        with self._lock:
+            entry = self._entries.get(source)
+            if entry is None or entry[:2] != (stat.st_mtime_ns, stat.st_size):
+                digest = self.digest(source)
+                cached = pj(self.cacheFolder, digest)
+                if not os.path.exists(cached):
+                    tmp = f'{cached}.{os.getpid()}.{threading.get_ident()}.tmp'
+                    shutil.copyfile(source, tmp)
+                    os.chmod(tmp, 0o444)
+                    os.replace(tmp, cached)
+                    self._verified.add(digest)
+                entry = (stat.st_mtime_ns, stat.st_size, digest)
+                self._entries[source] = entry
+            digest = entry[2]
+            cached = pj(self.cacheFolder, digest)
+            if self.verify and digest not in self._verified:
+                if self.digest(cached) != digest:
+                    logger.warning(f'Staged file {cached} is corrupted, restaging {source}')
+                    os.remove(cached)
+                    self._entries.pop(source)
+                    return self.stage(source)
+                self._verified.add(digest)
+        return cached
+
+    def place(self, source: str, calcFolder: str, name: str = None):
+        '''
+        Put source into calcFolder under name (basename of source by default)
+        :return: the placement mode actually used
+        '''
+        cached = self.stage(source)
+        dest = pj(calcFolder, name if name is not None else os.path.basename(source))
+        if os.path.lexists(dest):
+            try:
+                if os.path.samefile(dest, cached):
+                    return 'present'
+            except OSError:
+                pass
+            os.remove(dest)
+
+        for mode in self.linkModes[self.linkModes.index(self.linkMode):]:
+            try:
+                if mode == 'hardlink':
+                    os.link(cached, dest)
+                elif mode == 'symlink':
+                    os.symlink(cached, dest)
+                else:
+                    shutil.copyfile(cached, dest)
+                return mode
+            except OSError as e:
+                logger.debug(f'Cannot {mode} {cached} to {dest}: {e}')
+        raise OSError(f'Unable to stage {source} into {calcFolder}')
+
+    def check(self):
+        '''
+        Integrity check of the whole cache, corrupted files are removed and restaged on next use
+        :return: list of removed digests
+        '''
+        corrupted = []
+        with self._lock:
+            for name in os.listdir(self.cacheFolder):
+                filename = pj(self.cacheFolder, name)
+                if name.endswith('.tmp'):
+                    continue
+                if self.digest(filename) != name:
+                    os.remove(filename)
+                    corrupted.append(name)
+            self._verified.difference_update(corrupted)
+            self._entries = {s: e for s, e in self._entries.items() if e[2] not in corrupted}
+        if corrupted:
+            logger.warning(f'Removed {len(corrupted)} corrupted files from {self.cacheFolder}')
+        return corrupted
+
+    def prune(self, maxAge: float):
+        '''
+        Remove cached files not used by this process and older than maxAge seconds,
+        together with temporary files left by killed processes
+        '''
+        now = time.time()
+        with self._lock:
+            inUse = {e[2] for e in self._entries.values()}
+            for name in os.listdir(self.cacheFolder):
+                filename = pj(self.cacheFolder, name)
+                if name in inUse or now - os.stat(filename).st_mtime < maxAge:
+                    continue
+                os.remove(filename)
+                self._verified.discard(name)
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.cacheFolder, ignore_errors=True)
+            self._entries.clear()
+            self._verified.clear()
@@ -0,0 +1,174 @@
+"""
+USPEX.Stages.ABACUS_Tuner
+
+Per-structure choice of kpar, bndpar and the MPI x OpenMP layout
+
+===========================
+"""
+import json
+import logging
+import math
+import os
+import threading
+from collections import defaultdict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class Layout:
+    '''
+    Parallel layout of one calculation
+    '''
+
+    def __init__(self, mpiProcesses: int, ompThreads: int, kpar: int, bndpar: int):
+        self.mpiProcesses = mpiProcesses
+        self.ompThreads = ompThreads
+        self.kpar = kpar
+        self.bndpar = bndpar
+
+    def key(self):
+        return (self.mpiProcesses, self.ompThreads, self.kpar, self.bndpar)
+
+    def __repr__(self):
+        return f'{self.mpiProcesses} MPI x {self.ompThreads} OMP, kpar {self.kpar}, bndpar {self.bndpar}'
+
+
+class ParallelTuner:
+    '''
+    Chooses the layout of a calculation from its k-mesh, atom count, basis and cores.
+
+    k-point pools (kpar) are the cheapest level of parallelism, so the number of processes is
+    divided into as many pools as the irreducible k-points (reduced by the space group with
+    spglib) use evenly, as long as every pool keeps
+    enough processes for the size of the structure. Processes a PW pool cannot use on its atoms
+    are spent on band groups (bndpar). Observed wall times are appended to a history file, and a
+    layout that was measured faster for the same kind of calculation replaces the estimate.
+    '''
+
+    # processes per atom beyond which a pool stops scaling
+    processesPerAtom = {'pw': 4, 'lcao': 2}
+    minSamples = 2
+
+    def __init__(self, cores: int, history: str = None):
+        '''
+        Parameter definition:
+            cores : Cores available to one calculation
+            history : JSON-lines file of observed wall times, shared between runs
+        '''
+        self.cores = max(1, cores)
+        self.history = history
+        self._lock = threading.Lock()
+        # (basis, cores, k-points, atom-count class) -> layout key -> list of seconds
+        self._timings = defaultdict(lambda: defaultdict(list))
+        if history is not None and os.path.exists(history):
+            with open(history) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        if record['cores'] != self.cores:
+                            continue
+                        self._timings[self.category(record['basis'], record['kpoints'], record['natoms'])][
+                            tuple(record['layout'])].append(record['seconds'])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+
+    # point-group order assumed when the symmetry of a structure cannot be analysed
+    maxPointGroup = 24
+
+    @classmethod
+    def irreducibleKPoints(cls, kPoints, structure=None, symmetry: int = 1):
+        '''
+        Irreducible points of a Gamma-centred mesh as ABACUS reduces it
+        :param structure: structure of the calculation, its space group reduces the mesh
+        :param symmetry: INPUT symmetry, -1 keeps the full mesh, 0 only uses time reversal
+        '''
+        kPoints = [int(n) for n in kPoints]
+        total = int(np.prod(kPoints))
+        if symmetry < 0:
+            return total
+        # k and -k are equivalent except for the points that are their own inverse
+        selfInverse = int(np.prod([2 if n % 2 == 0 else 1 for n in kPoints]))
+        timeReversal = (total + selfInverse) // 2
+        if symmetry == 0 or structure is None:
+            return timeReversal
+        try:
+            import spglib
+            lattice = np.asarray(structure.getCell().getCellVectors(), dtype=float)
+            positions = np.linalg.solve(lattice.T, np.asarray(structure.getCartesianCoordinates(), dtype=float).T).T
+            names = [el.short_name for el in structure.getAtomTypes()]
+            cell = (lattice, positions, [sorted(set(names)).index(name) for name in names])
+            mapping, _ = spglib.get_ir_reciprocal_mesh(kPoints, cell, is_shift=[0, 0, 0])
+            return len(np.unique(mapping))
+        except Exception as e:
+            logger.debug(f'No space group for the k-mesh reduction: {e}')
+        # without spglib assume a high symmetry, fewer pools than k-points are cheaper than idle ones
+        return max(1, math.ceil(timeReversal / cls.maxPointGroup))
+
+    def category(self, basis: str, kPoints: int, natoms: int):
+        return (basis, self.cores, kPoints, int(round(math.log2(max(natoms, 1)))))
+
+    @staticmethod
+    def divisors(n: int):
+        return [d for d in range(1, n + 1) if n % d == 0]
+
+    def estimate(self, nk: int, natoms: int, lcao: bool):
+        '''
+        :param nk: irreducible k-points, see irreducibleKPoints
+        :return: Layout estimated from the structure alone
+        '''
+        basis = 'lcao' if lcao else 'pw'
+        saturation = max(1, self.processesPerAtom[basis] * natoms)
+        # threads only pay off for LCAO once the processes of a pool would saturate
+        ompThreads = 2 if lcao and self.cores >= 8 and self.cores > saturation else 1
+        mpiProcesses = max(1, self.cores // ompThreads)
+        return Layout(mpiProcesses, ompThreads, *self.pools(nk, natoms, lcao, mpiProcesses))
+
+    def pools(self, nk: int, natoms: int, lcao: bool, mpiProcesses: int):
+        '''
+        :param mpiProcesses: processes of the calculation, e.g. fixed by an earlier fused stage
+        :return: (kpar, bndpar) splitting mpiProcesses into k-point pools and band groups
+        '''
+        saturation = max(1, self.processesPerAtom['lcao' if lcao else 'pw'] * natoms)
+
+        def cost(kpar):
+            perPool = mpiProcesses // kpar
+            return math.ceil(nk / kpar) * (1 + perPool / saturation) / perPool
+
+        kpar = min((d for d in self.divisors(mpiProcesses) if d <= nk), key=lambda d: (cost(d), -d))
+        bndpar = 1
+        perPool = mpiProcesses // kpar
+        if not lcao and perPool > saturation:
+            bndpar = min(d for d in self.divisors(perPool) if perPool // d <= saturation)
+        return kpar, bndpar
+
+    def choose(self, nk: int, natoms: int, lcao: bool):
+        '''
+        :param nk: irreducible k-points, see irreducibleKPoints
+        :return: Layout for a calculation, the fastest measured one when the history knows better
+        '''
+        layout = self.estimate(nk, natoms, lcao)
+        category = self.category('lcao' if lcao else 'pw', nk, natoms)
+        with self._lock:
+            timings = {key: np.mean(seconds) for key, seconds in self._timings.get(category, {}).items()
+                       if len(seconds) >= self.minSamples}
+        if timings:
+            best = min(timings, key=timings.get)
+            if layout.key() not in timings or timings[best] < timings[layout.key()]:
+                layout = Layout(*best)
+        return layout
+
+    def record(self, nk: int, natoms: int, lcao: bool, layout: Layout, seconds: float):
+        '''
+        Add the wall time of a finished calculation to the history
+        '''
+        if seconds is None or seconds <= 0:
+            return
+        basis = 'lcao' if lcao else 'pw'
+        with self._lock:
+            self._timings[self.category(basis, nk, natoms)][layout.key()].append(seconds)
+            if self.history is not None:
+                with open(self.history, 'a') as f:
+                    f.write(json.dumps(dict(basis=basis, cores=self.cores, kpoints=nk, natoms=natoms,
+                                            layout=list(layout.key()), seconds=seconds)) + '\n')
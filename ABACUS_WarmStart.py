@@ -0,0 +1,155 @@
+"""
+USPEX.Stages.ABACUS_WarmStart
+
+Store of converged charge densities used to start the SCF of close structures
+
+===========================
+"""
+import glob
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from os.path import join as pj
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def composition(structure):
+    '''
+    :return: composition string of a structure, e.g. "O4 Si2"
+    '''
+    counts = Counter(el.short_name for el in structure.getAtomTypes())
+    return ' '.join(f'{element}{counts[element]}' for element in sorted(counts))
+
+
+def latticeParameters(cell: np.ndarray):
+    '''
+    :return: lengths of the cell vectors and cosines of the angles between them
+    '''
+    cell = np.asarray(cell, dtype=float)
+    lengths = np.linalg.norm(cell, axis=1)
+    cosines = np.array([np.dot(cell[1], cell[2]) / (lengths[1] * lengths[2]),
+                        np.dot(cell[0], cell[2]) / (lengths[0] * lengths[2]),
+                        np.dot(cell[0], cell[1]) / (lengths[0] * lengths[1])])
+    return lengths, cosines
+
+
+class DensityStore:
+    '''
+    Converged charge densities of finished calculations, kept per INPUT tag and composition.
+
+    ABACUS reads an initial density (init_chg file) only on the real-space grid it would build
+    itself, so a density is offered to a new structure of the same composition whose cell
+    lengths and angles agree within tolerance, which keeps the FFT grid unchanged. The atoms
+    have to sit alike as well: the pair-distance fingerprints of the two structures must agree
+    within fingerprintTolerance, a density of other bonds starts the SCF further off than atomic charge.
+    Densities are copied, never linked: ABACUS overwrites them in place when it writes its own.
+    '''
+
+    densityPatterns = ('SPIN*_CHG.cube', 'chg*.cube')
+    indexFile = 'density.json'
+
+    def __init__(self, folder: str, tolerance: float = 0.02, fingerprintTolerance: float = 0.05,
+                 maxPerComposition: int = 16):
+        '''
+        Parameter definition:
+            folder : Directory holding the stored densities
+            tolerance : Largest relative change of cell lengths (and absolute change of angle cosines)
+            fingerprintTolerance : Largest cosine distance between the fingerprints of the structures
+            maxPerComposition : Only the most recent densities of a composition are kept
+        '''
+        self.folder = os.path.abspath(folder)
+        self.tolerance = tolerance
+        self.fingerprintTolerance = fingerprintTolerance
+        self.maxPerComposition = maxPerComposition
+        os.makedirs(self.folder, exist_ok=True)
+        self._lock = threading.Lock()
+        # (tag, composition) -> list of (entry folder, lengths, cosines, created, fingerprint vector)
+        self._entries = dict()
+        self._counter = 0
+        for meta in glob.glob(pj(self.folder, '*', self.indexFile)):
+            try:
+                with open(meta) as f:
+                    data = json.load(f)
+                lengths, cosines = latticeParameters(data['cell'])
+                vector = np.asarray(data['fingerprint'], dtype=float) if data.get('fingerprint') else None
+                self._entries.setdefault((data['tag'], data['composition']), []).append(
+                    (os.path.dirname(meta), lengths, cosines, data['created'], vector))
+            except (OSError, ValueError, KeyError):
+                logger.debug(f'Ignoring broken density entry {meta}')
+        for entries in self._entries.values():
+            entries.sort(key=lambda entry: entry[3])
+
+    @classmethod
+    def densityFiles(cls, outputFolder: str):
+        return sorted({f for pattern in cls.densityPatterns for f in glob.glob(pj(outputFolder, pattern))})
+
+    def store(self, tag: str, composition: str, cell: np.ndarray, outputFolder: str, fingerprint=None):
+        '''
+        Keep the density written into outputFolder by a finished calculation
+        :param fingerprint: Fingerprint of the final structure
+        :return: folder of the new entry, None when outputFolder has no density
+        '''
+        files = self.densityFiles(outputFolder)
+        if not files:
+            return None
+        with self._lock:
+            self._counter += 1
+            entry = pj(self.folder, f'{os.getpid()}-{time.time_ns()}-{self._counter}')
+        os.makedirs(entry)
+        for f in files:
+            shutil.copy2(f, entry)
+        created = time.time()
+        vector = np.asarray(fingerprint.vector, dtype=float) if fingerprint is not None else None
+        with open(pj(entry, self.indexFile), 'w') as f:
+            json.dump(dict(tag=str(tag), composition=composition, cell=np.asarray(cell, dtype=float).tolist(),
+                           created=created, fingerprint=vector.tolist() if vector is not None else None), f)
+
+        lengths, cosines = latticeParameters(cell)
+        with self._lock:
+            entries = self._entries.setdefault((str(tag), composition), [])
+            entries.append((entry, lengths, cosines, created, vector))
+            evicted = entries[:-self.maxPerComposition] if len(entries) > self.maxPerComposition else []
+            del entries[:len(evicted)]
+        for old in evicted:
+            shutil.rmtree(old[0], ignore_errors=True)
+        return entry
+
+    def find(self, tag: str, composition: str, cell: np.ndarray, fingerprint=None):
+        '''
+        :param fingerprint: Fingerprint of the new structure, only densities of structures within
+                            fingerprintTolerance of it are offered
+        :return: folder of the closest compatible density, or None
+        '''
+        lengths, cosines = latticeParameters(cell)
+        best, bestDeviation = None, None
+        with self._lock:
+            entries = list(self._entries.get((str(tag), composition), []))
+        # newest first, so the most recent of equally close densities wins
+        for entry, storedLengths, storedCosines, _, vector in reversed(entries):
+            if fingerprint is not None and (vector is None or len(vector) != len(fingerprint.vector)
+                                            or fingerprint.distance(vector) > self.fingerprintTolerance):
+                continue
+            deviation = max(np.max(np.abs(lengths / storedLengths - 1)), np.max(np.abs(cosines - storedCosines)))
+            if deviation <= self.tolerance and (bestDeviation is None or deviation < bestDeviation):
+                best, bestDeviation = entry, deviation
+        return best
+
+    def place(self, entry: str, outputFolder: str):
+        '''
+        Copy the density of entry into outputFolder, where init_chg file looks for it
+        :return: list of placed files, empty when the entry has disappeared
+        '''
+        files = self.densityFiles(entry)
+        if not files:
+            return []
+        os.makedirs(outputFolder, exist_ok=True)
+        for f in self.densityFiles(outputFolder):
+            os.remove(f)
+        return [shutil.copy2(f, outputFolder) for f in files]
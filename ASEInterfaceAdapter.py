@@ -6,20 +6,104 @@ from ase.io.espresso import read_fortran_namelist, read_espresso_out, write_espr
 from ase.io.abacus import write_abacus, read_abacus_results, read_abacus_out
 from ase.io import ParseError, read, write
 from ase.atoms import Atoms
+from ase.data import chemical_symbols, atomic_masses, atomic_numbers
+from ase.units import Bohr
 from ase.constraints import FixAtoms
 import os
+import mmap
+from io import StringIO
+from .ABACUS_LogTailer import LogTailer
 
 logger = logging.getLogger(__name__)
+
+
+def _lineStart(mm, position):
+    return mm.rfind(b'\n', 0, position) + 1
+
+
+def _lineEnd(mm, position, lines=1):
+    for _ in range(lines):
+        position = mm.find(b'\n', position) + 1
+        if position == 0:
+            return len(mm)
+    return position
+
+
+def _readLastFrame(filename, locate):
+    '''
+    Memory-map filename and let locate(mm) find the header and last-frame byte ranges by
+    scanning backwards from the end, so only those ranges are ever read.
+    :return: text of the ranges joined together, or None if locate did not find its markers
+    '''
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            ranges = locate(mm)
+            if ranges is None:
+                return None
+            text = StringIO(b''.join(mm[start:end] for start, end in ranges).decode(errors='replace'))
+    text.name = filename
+    return text
+
 class ASEInterfaceAdapter:
     structureType = None
     atomType = None
     cellType = None
 
+    # atomic number -> interned atomType
+    _elements = dict()
+
     @classmethod
     def registerTypes(cls, structureType, atomType, cellType):
         cls.structureType = structureType
         cls.atomType = atomType
         cls.cellType = cellType
+        cls._elements = dict()
+
+    ########################## Structure conversion shared by all backends ##########################
+    @classmethod
+    def atomTypes(cls, numbers):
+        '''
+        :param numbers: atomic numbers
+        :return: array of atomTypes, one interned object per element
+        '''
+        unique, inverse = np.unique(np.asarray(numbers, dtype=int), return_inverse=True)
+        elements = np.empty(len(unique), dtype=object)
+        for i, number in enumerate(unique):
+            element = cls._elements.get(number)
+            if element is None:
+                element = cls._elements[number] = cls.atomType(chemical_symbols[number])
+            elements[i] = element
+        return elements[inverse]
+
+    @classmethod
+    def toAtoms(cls, structure, sort=False):
+        '''
+        :param sort: order atoms by chemical symbol
+        :return: ase Atoms of structure and the applied order (None when not sorted)
+        '''
+        cell = structure.getCell()
+        symbols = np.asarray([el.short_name for el in structure.getAtomTypes()])
+        positions = structure.getCartesianCoordinates()
+        order = None
+        if sort:
+            order = np.argsort(symbols)
+            symbols, positions = symbols[order], positions[order]
+        return Atoms(symbols, positions, cell=cell.getCellVectors()), order
+
+    @classmethod
+    def fromAtoms(cls, atoms, pbc, order=None, numbers=None):
+        '''
+        :param order: order applied by toAtoms, undone here
+        :param numbers: atomic numbers to use instead of those of atoms
+        :return: structure of atoms
+        '''
+        atomTypes = cls.atomTypes(atoms.numbers if numbers is None else numbers)
+        positions = atoms.get_positions()
+        if order is not None:
+            atomTypes[order], positions[order] = atomTypes.copy(), positions.copy()
+        return cls.structureType(atomTypes, positions, cell=cls.cellType(atoms.get_cell().array, pbc))
 
     class Results:
 
@@ -48,34 +132,53 @@ class ASEInterfaceAdapter:
         potcar_file = 'POTCAR'
 
         def write(self, structure, fixedIndices, label, calcFolder):
-            cell = structure.getCell()
-            symbols = np.asarray([el.short_name for el in structure.getAtomTypes()])
-            order = np.argsort(symbols)
-            atoms = Atoms(symbols[order], structure.getCartesianCoordinates()[order], cell=cell.getCellVectors())
+            atoms, order = ASEInterfaceAdapter.toAtoms(structure, sort=True)
             if len(fixedIndices) > 0:
                 atoms.set_constraint(FixAtoms(indices=fixedIndices))
             write_vasp(pj(calcFolder, self.poscar_file), atoms, label=label, direct=True, vasp5=True, long_format=False)
-            return {'pbc': cell.getPBC(), 'symbolsOrder': order}
+            return {'pbc': structure.getCell().getPBC(), 'symbolsOrder': order}
+
+        # read only the last ionic step of OUTCAR instead of the whole trajectory
+        lastFrameOnly = False
 
-        def read(self, calcFolder, pbc, symbolsOrder):
+        @staticmethod
+        def locateLastFrame(mm):
+            '''
+            OUTCAR header (up to the first SCF iteration) and the last complete ionic step
+            '''
+            delimiter = b'FREE ENERGIE OF THE ION-ELECTRON SYSTEM'
+            last = mm.rfind(delimiter)
+            previous = mm.rfind(delimiter, 0, last) if last > 0 else -1
+            iteration = mm.find(b'Iteration')
+            if previous < 0 or iteration < 0 or iteration > previous:
+                return None
+            # ase closes every ionic step 4 lines after the delimiter
+            return [(0, _lineEnd(mm, iteration)), (_lineEnd(mm, previous, 5), len(mm))]
+
+        def read(self, calcFolder, pbc, symbolsOrder, lastFrame=None):
+            lastFrame = self.lastFrameOnly if lastFrame is None else lastFrame
+            trajectoryAtoms = None
+            if lastFrame:
+                try:
+                    text = _readLastFrame(pj(calcFolder, self.outcar_file), self.locateLastFrame)
+                    if text is not None:
+                        trajectoryAtoms = list(iread_vasp_out(text, None))[-1:] or None
+                except (OSError, KeyError, ValueError, IndexError, ParseError) as e:
+                    logger.debug(f'Last-frame read of OUTCAR failed, reading it forward: {e}')
             try:
-                with open(pj(calcFolder, self.outcar_file)) as f:
-                    trajectoryAtoms = list(iread_vasp_out(f, None))
+                if trajectoryAtoms is None:
+                    with open(pj(calcFolder, self.outcar_file)) as f:
+                        trajectoryAtoms = list(iread_vasp_out(f, None))
+                        if lastFrame:
+                            trajectoryAtoms = trajectoryAtoms[-1:]
             except (KeyError, ParseError):
                 with open(pj(calcFolder, self.xml_file)) as f:
                     trajectoryAtoms = list(read_vasp_xml(f))
             trajectory = []
+            symbolsOrder = np.asarray(symbolsOrder)
             for atoms in trajectoryAtoms:
-                size = len(atoms)
-                positions = np.empty((size, 3), dtype=float)
-                atomTypes = np.empty(size, dtype=ASEInterfaceAdapter.atomType)
-                for i, symbol, position in zip(symbolsOrder, atoms.get_chemical_symbols(), atoms.get_positions()):
-                    positions[i] = position
-                    atomTypes[i] = ASEInterfaceAdapter.atomType(symbol)
-                cell = ASEInterfaceAdapter.cellType(atoms.get_cell().array, pbc)
-                structure = ASEInterfaceAdapter.structureType(atomTypes, positions, cell=cell)
                 trajectory.append(dict(
-                    structure=structure,
+                    structure=ASEInterfaceAdapter.fromAtoms(atoms, pbc, order=symbolsOrder),
                     results=ASEInterfaceAdapter.Results(atoms)
                 ))
             return trajectory
@@ -87,9 +190,7 @@ class ASEInterfaceAdapter:
         dump_file = 'lammps.dump'
 
         def write(self, structure, fixedIndices, label, specorder, calcFolder):
-            cell = structure.getCell()
-            atoms = Atoms([el.short_name for el in structure.getAtomTypes()], structure.getCartesianCoordinates(),
-                          cell=cell.getCellVectors())
+            atoms, _ = ASEInterfaceAdapter.toAtoms(structure)
             filename = pj(calcFolder, self.data_file)
             atoms.write(filename, format='lammps-data', specorder=specorder)
             with open(filename, 'rt') as f:
@@ -97,16 +198,14 @@ class ASEInterfaceAdapter:
             content[0] = f'{label}\n'
             with open(filename, 'wt') as f:
                 f.writelines(content)
-            return {'pbc': cell.getPBC()}
+            return {'pbc': structure.getCell().getPBC()}
 
         def read(self, calcFolder, specorder, pbc):
             if ex(pj(calcFolder, self.dump_file)):
                 atoms = read(pj(calcFolder, self.dump_file), format='lammps-dump-text')
-                atomTypes = np.array(
-                    [ASEInterfaceAdapter.atomType(specorder[i - 1]) for i in atoms.get_atomic_numbers()])
-                structure = ASEInterfaceAdapter.structureType(atomTypes, atoms.get_positions(),
-                                                              cell=ASEInterfaceAdapter.cellType(atoms.get_cell().array,
-                                                                                                pbc))
+                # lammps type ids come back as atomic numbers, map them through specorder
+                numbers = np.array([chemical_symbols.index(s) for s in specorder])[atoms.numbers - 1]
+                structure = ASEInterfaceAdapter.fromAtoms(atoms, pbc, numbers=numbers)
                 return dict(
                     structure=structure,
                     results=ASEInterfaceAdapter.Results(atoms)
@@ -126,10 +225,7 @@ class ASEInterfaceAdapter:
             self.data = data
 
         def write(self, structure, fixedIndices, kPoints, pseudopotentials, calcFolder):
-            cell = structure.getCell()
-            atoms = Atoms(symbols=[el.short_name for el in structure.getAtomTypes()],
-                          positions=structure.getCartesianCoordinates(),
-                          cell=cell.getCellVectors())
+            atoms, _ = ASEInterfaceAdapter.toAtoms(structure)
             if len(fixedIndices) > 0:
                 atoms.set_constraint(FixAtoms(indices=fixedIndices))
             with open(calcFolder / self.inputFile, 'wt') as f:
@@ -138,17 +234,42 @@ class ASEInterfaceAdapter:
                                   pseudopotentials={s: p.name for s, p in pseudopotentials.items()},
                                   kpts=kPoints,
                                   crystal_coordinates=True)
-            return {'pbc': cell.getPBC()}
+            return {'pbc': structure.getCell().getPBC()}
+
+        # parse only the header and the last SCF of the output
+        lastFrameOnly = True
+
+        @staticmethod
+        def locateLastFrame(mm):
+            '''
+            Start of the last PWSCF run up to its first SCF, and everything after the
+            second-to-last SCF of the output
+            '''
+            end = b'End of self-consistent calculation'
+            last = mm.rfind(end)
+            previous = mm.rfind(end, 0, last) if last > 0 else -1
+            if previous < 0:
+                return None
+            start = mm.rfind(b'Program PWSCF', 0, previous)
+            if start < 0:
+                return None
+            headerEnd = _lineStart(mm, mm.find(end, start))
+            return [(_lineStart(mm, start), headerEnd), (max(headerEnd, _lineStart(mm, previous)), len(mm))]
 
         def read(self, calcFolder, pbc):
-            with open(pj(calcFolder, self.outputFile)) as f:
-                atoms = next(read_espresso_out(f, index=slice(None, -2, -1)))
-            atomTypes = np.array([ASEInterfaceAdapter.atomType(s) for s in atoms.get_chemical_symbols()])
-            structure = ASEInterfaceAdapter.structureType(atomTypes, atoms.get_positions(),
-                                                          cell=ASEInterfaceAdapter.cellType(atoms.get_cell().array,
-                                                                                            pbc))
+            atoms = None
+            if self.lastFrameOnly:
+                try:
+                    text = _readLastFrame(pj(calcFolder, self.outputFile), self.locateLastFrame)
+                    if text is not None:
+                        atoms = next(read_espresso_out(text, index=slice(None, -2, -1)))
+                except (OSError, KeyError, ValueError, IndexError, StopIteration) as e:
+                    logger.debug(f'Last-frame read of QE output failed, reading it forward: {e}')
+            if atoms is None:
+                with open(pj(calcFolder, self.outputFile)) as f:
+                    atoms = next(read_espresso_out(f, index=slice(None, -2, -1)))
             return dict(
-                structure=structure,
+                structure=ASEInterfaceAdapter.fromAtoms(atoms, pbc),
                 results=ASEInterfaceAdapter.Results(atoms)
             )
 
@@ -165,30 +286,139 @@ class ASEInterfaceAdapter:
         log3_file = 'OUT.USPEX/running_scf.log'
         output_file = 'OUT.USPEX'        
 
+        # format STRU straight from the arrays instead of going through Atoms and write_abacus
+        nativeWriter = True
+        # (species, pseudopotentials, orbitals) -> whether the native text matched write_abacus
+        _nativeChecked = dict()
+
+        @staticmethod
+        def writeKPoints(filename, kPoints):
+            with open(filename, 'w') as fp:
+                fp.write('K_POINTS\n0\nGamma\n')
+                fp.write('%4d %4d %4d   0   0   0\n' % tuple(kPoints))
+
+        @staticmethod
+        def formatStru(symbols, positions, cell, pp, basis):
+            '''
+            STRU text in the layout of write_abacus, species in order of appearance
+            :param symbols: chemical symbols, already sorted
+            '''
+            species, counts = np.unique(symbols, return_counts=True)
+            first = np.argsort([np.flatnonzero(symbols == s)[0] for s in species])
+            species, counts = species[first], counts[first]
+            # not wrapped into the cell, like write_abacus on the non-periodic Atoms of toAtoms
+            scaled = np.linalg.solve(cell.T, positions.T).T
+
+            lines = ['ATOMIC_SPECIES\n']
+            for element in species:
+                mass = str(atomic_masses[atomic_numbers[element]])
+                pseudofile = pp[element] if pp else f'{element}.UPF'
+                lines.append(f'{element}{" " * (4 - len(element))}{mass}{" " * (14 - len(mass))}{pseudofile}\n')
+            if basis:
+                lines.append('\nNUMERICAL_ORBITAL\n')
+                lines.extend(f'{basis[element]}\n' for element in species)
+            lines.append(f'\nLATTICE_CONSTANT\n{1 / Bohr} \n\nLATTICE_VECTORS\n')
+            for vector in cell:
+                lines.append(''.join(f'{value:0<12f}      ' for value in vector) + '\n')
+            lines.append('\nATOMIC_POSITIONS\nDirect\n')
+            start = 0
+            for element, count in zip(species, counts):
+                lines.append(f'\n{element}\n0.0\n{count}\n')
+                # one format call per species instead of one per atom
+                row = '{:0<12f} {:0<12f} {:0<12f}  1 1 1\n'
+                lines.append((row * count).format(*scaled[start:start + count].ravel()))
+                start += count
+            return ''.join(lines)
+
         def write(self, filename, structure, pp, basis):
-            cell = structure.getCell()
+            cell = np.asarray(structure.getCell().getCellVectors(), dtype=float)
             symbols = np.asarray([el.short_name for el in structure.getAtomTypes()])
             order = np.argsort(symbols)
-            atoms = Atoms(symbols[order], structure.getCartesianCoordinates()[order], cell=cell.getCellVectors())
-            #if len(fixedIndices) > 0:
-            #    atoms.set_constrain(FixAtoms(indices=fixedIndices))
+            key = (tuple(np.unique(symbols)), tuple(sorted(pp.items())) if pp else None,
+                   tuple(sorted(basis.items())) if basis else None)
+            native = self.nativeWriter and self._nativeChecked.get(key) is not False
+            if native:
+                text = self.formatStru(symbols[order], np.asarray(structure.getCartesianCoordinates())[order],
+                                       cell, pp, basis)
+            if not native or key not in self._nativeChecked:
+                atoms, _ = ASEInterfaceAdapter.toAtoms(structure, sort=True)
+                reference = StringIO()
+                write_abacus(reference, atoms, pp, basis)
+                reference = reference.getvalue()
+                if native:
+                    # the native layout is trusted only after it reproduced write_abacus once
+                    self._nativeChecked[key] = text == reference
+                    if text != reference:
+                        logger.warning('Native STRU writer differs from write_abacus, using write_abacus')
+                text = reference
             with open(filename, 'wt') as f:
-                write_abacus(f, atoms, pp, basis)
-            
-            return {'pbc': cell.getPBC()}
-
-        def read(self, foldername, pbc):
-            for i in os.listdir(foldername):
-               if i.startswith('running') and i.endswith('log'):
-                   log = i
-                   break
-               else:
-                   logger.info('No log file.')
-            atoms = read(pj(foldername,log), format='abacus-out')
-            atomTypes = np.array([ASEInterfaceAdapter.atomType(s) for s in atoms.get_chemical_symbols()])
-            structure = ASEInterfaceAdapter.structureType(atomTypes, atoms.get_positions(), \
-                        cell=ASEInterfaceAdapter.cellType(atoms.get_cell().array, pbc))
-            volumeline = os.popen('grep Volume {} |tail -n 1'.format(pj(foldername,log))).read()
-            volume = volumeline.strip().split('=')[1]
-            return dict(structure=structure, results=ASEInterfaceAdapter.Results(atoms), volume = float(volume))
-            
+                f.write(text)
+
+            return {'pbc': structure.getCell().getPBC()}
+
+        # parse only the header and the last ionic steps of the log
+        lastFrameOnly = True
+        stepMarkers = (b'STEP OF ION RELAXATION', b'STEP OF RELAXATION', b'RELAX IONS', b'STEP OF MOLECULAR DYNAMICS')
+
+        def __init__(self):
+            # foldername -> (log signature, extracted results)
+            self._extracted = dict()
+
+        @classmethod
+        def locateLastFrame(cls, mm):
+            '''
+            Log header (up to the first ionic step) and the last two ionic steps, the earlier
+            one holds the coordinates and cell printed before the final step
+            '''
+            for marker in cls.stepMarkers:
+                last = mm.rfind(marker)
+                previous = mm.rfind(marker, 0, last) if last > 0 else -1
+                if previous >= 0:
+                    headerEnd = _lineStart(mm, mm.find(marker))
+                    return [(0, headerEnd), (max(headerEnd, _lineStart(mm, previous)), len(mm))]
+            return None
+
+        def readAtoms(self, log):
+            if self.lastFrameOnly:
+                try:
+                    text = _readLastFrame(log, self.locateLastFrame)
+                    if text is not None:
+                        return read(text, format='abacus-out')
+                except Exception as e:
+                    logger.debug(f'Last-frame read of {log} failed, reading it forward: {e}')
+            return read(log, format='abacus-out')
+
+        def extract(self, foldername, state=None):
+            '''
+            Final frame, energy, forces, stress, volume, convergence flags and ionic-step count
+            of the running_*.log in foldername. The log is parsed once per version and the result
+            is cached per folder; state is the LogState already built while polling, if any.
+            '''
+            if state is None:
+                state = LogTailer().poll(foldername)
+            if state is None:
+                raise FileNotFoundError(f'No running_*.log in {foldername}')
+            stat = os.stat(state.filename)
+            signature = (state.filename, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            cached = self._extracted.get(foldername)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+
+            atoms = self.readAtoms(state.filename)
+            results = atoms.get_calculator().results
+            extracted = dict(atoms=atoms,
+                             results=ASEInterfaceAdapter.Results(atoms),
+                             energy=results.get('energy'),
+                             forces=results.get('forces'),
+                             stress=results.get('stress'),
+                             volume=state.volume if state.volume is not None else atoms.get_volume(),
+                             converged=state.converged,
+                             relaxConverged=state.relaxConverged,
+                             ionicSteps=state.ionicSteps)
+            self._extracted[foldername] = (signature, extracted)
+            return extracted
+
+        def read(self, foldername, pbc, state=None):
+            extracted = self.extract(foldername, state)
+            structure = ASEInterfaceAdapter.fromAtoms(extracted['atoms'], pbc)
+            return dict(extracted, structure=structure)
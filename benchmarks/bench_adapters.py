@@ -0,0 +1,399 @@
+"""
+USPEX.Stages.benchmarks.bench_adapters
+
+Timing and peak memory of the adapter read/write paths on synthetic outputs
+
+    python benchmarks/bench_adapters.py --atoms 8,64,256 --steps 1,10,50 --json results.json
+    python benchmarks/bench_adapters.py --compare results.json
+
+Runs offline: ABACUS, VASP and pw.x are never started, their outputs are generated by
+synthetic.py. Cases whose ase reader or writer is not available are reported as skipped,
+cases that fail otherwise, or whose last-frame read differs from the forward read, as
+failed, and the exit status is then 1.
+
+===========================
+"""
+import argparse
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from os.path import join as pj
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# stand-in for USPEX's KPoints when the modules are benchmarked outside a USPEX installation
+KPOINTS_FALLBACK = '''import numpy as np
+
+
+class BadKPoints(Exception):
+    pass
+
+
+class KPoints:
+
+    def __init__(self, kresol):
+        self.kresol = kresol
+
+    def build(self, cell):
+        reciprocal = np.linalg.norm(np.linalg.inv(cell.getCellVectors()), axis=0)
+        return [max(1, int(np.ceil(r / self.kresol))) for r in reciprocal]
+'''
+
+
+# packages of an USPEX installation that may hold the adapter modules
+INSTALLED_PACKAGES = ('USPEX.Stages.Interfaces', 'USPEX.Stages')
+# errors of readers and writers that are not available, their cases are skipped
+UNAVAILABLE = (ImportError, NotImplementedError)
+try:
+    # raised by ase.io.read for a format whose plugin (e.g. ase-abacus) is not installed
+    from ase.io.formats import UnknownFileTypeError
+    UNAVAILABLE += (UnknownFileTypeError,)
+except ImportError:
+    pass
+
+
+def loadPackage(workFolder: str):
+    '''
+    :return: name of the package holding the adapter modules, USPEX.Stages.Interfaces (or
+             USPEX.Stages) when installed, otherwise a package of links to the modules of this repository
+    '''
+    for package in INSTALLED_PACKAGES:
+        try:
+            if importlib.util.find_spec(f'{package}.ASEInterfaceAdapter') is not None:
+                return package
+        except ImportError:
+            # the parent package is not installed
+            continue
+    package = pj(workFolder, 'uspex_bench')
+    os.makedirs(package)
+    for name in os.listdir(REPOSITORY):
+        if name.endswith('.py'):
+            os.symlink(pj(REPOSITORY, name), pj(package, name))
+    if not os.path.exists(pj(package, '__init__.py')):
+        open(pj(package, '__init__.py'), 'w').close()
+    if not os.path.exists(pj(package, 'KPoints.py')):
+        with open(pj(package, 'KPoints.py'), 'w') as f:
+            f.write(KPOINTS_FALLBACK)
+    sys.path.insert(0, workFolder)
+    return 'uspex_bench'
+
+
+class Benchmark:
+    '''
+    Runs every case over the grid of atom and ionic-step counts and collects one row per case and size
+    '''
+
+    def __init__(self, package: str, workFolder: str, repeat: int = 3):
+        self.adapters = importlib.import_module(f'{package}.ASEInterfaceAdapter')
+        self.interfaceModule = importlib.import_module(f'{package}.ABACUS_Interface')
+        self.adapterType = self.adapters.ASEInterfaceAdapter
+        self.adapterType.registerTypes(synthetic.Structure, synthetic.Element, synthetic.Cell)
+        self.interfaceModule.ABACUS_Interface.registerTypes(self.adapterType.ABACUS)
+        self.workFolder = workFolder
+        self.repeat = repeat
+        self.rows = []
+
+    def measure(self, case: str, natoms: int, steps, function, setup=None, size=None):
+        '''
+        Time function over repeat runs (setup runs untimed before each) and record its peak
+        memory in one more traced run
+        :param size: callable returning the bytes processed by one run
+        '''
+        row = dict(case=case, atoms=natoms, steps=steps)
+        try:
+            seconds = []
+            for _ in range(self.repeat):
+                if setup is not None:
+                    setup()
+                start = time.perf_counter()
+                function()
+                seconds.append(time.perf_counter() - start)
+            if setup is not None:
+                setup()
+            tracemalloc.start()
+            try:
+                function()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        except UNAVAILABLE as e:
+            row['skipped'] = self.describe(e)
+            self.rows.append(row)
+            return row
+        except Exception as e:
+            # a regression, reported with the other results instead of stopping the run
+            logger.exception(f'{case} failed for {natoms} atoms and {steps} steps')
+            row['failed'] = self.describe(e)
+            self.rows.append(row)
+            return row
+        row.update(best=min(seconds), mean=float(np.mean(seconds)), peak=peak)
+        if size is not None:
+            row['bytes'] = size()
+            row['throughput'] = row['bytes'] / row['best'] if row['best'] > 0 else None
+        self.rows.append(row)
+        return row
+
+    @staticmethod
+    def describe(error: Exception):
+        return f'{type(error).__name__}: {error}'.splitlines()[0][:80]
+
+    def compare(self, case: str, natoms: int, steps, forward, last):
+        '''
+        Mark the row of case as failed when the last-frame read disagrees with the forward read
+        :param forward, last: callables reading the same output both ways
+        '''
+        row = next((r for r in reversed(self.rows) if (r['case'], r['atoms'], r['steps']) == (case, natoms, steps)),
+                   None)
+        if row is None or 'best' not in row:
+            return
+        try:
+            expected, actual = forward(), last()
+            same = np.allclose(expected['structure'].getCartesianCoordinates(),
+                               actual['structure'].getCartesianCoordinates(), atol=1e-6) \
+                and np.allclose(expected['structure'].getCell().getCellVectors(),
+                                actual['structure'].getCell().getCellVectors(), atol=1e-6) \
+                and np.isclose(expected['results'].results['energy'], actual['results'].results['energy'])
+        except Exception as e:
+            row['failed'] = f'comparison with the forward read: {self.describe(e)}'
+            return
+        if not same:
+            row['failed'] = 'last frame differs from the forward read'
+
+    def folder(self, *names):
+        folder = pj(self.workFolder, *names)
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    ############################## ABACUS ##############################
+    def abacusSetup(self):
+        '''
+        Specific/ folder of an ABACUS_Interface in the work folder, returns the interface
+        '''
+        specific = self.folder('Specific')
+        with open(pj(specific, 'INPUT_1'), 'w') as f:
+            f.write('INPUT_PARAMETERS\ncalculation relax\nbasis_type pw\necutwfc 50\ncal_force 1\ncal_stress 1\n')
+        with open(pj(specific, 'ATOMIC_SPECIES'), 'w') as f:
+            f.write('Si 28.085 Si.UPF\nO 15.999 O.UPF\n')
+        for pseudopotential in ('Si.UPF', 'O.UPF'):
+            with open(pj(specific, pseudopotential), 'w') as f:
+                f.write('<UPF version="2.0.1">\n</UPF>\n')
+        return self.interfaceModule.ABACUS_Interface(tag=1, kresol=0.1,
+                                                     stagingFolder=pj(self.workFolder, '.abacus_staging'))
+
+    def abacusCases(self, atoms, steps):
+        cwd = os.getcwd()
+        os.chdir(self.workFolder)
+        try:
+            interface = self.abacusSetup()
+            pp = {'Si': 'Si.UPF', 'O': 'O.UPF'}
+            for natoms in atoms:
+                structure = synthetic.makeStructure(natoms)
+                filename = pj(self.folder('abacus-write'), 'STRU')
+                self.measure('ABACUS.write', natoms, None,
+                             lambda: interface.adapter.write(filename, structure, pp, None),
+                             size=lambda: os.path.getsize(filename))
+
+                for nsteps in steps:
+                    calcFolder = self.folder(f'abacus-{natoms}-{nsteps}')
+                    output = self.folder(f'abacus-{natoms}-{nsteps}', interface.output_file)
+                    log = pj(output, 'running_relax.log')
+                    text = synthetic.abacusLog(structure, nsteps)
+                    with open(log, 'w') as f:
+                        f.write(text)
+                    pbc = structure.getCell().getPBC()
+
+                    # a fresh adapter per run, the extracted results are cached per log version
+                    self.measure('ABACUS.read', natoms, nsteps,
+                                 lambda: self.adapterType.ABACUS().read(output, pbc),
+                                 size=lambda: os.path.getsize(log))
+                    self.compare('ABACUS.read', natoms, nsteps,
+                                 lambda: self.forwardReader(self.adapterType.ABACUS()).read(output, pbc),
+                                 lambda: self.adapterType.ABACUS().read(output, pbc))
+                    self.measure('isConverged', natoms, nsteps,
+                                 lambda: interface.isConverged(calcFolder),
+                                 setup=lambda: interface.tailer.reset(output),
+                                 size=lambda: os.path.getsize(log))
+                    self.measure('isConverged (tail)', natoms, nsteps,
+                                 lambda: interface.isConverged(calcFolder),
+                                 setup=self.appending(interface, output, log, text),
+                                 size=lambda: len(text) // nsteps)
+
+                    def readOutput():
+                        system = dict(structure=structure, externalPressure=0.0, ase=dict(pbc=pbc))
+                        return interface.readOutput(system, calcFolder)
+
+                    def cold():
+                        interface.tailer.reset(output)
+                        interface.adapter._extracted.clear()
+
+                    self.measure('readOutput', natoms, nsteps, readOutput, setup=cold,
+                                 size=lambda: os.path.getsize(log))
+        finally:
+            os.chdir(cwd)
+
+    @staticmethod
+    def appending(interface, output, log, text):
+        '''
+        Setup of the incremental poll: the log is polled up to its second-to-last ionic step,
+        then the last step is appended, so the timed poll only reads that step
+        '''
+        marker = text.rfind(' STEP OF ')
+        head, last = text[:marker], text[marker:]
+
+        def setup():
+            with open(log, 'w') as f:
+                f.write(head)
+            interface.tailer.reset(output)
+            interface.tailer.poll(output)
+            with open(log, 'a') as f:
+                f.write(last)
+        return setup
+
+    @staticmethod
+    def forwardReader(adapter):
+        adapter.lastFrameOnly = False
+        return adapter
+
+    ############################## VASP ##############################
+    def vaspCases(self, atoms, steps):
+        vasp = self.adapterType.VASP()
+        for natoms in atoms:
+            structure = synthetic.makeStructure(natoms)
+            folder = self.folder(f'vasp-{natoms}')
+            options = dict()
+            self.measure('VASP.write', natoms, None, lambda: options.update(vasp.write(structure, [], 'bench', folder)),
+                         size=lambda: os.path.getsize(pj(folder, vasp.poscar_file)))
+            if not options:
+                continue
+            for nsteps in steps:
+                with open(pj(folder, vasp.outcar_file), 'w') as f:
+                    f.write(synthetic.outcar(structure, nsteps))
+                size = os.path.getsize(pj(folder, vasp.outcar_file))
+                for lastFrame in (False, True):
+                    self.measure('VASP.read (last frame)' if lastFrame else 'VASP.read', natoms, nsteps,
+                                 lambda: vasp.read(folder, lastFrame=lastFrame, **options), size=lambda: size)
+                # the adapter returns the trajectory, the last-frame read only its final step
+                self.compare('VASP.read (last frame)', natoms, nsteps,
+                             lambda: vasp.read(folder, lastFrame=False, **options)[-1],
+                             lambda: vasp.read(folder, lastFrame=True, **options)[-1])
+
+    ############################## QE ##############################
+    def espressoCases(self, atoms, steps):
+        options = pj(self.folder('qe'), 'options')
+        with open(options, 'w') as f:
+            f.write("&CONTROL\n  calculation = 'relax'\n/\n&SYSTEM\n  ecutwfc = 40\n/\n&ELECTRONS\n/\n&IONS\n/\n")
+        try:
+            qe = self.adapterType.QE(options)
+        except Exception as e:
+            self.rows.append(dict(case='QE', atoms=None, steps=None, skipped=f'{type(e).__name__}: {e}'))
+            return
+        pseudopotentials = {'Si': Path('Si.UPF'), 'O': Path('O.UPF')}
+        for natoms in atoms:
+            structure = synthetic.makeStructure(natoms)
+            folder = Path(self.folder(f'qe-{natoms}'))
+            self.measure('QE.write', natoms, None,
+                         lambda: qe.write(structure, [], [2, 2, 2], pseudopotentials, folder),
+                         size=lambda: os.path.getsize(folder / qe.inputFile))
+            for nsteps in steps:
+                with open(folder / qe.outputFile, 'w') as f:
+                    f.write(synthetic.espressoOutput(structure, nsteps))
+                size = os.path.getsize(folder / qe.outputFile)
+                def reader(lastFrame):
+                    def read():
+                        qe.lastFrameOnly = lastFrame
+                        return qe.read(str(folder), structure.getCell().getPBC())
+                    return read
+                for lastFrame in (False, True):
+                    self.measure('QE.read (last frame)' if lastFrame else 'QE.read', natoms, nsteps, reader(lastFrame),
+                                 size=lambda: size)
+                self.compare('QE.read (last frame)', natoms, nsteps, reader(False), reader(True))
+
+
+def formatRows(rows, baseline=None):
+    '''
+    :param baseline: rows of an earlier run, the ratio of best times is added where sizes match
+    '''
+    reference = {(r['case'], r['atoms'], r['steps']): r for r in baseline or [] if 'best' in r}
+    lines = [f'{"case":<24}{"atoms":>7}{"steps":>7}{"size KiB":>11}{"best ms":>11}{"mean ms":>11}{"MiB/s":>9}'
+             f'{"peak MiB":>10}' + (f'{"vs base":>9}' if baseline else '')]
+    for row in rows:
+        prefix = f'{row["case"]:<24}{row["atoms"] if row["atoms"] is not None else "-":>7}' \
+                 f'{row["steps"] if row["steps"] is not None else "-":>7}'
+        if 'skipped' in row:
+            lines.append(f'{prefix}  skipped: {row["skipped"]}')
+            continue
+        if 'failed' in row and 'best' not in row:
+            lines.append(f'{prefix}  FAILED: {row["failed"]}')
+            continue
+        throughput = row.get('throughput')
+        line = f'{prefix}{row.get("bytes", 0) / 1024:>11.1f}{row["best"] * 1e3:>11.2f}{row["mean"] * 1e3:>11.2f}' \
+               f'{throughput / 2 ** 20 if throughput else 0:>9.1f}{row["peak"] / 2 ** 20:>10.2f}'
+        previous = reference.get((row['case'], row['atoms'], row['steps']))
+        if previous is not None:
+            line += f'{row["best"] / previous["best"]:>8.2f}x'
+        if 'failed' in row:
+            line += f'  FAILED: {row["failed"]}'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the adapter read/write paths on synthetic outputs')
+    parser.add_argument('--atoms', default='8,64,256', help='comma-separated atom counts')
+    parser.add_argument('--steps', default='1,10,50', help='comma-separated ionic-step counts')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per case')
+    parser.add_argument('--codes', default='abacus,vasp,qe', help='comma-separated subset of abacus, vasp, qe')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run to compare the best times with')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    atoms = [int(n) for n in args.atoms.split(',')]
+    steps = [int(n) for n in args.steps.split(',')]
+    codes = set(args.codes.lower().split(','))
+    workFolder = tempfile.mkdtemp(prefix='uspex_bench_')
+    try:
+        try:
+            benchmark = Benchmark(loadPackage(workFolder), workFolder, repeat=args.repeat)
+        except ImportError as e:
+            # e.g. ase without the ase-abacus reader, which the adapter module imports
+            rows = [dict(case=code, atoms=None, steps=None, skipped=Benchmark.describe(e)) for code in sorted(codes)]
+        else:
+            if 'abacus' in codes:
+                benchmark.abacusCases(atoms, steps)
+            if 'vasp' in codes:
+                benchmark.vaspCases(atoms, steps)
+            if 'qe' in codes:
+                benchmark.espressoCases(atoms, steps)
+            rows = benchmark.rows
+    finally:
+        shutil.rmtree(workFolder, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['rows']
+    print(formatRows(rows, baseline))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(python=sys.version.split()[0], time=time.time(), rows=rows), f, indent=1)
+    return 1 if any('failed' in row for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
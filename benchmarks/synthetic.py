@@ -0,0 +1,278 @@
+"""
+USPEX.Stages.benchmarks.synthetic
+
+Synthetic structures and ABACUS/VASP/QE outputs scaled by atom and ionic-step count
+
+===========================
+"""
+import numpy as np
+
+BOHR = 0.52917721067
+RY = 13.605693122994
+
+
+class Element:
+    '''
+    Stand-in for the USPEX atom type, registered through ASEInterfaceAdapter.registerTypes
+    '''
+
+    def __init__(self, short_name: str):
+        self.short_name = short_name
+
+    def __repr__(self):
+        return self.short_name
+
+
+class Cell:
+
+    def __init__(self, vectors, pbc=(True, True, True)):
+        self.vectors = np.asarray(vectors, dtype=float)
+        self.pbc = pbc
+
+    def getCellVectors(self):
+        return self.vectors
+
+    def getPBC(self):
+        return self.pbc
+
+
+class Structure:
+
+    def __init__(self, atomTypes, positions, cell):
+        self.atomTypes = list(atomTypes)
+        self.positions = np.asarray(positions, dtype=float)
+        self.cell = cell
+
+    def getAtomTypes(self):
+        return self.atomTypes
+
+    def getCartesianCoordinates(self):
+        return self.positions
+
+    def getCell(self):
+        return self.cell
+
+
+def makeStructure(natoms: int, species=('Si', 'O'), volumePerAtom: float = 20.0, seed: int = 0):
+    '''
+    Random structure in a slightly skewed cell, species dealt out in turn
+    '''
+    rng = np.random.default_rng(seed)
+    length = (natoms * volumePerAtom) ** (1 / 3)
+    vectors = np.diag([length, length * 1.05, length * 0.95]) + rng.uniform(-0.05, 0.05, (3, 3)) * length
+    positions = rng.random((natoms, 3)) @ vectors
+    elements = {s: Element(s) for s in species}
+    atomTypes = [elements[species[i % len(species)]] for i in range(natoms)]
+    return Structure(atomTypes, positions, Cell(vectors))
+
+
+def trajectory(structure: Structure, steps: int, cellRelax: bool = False, seed: int = 0):
+    '''
+    Ionic steps of a relaxation of structure with atoms grouped by species as the codes print them
+    :return: symbols, list of dicts with cell, positions (A), energy (eV), forces (eV/A) and stress (kbar)
+    '''
+    rng = np.random.default_rng(seed)
+    symbols = np.asarray([el.short_name for el in structure.getAtomTypes()])
+    order = np.argsort(symbols, kind='stable')
+    symbols = symbols[order]
+    cell = structure.getCell().getCellVectors().copy()
+    positions = structure.getCartesianCoordinates()[order].copy()
+    natoms = len(symbols)
+    frames = []
+    for step in range(steps):
+        decay = 0.5 ** step
+        forces = rng.normal(0.0, 0.5 * decay, (natoms, 3))
+        forces -= forces.mean(axis=0)
+        stress = rng.normal(0.0, 20.0 * decay, (3, 3))
+        stress = (stress + stress.T) / 2
+        frames.append(dict(cell=cell.copy(), positions=positions.copy(), forces=forces, stress=stress,
+                           energy=-5.0 * natoms - decay))
+        positions = positions + 0.02 * forces
+        if cellRelax:
+            cell = cell @ (np.eye(3) + 1e-4 * stress)
+    return symbols, frames
+
+
+def _species(symbols):
+    species, first, counts = np.unique(symbols, return_index=True, return_counts=True)
+    order = np.argsort(first)
+    return species[order], counts[order]
+
+
+def _rows(template: str, values):
+    values = np.asarray(values)
+    return (template * len(values)).format(*values.ravel())
+
+
+def abacusLog(structure: Structure, steps: int, cellRelax: bool = False, converged: bool = True, scfIterations: int = 12,
+              seed: int = 0):
+    '''
+    running_relax.log (running_cell-relax.log with cellRelax) of ABACUS 3.x for a relaxation of
+    structure taking steps ionic steps
+    '''
+    symbols, frames = trajectory(structure, steps, cellRelax, seed)
+    species, counts = _species(symbols)
+    labels = [f'{s}{i + 1}' for s, count in zip(species, counts) for i in range(count)]
+
+    def label(text, value):
+        return f'{text:>41} = {value}\n'
+
+    def coordinates(frame):
+        scaled = np.linalg.solve(frame['cell'].T, frame['positions'].T).T
+        lines = [' DIRECT COORDINATES\n',
+                 f'{"atom":>13}{"x":>20}{"y":>20}{"z":>20}{"mag":>20}{"vx":>20}{"vy":>20}{"vz":>20}\n']
+        lines += [f'{"tauD_" + name:>13}{x:>20.12g}{y:>20.12g}{z:>20.12g}{0:>20}{0:>20}{0:>20}{0:>20}\n'
+                  for name, (x, y, z) in zip(labels, scaled)]
+        volume = abs(np.linalg.det(frame['cell']))
+        lines += ['\n\n', label('Volume (Bohr^3)', f'{volume / BOHR ** 3:.6g}'),
+                  label('Volume (A^3)', f'{volume:.6g}'),
+                  '\n Lattice vectors: (Cartesian coordinate: in unit of a_0)\n',
+                  _rows('{:>+21.10g}{:>+21.10g}{:>+21.10g}\n', frame['cell'])]
+        return lines
+
+    lines = ['\n', '                              ABACUS v3.4.0\n', '\n',
+             '               Atomic-orbital Based Ab-initio Computation at UStc\n', '\n',
+             ' READING GENERAL INFORMATION\n', label('global_out_dir', 'OUT.USPEX/'),
+             label('global_in_card', 'INPUT'), '\n',
+             ' READING UNITCELL INFORMATION\n', label('ntype', len(species)),
+             label('lattice constant (Bohr)', f'{1 / BOHR:.6g}'), label('lattice constant (Angstrom)', 1), '\n']
+    for i, (element, count) in enumerate(zip(species, counts)):
+        lines += [f' READING ATOM TYPE {i + 1}\n', label('atom label', element),
+                  label('number of atom for this type', count), label('start magnetization', 'FALSE'), '\n']
+    lines += [label('TOTAL ATOM NUMBER', len(symbols)), '\n']
+    lines += coordinates(frames[0])
+    lines += ['\n', ' SETUP THE PLANE WAVE BASIS\n', label('energy cutoff for wavefunc (unit:Ry)', 50), '\n']
+
+    for step, frame in enumerate(frames):
+        last = step == len(frames) - 1
+        lines += [' -------------------------------------------\n',
+                  f' STEP OF {"RELAXATION" if cellRelax else "ION RELAXATION"} : {step + 1}\n',
+                  ' -------------------------------------------\n',
+                  ' START CHARGE      : atomic\n',
+                  ' ITER   ETOT(eV)       EDIFF(eV)      DRHO       TIME(s)\n']
+        for iteration in range(scfIterations):
+            lines.append(f' CG{iteration + 1:<4d} {frame["energy"] + 10.0 ** -iteration:<14.8e} '
+                         f'{-(10.0 ** -iteration):<14.4e} {10.0 ** -(iteration / 2 + 1):<10.4e} 0.05\n')
+        if converged or not last:
+            lines.append(' charge density convergence is achieved\n')
+        else:
+            lines.append(' !! convergence has not been achieved @_@\n')
+        lines += [f' final etot is {frame["energy"]:.10f} eV\n', '\n',
+                  ' ------------------------------------------------------------------------------------------\n',
+                  ' TOTAL-FORCE (eV/Angstrom)\n',
+                  ' ------------------------------------------------------------------------------------------\n']
+        lines += [f'{name:>8}{fx:>27.10f}{fy:>27.10f}{fz:>27.10f}\n' for name, (fx, fy, fz) in zip(labels, frame['forces'])]
+        lines += [' ------------------------------------------------------------------------------------------\n',
+                  ' TOTAL-STRESS (KBAR)\n',
+                  ' ----------------------------------------------------------------\n',
+                  _rows('{:>21.10f}{:>21.10f}{:>21.10f}\n', frame['stress']),
+                  ' ----------------------------------------------------------------\n',
+                  f' TOTAL-PRESSURE: {np.trace(frame["stress"]) / 3:.6f} KBAR\n', '\n']
+        if not last:
+            lines += [' Ion relaxation is not converged yet (threshold is 0.0257112)\n', '\n']
+            lines += coordinates(frames[step + 1])
+            lines.append('\n')
+    if converged:
+        lines += ['\n', ' Relaxation is converged!\n' if cellRelax else ' Ion relaxation is converged!\n']
+    lines += ['\n', f' !FINAL_ETOT_IS {frames[-1]["energy"]:.10f} eV\n', '\n',
+              ' |CLASS_NAME---------|NAME---------------|TIME(Sec)-----|CALLS----|AVG------|PER%-------\n',
+              f'{"":21}total{"":15}{5.0 * steps:<15.2f}{9:<10d}{0.58:<10.2f}100.00%\n',
+              f' Driver              reading             {0.01:<15.2f}{1:<10d}{0.01:<10.2f}0.19%\n',
+              f' ESolver_KS_PW       runner              {4.9 * steps:<15.2f}{steps:<10d}{4.9:<10.2f}98.00%\n',
+              ' ----------------------------------------------------------------------------------------\n', '\n',
+              ' Start  Time  : Sat Oct 17 10:00:00 2026\n', ' Finish Time  : Sat Oct 17 10:00:05 2026\n',
+              f' Total  Time  : 0 h {int(5 * steps) // 60} mins {int(5 * steps) % 60} secs \n']
+    return ''.join(lines)
+
+
+def outcar(structure: Structure, steps: int, cellRelax: bool = False, seed: int = 0):
+    '''
+    OUTCAR of VASP for a relaxation of structure taking steps ionic steps
+    '''
+    symbols, frames = trajectory(structure, steps, cellRelax, seed)
+    species, counts = _species(symbols)
+    lines = [f' POTCAR:    PAW_PBE {element} 05Jan2001\n' for element in species] * 2
+    lines += ['   ions per type =     ' + ''.join(f'{count:6d}' for count in counts) + '\n',
+              ' ISPIN  =      1    spin polarized calculation?\n',
+              '   k-points           NKPTS =      1   k-points in BZ     NKDIM =      1   number of bands    NBANDS=  '
+              f'{4 * len(symbols):5d}\n',
+              ' k-points in reciprocal lattice and weights: K-Points\n',
+              '   0.00000000  0.00000000  0.00000000       1.000\n', '\n']
+    for step, frame in enumerate(frames):
+        reciprocal = np.linalg.inv(frame['cell']).T
+        lines += [f'--------------------------------------- Iteration {step + 1:6d}(  12)  '
+                  '---------------------------------------\n',
+                  '  FORCE on cell =-STRESS in cart. coord.  units (eV):\n',
+                  '  Direction    XX          YY          ZZ          XY          YZ          ZX\n',
+                  '  --------------------------------------------------------------------------------------\n',
+                  '  in kB' + ''.join(f'{frame["stress"][i, j]:12.5f}' for i, j in
+                                      ((0, 0), (1, 1), (2, 2), (0, 1), (1, 2), (0, 2))) + '\n',
+                  '\n', ' direct lattice vectors                 reciprocal lattice vectors\n',
+                  _rows('    {:12.9f} {:12.9f} {:12.9f}    {:12.9f} {:12.9f} {:12.9f}\n',
+                        np.hstack([frame['cell'], reciprocal])), '\n',
+                  ' POSITION                                       TOTAL-FORCE (eV/Angst)\n',
+                  ' -----------------------------------------------------------------------------------\n',
+                  _rows('  {:12.5f} {:12.5f} {:12.5f}   {:13.6f} {:13.6f} {:13.6f}\n',
+                        np.hstack([frame['positions'], frame['forces']])),
+                  ' -----------------------------------------------------------------------------------\n',
+                  '\n', '\n', '  FREE ENERGIE OF THE ION-ELECTRON SYSTEM (eV)\n',
+                  '  ---------------------------------------------------\n',
+                  f'  free  energy   TOTEN  =     {frame["energy"]:16.8f} eV\n', '\n',
+                  f'  energy  without entropy=     {frame["energy"]:16.8f}  energy(sigma->0) =     '
+                  f'{frame["energy"]:16.8f}\n', '\n']
+    return ''.join(lines)
+
+
+def espressoOutput(structure: Structure, steps: int, cellRelax: bool = False, seed: int = 0):
+    '''
+    pw.x output of Quantum ESPRESSO for a (vc-)relax of structure taking steps ionic steps
+    '''
+    symbols, frames = trajectory(structure, steps, cellRelax, seed)
+    species, _ = _species(symbols)
+    cell = frames[0]['cell']
+    alat = np.linalg.norm(cell[0])
+    natoms = len(symbols)
+    lines = ['\n', '     Program PWSCF v.7.2 starts on 17Oct2026 at 10: 0: 0 \n', '\n',
+             '     bravais-lattice index     =            0\n',
+             f'     lattice parameter (alat)  = {alat / BOHR:12.4f}  a.u.\n',
+             f'     unit-cell volume          = {abs(np.linalg.det(cell)) / BOHR ** 3:12.4f} (a.u.)^3\n',
+             f'     number of atoms/cell      = {natoms:12d}\n',
+             f'     number of atomic types    = {len(species):12d}\n', '\n',
+             f'     celldm(1)= {alat / BOHR:11.6f}  celldm(2)=   0.000000  celldm(3)=   0.000000\n', '\n',
+             '     crystal axes: (cart. coord. in units of alat)\n']
+    lines += [f'               a({i + 1}) = ( {x:10.6f} {y:10.6f} {z:10.6f} )  \n'
+              for i, (x, y, z) in enumerate(cell / alat)]
+    lines += ['\n', '   Cartesian axes\n', '\n',
+              '     site n.     atom                  positions (alat units)\n']
+    lines += [f'     {i + 1:5d}           {s:<4}tau({i + 1:4d}) = (  {x:10.7f}  {y:10.7f}  {z:10.7f}  )\n'
+              for i, (s, (x, y, z)) in enumerate(zip(symbols, frames[0]['positions'] / alat))]
+    lines.append('\n')
+    for step, frame in enumerate(frames):
+        if step > 0:
+            if cellRelax:
+                lines += ['\n', 'CELL_PARAMETERS (angstrom)\n', _rows('{:14.9f}{:14.9f}{:14.9f}\n', frame['cell']),
+                          '\n']
+            lines.append('ATOMIC_POSITIONS (angstrom)\n')
+            lines += [f'{s:<4}{x:16.10f}{y:16.10f}{z:16.10f}\n' for s, (x, y, z) in zip(symbols, frame['positions'])]
+            lines.append('\n')
+        energy = frame['energy'] / RY
+        lines += ['     total cpu time spent up to now is        5.0 secs\n', '\n',
+                  '     End of self-consistent calculation\n', '\n',
+                  "     Number of k-points >= 100: set verbosity='high' to print the bands.\n", '\n',
+                  '     the Fermi energy is     6.1234 ev\n', '\n',
+                  f'!    total energy              = {energy:18.8f} Ry\n',
+                  '     estimated scf accuracy    <       0.00000050 Ry\n', '\n',
+                  '     convergence has been achieved in  12 iterations\n', '\n',
+                  '     Forces acting on atoms (cartesian axes, Ry/au):\n', '\n']
+        lines += [f'     atom {i + 1:4d} type {1 + int(np.flatnonzero(species == s)[0]):2d}   force = '
+                  f'{fx:14.8f}{fy:14.8f}{fz:14.8f}\n'
+                  for i, (s, (fx, fy, fz)) in enumerate(zip(symbols, frame['forces'] * BOHR / RY))]
+        lines += ['\n', f'     Total force = {np.linalg.norm(frame["forces"]) * BOHR / RY:12.6f}     '
+                  'Total SCF correction =     0.000001\n', '\n']
+        stress = frame['stress']
+        lines += [f'     total   stress  (Ry/bohr**3)                   (kbar)     P= {np.trace(stress) / 3:11.2f}\n',
+                  _rows('  {:13.8f} {:13.8f} {:13.8f}  {:12.2f} {:12.2f} {:12.2f}\n',
+                        np.hstack([stress / 147105.08, stress])), '\n']
+    lines += ['     bfgs converged in  %3d scf cycles and %3d bfgs steps\n' % (steps, max(steps - 1, 0)), '\n',
+              '     End of BFGS Geometry Optimization\n', '\n', '     JOB DONE.\n']
+    return ''.join(lines)
@@ -1,3 +1,88 @@
+import atexit
+import importlib
+import inspect
+import logging
+import os
+import time
+
+_startTime = time.perf_counter()
+logger = logging.getLogger(__name__)
+
+
+class LazyComponent:
+    '''
+    Registered in place of a class. The module is imported and the registration callback
+    run the first time the component is called or one of its attributes is looked up.
+    Attribute lookups (__init__, __doc__, __name__, ...), isinstance/issubclass and
+    inspect.signature are answered by the resolved class.
+    '''
+
+    # component name -> seconds spent importing and registering it
+    loaded = dict()
+    pending = dict()
+    _own = ('_module', '_name', '_register', '_target', 'resolve')
+
+    def __init__(self, module: str, name: str, register=None):
+        self._module = module
+        self._name = name
+        self._register = register
+        self._target = None
+        LazyComponent.pending[name] = self
+
+    def resolve(self):
+        if self._target is None:
+            start = time.perf_counter()
+            target = getattr(importlib.import_module(self._module, __package__), self._name)
+            if self._register is not None:
+                self._register(target)
+            self._target = target
+            LazyComponent.pending.pop(self._name, None)
+            LazyComponent.loaded[self._name] = time.perf_counter() - start
+            logger.debug(f'Loaded {self._name} in {LazyComponent.loaded[self._name]:.3f} s')
+        return self._target
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattribute__(self, item):
+        if item in LazyComponent._own:
+            return object.__getattribute__(self, item)
+        target = self.resolve()
+        if item == '__bases__':
+            # issubclass(component, X) walks __bases__, the resolved class itself has to be found there
+            return (target,)
+        if item == '__signature__':
+            return inspect.signature(target)
+        return getattr(target, item)
+
+    def __instancecheck__(self, instance):
+        return isinstance(instance, self.resolve())
+
+    def __subclasscheck__(self, subclass):
+        return issubclass(subclass, self.resolve())
+
+    def __repr__(self):
+        return f'LazyComponent({self._module}.{self._name})'
+
+
+def componentsReport():
+    '''
+    :return: text listing the lazy components loaded so far with their load time
+    '''
+    lines = [f'Eager imports: {_eagerTime:.3f} s']
+    for name, seconds in sorted(LazyComponent.loaded.items(), key=lambda item: -item[1]):
+        lines.append(f'  loaded {name}: {seconds:.3f} s')
+    lines.append(f'  not loaded: {", ".join(sorted(LazyComponent.pending)) or "-"}')
+    return '\n'.join(lines)
+
+
+def _aseInterfaceAdapter():
+    from .Stages.Interfaces.ASEInterfaceAdapter import ASEInterfaceAdapter
+    if ASEInterfaceAdapter.structureType is None:
+        ASEInterfaceAdapter.registerTypes(AtomicStructure, Element, Cell)
+    return ASEInterfaceAdapter
+
+
 from .Atomistic.Element import Element
 from .Atomistic.CellUtility import Cell
 from .Atomistic.AtomicPrimitives import AtomicStructure, AtomicDisassembler
@@ -49,48 +134,35 @@ GlobalOptimizer.registerTarget('Atomistic',
                       creations=[RandTop, RandSym, RandSymPyXtal],
                       seeds=Seeds)
 from .Stages.Executor import Executor
-from .Stages.Interfaces.ASEInterfaceAdapter import ASEInterfaceAdapter
-ASEInterfaceAdapter.registerTypes(AtomicStructure, Element, Cell)
-from .Stages.Interfaces.ABINIT_Interface import ABINIT_Interface
-ABINIT_Interface.registerTypes(AtomicStructure, Element, Cell)
-Executor.registerInterface('abinit', ABINIT_Interface)
-from .Stages.Interfaces.GULP_Interface import GULP_Interface
-GULP_Interface.registerTypes(AtomicStructure, Element, Cell)
-Executor.registerInterface('gulp', GULP_Interface)
-from .Stages.Interfaces.LAMMPS_Interface import LAMMPS_Interface
-LAMMPS_Interface.registerTypes(AtomisticRepresentation, ASEInterfaceAdapter.LAMMPS)
-Executor.registerInterface('lammps', LAMMPS_Interface)
-from .Stages.Interfaces.MLIP_Interface import MLIP_Interface
-MLIP_Interface.registerTypes(AtomisticRepresentation, AtomicDisassembler)
-Executor.registerInterface('mlip', MLIP_Interface)
+# Calculator interfaces and task managers are only imported when a run actually uses them
+Executor.registerInterface('abinit', LazyComponent('.Stages.Interfaces.ABINIT_Interface', 'ABINIT_Interface',
+                                                   lambda c: c.registerTypes(AtomicStructure, Element, Cell)))
+Executor.registerInterface('gulp', LazyComponent('.Stages.Interfaces.GULP_Interface', 'GULP_Interface',
+                                                 lambda c: c.registerTypes(AtomicStructure, Element, Cell)))
+Executor.registerInterface('lammps', LazyComponent('.Stages.Interfaces.LAMMPS_Interface', 'LAMMPS_Interface',
+                                                   lambda c: c.registerTypes(AtomisticRepresentation,
+                                                                             _aseInterfaceAdapter().LAMMPS)))
+Executor.registerInterface('mlip', LazyComponent('.Stages.Interfaces.MLIP_Interface', 'MLIP_Interface',
+                                                 lambda c: c.registerTypes(AtomisticRepresentation, AtomicDisassembler)))
 from .Stages.Interfaces.PWmat_Interface import PWmat_Interface
 PWmat_Interface.registerTypes(AtomicStructure, Element, Cell)
-from .Stages.Interfaces.QE_Interface import QE_Interface
-QE_Interface.registerTypes(ASEInterfaceAdapter.QE)
-Executor.registerInterface('qe', QE_Interface)
-
-from .Stages.Interfaces.ABACUS_Interface import ABACUS_Interface
-ABACUS_Interface.registerTypes(ASEInterfaceAdapter.ABACUS)
-Executor.registerInterface('abacus', ABACUS_Interface)
-
-from .Stages.Interfaces.VASP_Interface import VASP_Interface
-VASP_Interface.registerTypes(ASEInterfaceAdapter.VASP)
-Executor.registerInterface('vasp', VASP_Interface)
-
-from .Stages.Interfaces.MOPAC_Interface import MOPAC_Interface
-MOPAC_Interface.registerTypes(AtomicStructure, Element, Cell)
-Executor.registerInterface('mopac', MOPAC_Interface)
-from .Stages.Interfaces.FHIaims_Interface import FHIaims_Interface
-FHIaims_Interface.registerTypes(AtomicStructure, Element, Cell)
-Executor.registerInterface('aims', FHIaims_Interface)
-from .Stages.TaskManagers.BSUB import BSUB
-Executor.registerTaskManager('BSUB', BSUB)
-from .Stages.TaskManagers.QSUB import QSUB
-Executor.registerTaskManager('QSUB', QSUB)
-from .Stages.TaskManagers.SBATCH import SBATCH
-Executor.registerTaskManager('SBATCH', SBATCH)
-from .Stages.TaskManagers.SHELL import SHELL
-Executor.registerTaskManager('SHELL', SHELL)
+Executor.registerInterface('qe', LazyComponent('.Stages.Interfaces.QE_Interface', 'QE_Interface',
+                                               lambda c: c.registerTypes(_aseInterfaceAdapter().QE)))
+
+Executor.registerInterface('abacus', LazyComponent('.Stages.Interfaces.ABACUS_Interface', 'ABACUS_Interface',
+                                                   lambda c: c.registerTypes(_aseInterfaceAdapter().ABACUS)))
+
+Executor.registerInterface('vasp', LazyComponent('.Stages.Interfaces.VASP_Interface', 'VASP_Interface',
+                                                 lambda c: c.registerTypes(_aseInterfaceAdapter().VASP)))
+
+Executor.registerInterface('mopac', LazyComponent('.Stages.Interfaces.MOPAC_Interface', 'MOPAC_Interface',
+                                                  lambda c: c.registerTypes(AtomicStructure, Element, Cell)))
+Executor.registerInterface('aims', LazyComponent('.Stages.Interfaces.FHIaims_Interface', 'FHIaims_Interface',
+                                                 lambda c: c.registerTypes(AtomicStructure, Element, Cell)))
+Executor.registerTaskManager('BSUB', LazyComponent('.Stages.TaskManagers.BSUB', 'BSUB'))
+Executor.registerTaskManager('QSUB', LazyComponent('.Stages.TaskManagers.QSUB', 'QSUB'))
+Executor.registerTaskManager('SBATCH', LazyComponent('.Stages.TaskManagers.SBATCH', 'SBATCH'))
+Executor.registerTaskManager('SHELL', LazyComponent('.Stages.TaskManagers.SHELL', 'SHELL'))
 from .Optimizers.ModelOptimizer import ModelOptimizer, External
 External.setExecutorType(Executor)
 ModelOptimizer.registerModel(External)
@@ -102,15 +174,18 @@ ModelOptimizer.registerTarget('Atomistic',
                       mutations=[Softmodemutation, Permutation, Transmutation, AddAtom, RemoveAtom, TeleportAtom],
                       creations=[RandTop, RandSym, RandSymPyXtal],
                       seeds=Seeds)
-from .Stages.AtomisticStage import AtomisticStage
-AtomisticStage.registerTypes(Executor, AtomicDisassembler)
 from .Stages.PopulationProcessor import PopulationProcessor
 from .Stages.GenerationController import GenerationController
 GenerationController.registerOptimizer(GlobalOptimizer)
 GenerationController.registerOptimizer(ModelOptimizer)
 from .Stages import Stages
 Stages.registerStage('execute', Executor)
-Stages.registerStage('atomistic', AtomisticStage)
+Stages.registerStage('atomistic', LazyComponent('.Stages.AtomisticStage', 'AtomisticStage',
+                                                lambda c: c.registerTypes(Executor, AtomicDisassembler)))
 Stages.registerStage('populationProcessor', PopulationProcessor)
 GenerationController.setPopulationProcessor(PopulationProcessor)
 PopulationProcessor.setStages(Stages)
+
+_eagerTime = time.perf_counter() - _startTime
+if os.environ.get('USPEX_COMPONENTS_REPORT'):
+    atexit.register(lambda: logger.info(f'USPEX components\n{componentsReport()}'))
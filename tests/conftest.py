@@ -0,0 +1,15 @@
+"""
+The modules of this repository are installed into USPEX/Stages/Interfaces and import each other
+relatively. The tests load them as the package abacus_stages, rooted at the repository.
+"""
+import os
+import sys
+import types
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = 'abacus_stages'
+
+if PACKAGE not in sys.modules:
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [REPOSITORY]
+    sys.modules[PACKAGE] = package
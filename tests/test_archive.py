@@ -0,0 +1,24 @@
+import os
+from os.path import join as pj
+
+from abacus_stages.ABACUS_Archive import ResultArchive
+
+
+def test_dedupe_pools_staged_files_only(tmp_path):
+    archive = ResultArchive(pj(tmp_path, 'archive'), retention='dedupe')
+    folders = [pj(tmp_path, name) for name in ('CalcFold1', 'CalcFold2')]
+    for folder in folders:
+        os.makedirs(pj(folder, 'OUT.USPEX'))
+        with open(pj(folder, 'OUT.USPEX', 'SPIN1_CHG.cube'), 'w') as f:
+            f.write('density\n')
+        with open(pj(folder, 'Si.upf'), 'w') as f:
+            f.write('potential\n')
+        archive.applyRetention(folder, staged=['Specific/Si.upf'])
+
+    assert os.path.samefile(pj(folders[0], 'Si.upf'), pj(folders[1], 'Si.upf'))
+    # a reused folder gets its density rewritten in place, the other folder must not see it
+    with open(pj(folders[0], 'OUT.USPEX', 'SPIN1_CHG.cube'), 'w') as f:
+        f.write('rewritten\n')
+    with open(pj(folders[1], 'OUT.USPEX', 'SPIN1_CHG.cube')) as f:
+        assert f.read() == 'density\n'
+    archive.close()
@@ -0,0 +1,21 @@
+from os.path import join as pj
+
+from abacus_stages.ABACUS_Instrumentation import Instrumentation
+
+
+def test_stages_share_one_prometheus_export(tmp_path):
+    filename = pj(tmp_path, 'metrics.prom')
+    # one interface per stage, created with the same instrumentation option
+    stages = [Instrumentation.forFile(filename, format='prometheus') for _ in range(2)]
+    assert stages[0] is stages[1]
+    assert Instrumentation.forFile(None).enabled is False
+
+    for tag, instrumentation in enumerate(stages, start=1):
+        calcFolder = pj(tmp_path, 'CalcFold1')
+        instrumentation.start(calcFolder)
+        instrumentation.lap(calcFolder, f'stage{tag}')
+        instrumentation.finish(calcFolder)
+    with open(filename) as f:
+        text = f.read()
+    assert 'phase="stage1"' in text and 'phase="stage2"' in text
+    assert 'uspex_abacus_structures_total 2' in text
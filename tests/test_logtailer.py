@@ -0,0 +1,36 @@
+from os.path import join as pj
+
+from abacus_stages.ABACUS_LogTailer import LogTailer
+
+
+def header(start):
+    return f' ABACUS v3.3\n Start Time is {start}\n'
+
+
+def test_appended_lines_extend_the_state(tmp_path):
+    log = pj(tmp_path, 'running_relax.log')
+    with open(log, 'w') as f:
+        f.write(header('Mon Oct 16 10:00:00 2023') + ' ION=   1 ELEC=   1\n')
+    tailer = LogTailer()
+    state = tailer.poll(tmp_path)
+    with open(log, 'a') as f:
+        f.write(' charge density convergence is achieved\n ION=   2 ELEC=   1\n')
+    assert tailer.poll(tmp_path) is state
+    assert state.ionicSteps == 2 and state.scfConverged is None
+
+
+def test_log_rewritten_in_place_is_parsed_again(tmp_path):
+    log = pj(tmp_path, 'running_relax.log')
+    with open(log, 'w') as f:
+        f.write(header('Mon Oct 16 10:00:00 2023') + ' ION=   1 ELEC=   1\n'
+                ' !! convergence has not been achieved @_@\n')
+    tailer = LogTailer()
+    assert tailer.poll(tmp_path).scfConverged is False
+    # a new run truncates and rewrites the same file, past the old offset before the next poll
+    with open(log, 'r+') as f:
+        f.truncate(0)
+        f.write(header('Mon Oct 16 11:00:00 2023') + ' ION=   1 ELEC=   1\n'
+                ' charge density convergence is achieved\n ION=   2 ELEC=   1\n'
+                ' charge density convergence is achieved\n')
+    state = tailer.poll(tmp_path)
+    assert state.ionicSteps == 2 and state.scfConverged is True and state.scfFailures == 0
@@ -0,0 +1,24 @@
+from abacus_stages.ABACUS_LogTailer import LogState
+from abacus_stages.ABACUS_Monitor import EarlyAbortMonitor
+
+
+def feed(state, text):
+    for line in text.splitlines():
+        state.feed(line)
+    return state
+
+
+def test_energy_printed_twice_counts_once():
+    steps = ''.join(f' STEP OF ION RELAXATION : {step + 1}\n'
+                    ' charge density convergence is achieved\n'
+                    f' final etot is {energy:.10f} eV\n'
+                    f' !FINAL_ETOT_IS {energy:.10f} eV\n'
+                    for step, energy in enumerate([-10.0, -9.0] * 3))
+    state = feed(LogState('running_relax.log'), steps)
+    assert state.energies == [-10.0, -9.0] * 3
+    assert EarlyAbortMonitor().reason(state, natoms=8).startswith('energy oscillates')
+
+
+def test_energy_of_single_point_is_kept():
+    state = feed(LogState('running_scf.log'), ' final etot is -5.0 eV\n !FINAL_ETOT_IS -5.5 eV\n')
+    assert state.energies == [-5.5]
@@ -0,0 +1,91 @@
+import os
+import stat
+import subprocess
+import sys
+from os.path import join as pj
+
+import pytest
+
+from abacus_stages.ABACUS_Runner import PackedRunner, writePackScript
+
+pytestmark = pytest.mark.skipif(sys.platform.startswith('win'), reason='stub binaries are shell scripts')
+
+
+def executable(filename, text):
+    with open(filename, 'w') as f:
+        f.write(text)
+    os.chmod(filename, os.stat(filename).st_mode | stat.S_IEXEC)
+    return filename
+
+
+@pytest.fixture
+def stubs(tmp_path):
+    '''
+    Stand-ins for abacus and mpirun: abacus records its environment and exits with the code in
+    the EXIT file of the calc folder, mpirun records -np and runs the rest of its command line
+    '''
+    abacus = executable(tmp_path / 'abacus', '#!/bin/sh\n'
+                        'mkdir -p OUT.USPEX\n'
+                        'echo " ION=   1 ELEC=   1" > OUT.USPEX/running_scf.log\n'
+                        'echo "$OMP_NUM_THREADS" > omp\n'
+                        'echo "stub abacus"\n'
+                        'exit $(cat EXIT 2>/dev/null || echo 0)\n')
+    mpirun = executable(tmp_path / 'mpirun', '#!/bin/sh\necho "$2" > np\nshift 2\nexec "$@"\n')
+    return str(abacus), f'{mpirun} -np {{np}}'
+
+
+def calcFolder(root, name, exitCode=0):
+    folder = pj(root, name)
+    os.makedirs(folder)
+    with open(pj(folder, 'EXIT'), 'w') as f:
+        f.write(f'{exitCode}\n')
+    return folder
+
+
+def read(filename):
+    with open(filename) as f:
+        return f.read().strip()
+
+
+def test_pack_script_marks_every_folder_done(tmp_path, stubs):
+    abacus, mpi = stubs
+    folders = [calcFolder(tmp_path, 'CalcFold1'), calcFolder(tmp_path, 'CalcFold2', exitCode=3)]
+    script = writePackScript(pj(tmp_path, 'pack.sh'), folders, cores=4, workers=2, abacusCommand=abacus,
+                             mpiCommand=mpi)
+    process = subprocess.run([script], capture_output=True, text=True, timeout=60)
+    assert process.returncode == 1, process.stderr
+    assert PackedRunner.readDone(folders[0]) == 0
+    assert PackedRunner.readDone(folders[1]) == 3
+    assert read(pj(folders[0], PackedRunner.outputFile)) == 'stub abacus'
+    assert read(pj(folders[0], 'np')) == '2'
+    assert read(pj(folders[0], 'omp')) == '1'
+
+
+def test_cached_and_discarded_folders_are_skipped(tmp_path, stubs):
+    abacus, mpi = stubs
+    folders = [calcFolder(tmp_path, 'CalcFold1', exitCode=5), calcFolder(tmp_path, 'CalcFold2', exitCode=5)]
+    open(pj(folders[0], PackedRunner.cachedFile), 'w').close()
+    open(pj(folders[1], PackedRunner.discardedFile), 'w').close()
+    runner = PackedRunner(abacusCommand=abacus, cores=2, workers=2, mpiCommand=mpi)
+    assert runner.run(folders) == {folders[0]: 0, folders[1]: 0}
+    for folder in folders:
+        assert PackedRunner.readDone(folder) == 0
+        assert not os.path.exists(pj(folder, 'omp'))
+
+
+def test_parallel_file_is_cut_to_the_share_of_a_worker(tmp_path, stubs):
+    abacus, mpi = stubs
+    folder = calcFolder(tmp_path, 'CalcFold1')
+    with open(pj(folder, PackedRunner.parallelFile), 'w') as f:
+        f.write('export OMP_NUM_THREADS=2\nexport USPEX_MPI_PROCESSES=16\n')
+    runner = PackedRunner(abacusCommand=abacus, cores=8, workers=2, mpiCommand=mpi)
+    assert runner.run([folder]) == {folder: 0}
+    assert read(pj(folder, 'np')) == '2'
+    assert read(pj(folder, 'omp')) == '2'
+
+
+def test_missing_binary_is_reported(tmp_path):
+    folder = calcFolder(tmp_path, 'CalcFold1')
+    runner = PackedRunner(abacusCommand=str(tmp_path / 'no-abacus'), cores=1, mpiCommand='')
+    assert runner.run([folder]) == {folder: 127}
+    assert PackedRunner.readDone(folder) == 127
@@ -0,0 +1,43 @@
+from io import StringIO
+from os.path import dirname, join as pj
+
+import numpy as np
+import pytest
+
+pytest.importorskip('ase.io.abacus')
+from abacus_stages.ASEInterfaceAdapter import ASEInterfaceAdapter  # noqa: E402
+
+GOLDEN = pj(dirname(__file__), 'data', 'STRU_golden')
+
+PP = {'O': 'O_ONCV_PBE-1.0.upf', 'Si': 'Si_ONCV_PBE-1.0.upf'}
+BASIS = {'O': 'O_gga_7au_100Ry_2s2p1d.orb', 'Si': 'Si_gga_8au_100Ry_2s2p1d.orb'}
+# oblique cell with a negative component and one of 10 A or more
+CELL = np.array([[4.0, 0.0, 0.0], [-2.0, 3.5, 0.0], [0.0, 0.0, 12.5]])
+SYMBOLS = np.array(['O', 'O', 'Si', 'Si'])
+# fractional coordinates outside [0, 1) stay as they are, toAtoms builds non-periodic Atoms
+SCALED = np.array([[-0.25, 0.5, 0.8], [0.125, 0.875, 1.2], [0.0, 0.0, 0.0], [0.5, 0.25, 0.1]])
+
+
+def test_format_stru_matches_golden_file():
+    text = ASEInterfaceAdapter.ABACUS.formatStru(SYMBOLS, SCALED @ CELL, CELL, PP, BASIS)
+    with open(GOLDEN) as f:
+        assert text == f.read()
+
+
+def test_format_stru_matches_write_abacus():
+    from ase.io.abacus import write_abacus
+    from abacus_stages.benchmarks.synthetic import makeStructure
+
+    structure = makeStructure(12, seed=7)
+    # atoms outside the cell, as left by a relaxation
+    structure.positions += np.random.default_rng(7).uniform(-6.0, 6.0, structure.positions.shape)
+    atoms, order = ASEInterfaceAdapter.toAtoms(structure, sort=True)
+    reference = StringIO()
+    try:
+        write_abacus(reference, atoms, PP, BASIS)
+    except NotImplementedError:
+        pytest.skip('write_abacus of the ase-abacus package is not available')
+    symbols = np.asarray([el.short_name for el in structure.getAtomTypes()])
+    text = ASEInterfaceAdapter.ABACUS.formatStru(symbols[order], structure.getCartesianCoordinates()[order],
+                                                 structure.getCell().getCellVectors(), PP, BASIS)
+    assert text == reference.getvalue()